@@ -0,0 +1,222 @@
+"""
+Dynamic micro-batching for model inference.
+
+Request threads submit preprocessed image arrays to a MicroBatcher. A single
+worker thread collects whatever is queued - up to max_batch_size rows, waiting
+at most max_wait_ms after the first item arrives - stacks it into one tensor,
+runs one forward pass and hands each request back its own rows.
+"""
+import collections
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from metrics import ENABLED as METRICS_ENABLED, Histogram, observe_stage
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE_ROWS = Histogram(
+    'abdos_inference_batch_rows',
+    'Rows per forward pass formed by the micro-batcher',
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the inference queue cannot accept more work."""
+
+
+class _Item:
+    __slots__ = ('rows', 'predict_fn', 'future', 'enqueued_at')
+
+    def __init__(self, rows, predict_fn):
+        self.rows = rows
+        self.predict_fn = predict_fn
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class MicroBatcher:
+    """
+    Collect concurrent inference requests into batches
+
+    Args:
+    - predict_fn: callable taking an (N, H, W, C) array and returning (N, classes);
+      submit() may name another one per item (e.g. a leased model version)
+    - max_batch_size: upper bound on rows per forward pass
+    - max_wait_ms: how long the first queued item may wait for company
+    - max_queue_size: queued items before submit() starts rejecting work
+    """
+
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=5.0, max_queue_size=256):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        self.predict_fn = predict_fn
+        self.max_batch_size = int(max_batch_size)
+        self.max_wait = max(float(max_wait_ms), 0.0) / 1000.0
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._carry = None
+        self._lock = threading.Lock()
+        self._batch_sizes = collections.Counter()
+        self._queue_waits = collections.deque(maxlen=2048)
+        self._total_batches = 0
+        self._total_rows = 0
+        self._failed_batches = 0
+
+        self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._worker.start()
+
+    # ------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------
+
+    def submit(self, rows, predict_fn=None):
+        """
+        Queue one image (H, W, C) or a small batch (N, H, W, C)
+
+        Returns a Future that resolves to the model output rows for this item.
+        Items are only batched with others that use the same predict_fn.
+        """
+        rows = np.asarray(rows, dtype=np.float32)
+        if rows.ndim == 3:
+            rows = rows[np.newaxis, ...]
+        if len(rows) > self.max_batch_size:
+            raise ValueError(
+                f'Submitted {len(rows)} rows but max_batch_size is {self.max_batch_size}'
+            )
+
+        item = _Item(rows, predict_fn or self.predict_fn)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            raise QueueFullError('Inference queue is full, try again later')
+        return item.future
+
+    def predict(self, rows, timeout=None, predict_fn=None):
+        """Blocking convenience wrapper around submit()"""
+        return self.submit(rows, predict_fn).result(timeout=timeout)
+
+    def stats(self):
+        """Snapshot of queue depth and achieved batch sizes for tuning"""
+        with self._lock:
+            waits = sorted(self._queue_waits)
+            sizes = dict(sorted(self._batch_sizes.items()))
+            total_batches = self._total_batches
+            total_rows = self._total_rows
+            failed = self._failed_batches
+
+        def percentile(p):
+            if not waits:
+                return None
+            index = min(len(waits) - 1, int(round(p / 100.0 * (len(waits) - 1))))
+            return round(waits[index] * 1000.0, 3)
+
+        return {
+            'queue_depth': self._queue.qsize() + (1 if self._carry is not None else 0),
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000.0,
+            'total_batches': total_batches,
+            'total_rows': total_rows,
+            'failed_batches': failed,
+            'mean_batch_size': round(total_rows / total_batches, 3) if total_batches else 0.0,
+            'batch_size_distribution': sizes,
+            'queue_wait_ms': {
+                'p50': percentile(50),
+                'p90': percentile(90),
+                'p99': percentile(99),
+            },
+        }
+
+    def close(self, timeout=5.0):
+        """Stop the worker after draining what is already queued"""
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            logger.warning("Micro-batcher queue full during shutdown; worker not signalled")
+            return
+        self._worker.join(timeout=timeout)
+
+    # ------------------------------------------------------------
+    # Worker
+    # ------------------------------------------------------------
+
+    def _next_item(self, timeout=None):
+        if self._carry is not None:
+            item, self._carry = self._carry, None
+            return item
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self, first):
+        batch = [first]
+        rows = len(first.rows)
+        deadline = time.monotonic() + self.max_wait
+        stop = False
+
+        while rows < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._next_item(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            if rows + len(item.rows) > self.max_batch_size or item.predict_fn != first.predict_fn:
+                # Does not fit (or needs another model version): it opens the next batch instead
+                self._carry = item
+                break
+            batch.append(item)
+            rows += len(item.rows)
+
+        return batch, rows, stop
+
+    def _run(self):
+        while True:
+            first = self._next_item()
+            if first is None:
+                break
+
+            batch, rows, stop = self._collect(first)
+            started = time.monotonic()
+            live = [item for item in batch if item.future.set_running_or_notify_cancel()]
+
+            if live:
+                try:
+                    inputs = live[0].rows if len(live) == 1 else np.concatenate(
+                        [item.rows for item in live], axis=0
+                    )
+                    outputs = np.asarray(first.predict_fn(inputs))
+                    offset = 0
+                    for item in live:
+                        count = len(item.rows)
+                        item.future.set_result(outputs[offset:offset + count])
+                        offset += count
+                except Exception as e:
+                    logger.error(f"Batched inference failed for {rows} rows: {str(e)}")
+                    with self._lock:
+                        self._failed_batches += 1
+                    for item in live:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+
+            with self._lock:
+                self._total_batches += 1
+                self._total_rows += rows
+                self._batch_sizes[rows] += 1
+                self._queue_waits.extend(started - item.enqueued_at for item in batch)
+
+            if METRICS_ENABLED:
+                BATCH_SIZE_ROWS.observe(rows)
+                observe_stage('inference', time.monotonic() - started)
+                for item in batch:
+                    observe_stage('batch_wait', started - item.enqueued_at)
+
+            if stop:
+                break
@@ -0,0 +1,111 @@
+"""
+History read latency against history size, keyset pages versus a full fetch.
+
+Seeds a scratch database with N predictions for one user (for each N in
+--sizes), creates the history index and times three reads: the first page,
+a page from the middle of the history (reached by following cursors), and
+the old behaviour of fetching and sorting the whole history. Page latency
+should stay flat as N grows; the full fetch grows linearly.
+
+With --backend mongo it needs a running MongoDB and uses a scratch database
+that is dropped afterwards; --backend memory runs offline against
+MemoryStorage.
+
+Usage:
+    python benchmarks/bench_history.py --uri mongodb://localhost:27017 --sizes 1000,10000,100000
+    python benchmarks/bench_history.py --backend memory
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from history import history_page  # noqa: E402
+from storage import MemoryStorage, MongoStorage  # noqa: E402
+
+LABELS = ['Actinic Keratoses', 'Basal Cell Carcinoma', 'Benign Keratosis', 'Dermatofibroma',
+          'Melanoma', 'Melanocytic Nevi', 'Vascular Lesions']
+
+
+def seed(storage, user_id, count, rng):
+    start = datetime.now(timezone.utc) - timedelta(days=365)
+    batch = []
+    for i in range(count):
+        probabilities = [rng.random() for _ in LABELS]
+        total = sum(probabilities)
+        batch.append({
+            'user_id': user_id,
+            'timestamp': start + timedelta(seconds=i * 30),
+            'predicted_class': i % len(LABELS),
+            'label': LABELS[i % len(LABELS)],
+            'confidence': round(rng.uniform(40, 99), 2),
+            'all_probabilities': [p / total for p in probabilities],
+            'image_name': f'lesion_{i}.jpg',
+        })
+        if len(batch) == 5000:
+            storage.insert_predictions(batch)
+            batch = []
+    if batch:
+        storage.insert_predictions(batch)
+
+
+def median_ms(fn, runs):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000.0)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=['mongo', 'memory'], default='mongo')
+    parser.add_argument('--uri', default=os.environ.get('MONGO_URI', 'mongodb://localhost:27017'))
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.backend == 'mongo':
+        storage = MongoStorage(args.uri, database=f'abdos_bench_{ObjectId()}')
+    else:
+        storage = MemoryStorage()
+    storage.ensure_indexes()
+    rng = random.Random(0)
+
+    print(f"{storage.name} storage, page size {args.page_size}, median of {args.runs} runs")
+    print(f"{'records':>9} {'first page ms':>14} {'middle page ms':>15} {'full fetch ms':>14}")
+    try:
+        for size in (int(v) for v in args.sizes.split(',')):
+            user_id = ObjectId()
+            seed(storage, user_id, size, rng)
+
+            # Walk cursors to the page in the middle of the history
+            cursor = None
+            for _ in range(size // args.page_size // 2):
+                _, cursor = history_page(storage, user_id, limit=args.page_size, cursor=cursor)
+
+            first = median_ms(lambda: history_page(storage, user_id, limit=args.page_size), args.runs)
+            middle = median_ms(
+                lambda: history_page(storage, user_id, limit=args.page_size, cursor=cursor), args.runs
+            )
+            # The old endpoint: the whole history in one go
+            full = median_ms(
+                lambda: storage.prediction_page(user_id, size + 1), max(1, args.runs // 5)
+            )
+            print(f"{size:>9} {first:>14.2f} {middle:>15.2f} {full:>14.1f}")
+    finally:
+        if args.backend == 'mongo':
+            storage.client.drop_database(storage.db.name)
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
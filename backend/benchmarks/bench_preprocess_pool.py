@@ -0,0 +1,69 @@
+"""
+Throughput of image preprocessing against the number of cores used.
+
+For each core count N it preprocesses the same set of synthetic JPEG uploads
+twice: with N request threads doing the work in-process (the waitress
+situation, limited by the GIL), and with N worker processes behind a
+PreprocessPool fed by 2N request threads. Prints images/sec and the scaling
+relative to one core.
+
+Usage:
+    python benchmarks/bench_preprocess_pool.py --images 400 --resolution 3024x2268
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from preprocessing import preprocess_image  # noqa: E402
+from preprocess_pool import PreprocessPool  # noqa: E402
+from bench_preprocessing import synthetic_photo  # noqa: E402
+
+
+def images_per_second(fn, uploads, threads):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(fn, uploads))
+    return len(uploads) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--resolution', default='1920x1440', help='WIDTHxHEIGHT of the synthetic uploads')
+    parser.add_argument('--max-cores', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.resolution.lower().split('x'))
+    distinct = [synthetic_photo(width, height, seed=seed) for seed in range(8)]
+    uploads = [distinct[i % len(distinct)] for i in range(args.images)]
+
+    core_counts = sorted({1, 2, 4, 8, 16, 32, args.max_cores} & set(range(1, args.max_cores + 1)))
+    in_thread = lambda data: preprocess_image(io.BytesIO(data))
+
+    print(f"{args.images} uploads at {width}x{height}")
+    print(f"{'cores':>5} {'threads img/s':>14} {'scaling':>8} {'pool img/s':>11} {'scaling':>8}")
+
+    thread_base = pool_base = None
+    for cores in core_counts:
+        thread_rate = images_per_second(in_thread, uploads, cores)
+
+        pool = PreprocessPool(cores)
+        try:
+            # Start the workers before timing
+            images_per_second(pool.preprocess, uploads[:cores * 2], cores * 2)
+            pool_rate = images_per_second(pool.preprocess, uploads, cores * 2)
+        finally:
+            pool.close()
+
+        thread_base = thread_base or thread_rate
+        pool_base = pool_base or pool_rate
+        print(f"{cores:>5} {thread_rate:>14.1f} {thread_rate / thread_base:>7.2f}x "
+              f"{pool_rate:>11.1f} {pool_rate / pool_base:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark and parity check for the reduced-size JPEG decode path.
+
+Compares preprocessing.preprocess_image() (draft-mode decode + resize) with
+the original full decode + resize, both with the --resample filter, on
+synthetic photos of several resolutions, and prints the per-image time of
+both paths.
+
+With --model, both preprocessed inputs are also run through the model and the
+largest difference in predicted probabilities is checked against --tolerance;
+the script exits non-zero if any resolution is outside it.
+
+Usage:
+    python benchmarks/bench_preprocessing.py
+    python benchmarks/bench_preprocessing.py --resample lanczos --normalization unit
+    python benchmarks/bench_preprocessing.py --model path/to/model.h5 --tolerance 0.02
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from preprocessing import RESAMPLING, preprocess_image, preprocess_image_reference  # noqa: E402
+
+RESOLUTIONS = [(640, 480), (1280, 960), (1920, 1440), (3024, 2268), (4032, 3024)]
+
+
+def synthetic_photo(width, height, seed=0):
+    """Smooth colour gradients with mild noise, saved as a quality-90 JPEG"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    r = 128 + 100 * np.sin(x / width * 6.0)
+    g = 128 + 100 * np.cos(y / height * 4.0)
+    b = 128 + 60 * np.sin((x + y) / (width + height) * 10.0)
+    pixels = np.stack([r, g, b], axis=-1) + rng.normal(0, 8, (height, width, 3))
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def time_per_image(fn, data, repeats):
+    fn(io.BytesIO(data))
+    started = time.perf_counter()
+    for _ in range(repeats):
+        fn(io.BytesIO(data))
+    return (time.perf_counter() - started) * 1000.0 / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--normalization', default='symmetric', choices=['symmetric', 'unit'])
+    parser.add_argument('--resample', default='bicubic', choices=sorted(RESAMPLING),
+                        help='final resize filter (backend: bicubic, model server: lanczos)')
+    parser.add_argument('--model', help='Keras/TFLite model to compare predictions with')
+    parser.add_argument('--tolerance', type=float, default=0.02,
+                        help='maximum allowed absolute difference in any class probability')
+    args = parser.parse_args()
+
+    engine = None
+    if args.model:
+        from inference import load_engine
+        backend = 'tflite' if args.model.endswith('.tflite') else 'keras'
+        engine = load_engine(args.model, backend=backend, tflite_path=args.model, compile=False)
+
+    options = dict(normalization=args.normalization, resample=args.resample)
+    fast = lambda source: preprocess_image(source, **options)
+    reference = lambda source: preprocess_image_reference(source, **options)
+
+    print(f"{'resolution':>12} {'reference ms':>13} {'fast ms':>9} {'speedup':>8} "
+          f"{'pixel MAE':>10}" + (f" {'max |dp|':>9}" if engine else ''))
+
+    failed = False
+    for index, (width, height) in enumerate(RESOLUTIONS):
+        data = synthetic_photo(width, height, seed=index)
+        ref_ms = time_per_image(reference, data, args.repeats)
+        fast_ms = time_per_image(fast, data, args.repeats)
+
+        ref_array = reference(io.BytesIO(data))
+        fast_array = fast(io.BytesIO(data))
+        pixel_mae = float(np.mean(np.abs(ref_array - fast_array)))
+
+        line = (f"{f'{width}x{height}':>12} {ref_ms:>13.2f} {fast_ms:>9.2f} "
+                f"{ref_ms / fast_ms:>7.1f}x {pixel_mae:>10.4f}")
+
+        if engine is not None:
+            probs = engine.predict(np.stack([ref_array, fast_array]))
+            max_diff = float(np.max(np.abs(probs[0] - probs[1])))
+            same_class = int(np.argmax(probs[0])) == int(np.argmax(probs[1]))
+            ok = max_diff <= args.tolerance and same_class
+            failed = failed or not ok
+            line += f" {max_diff:>9.4f}" + ('' if ok else '  PARITY FAILED')
+        print(line)
+
+    if engine is not None:
+        print('Parity check ' + ('FAILED' if failed else f'passed (tolerance {args.tolerance})'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+"""
+Content-addressed store for uploaded images.
+
+Uploads are kept so that past predictions can be re-run through a new model
+version. Blobs are keyed by the SHA-256 of their bytes, so an image uploaded
+a thousand times is stored once; each prediction that refers to it holds a
+reference, counted in storage (image_blobs). A thumbnail is generated once,
+when the blob is first written.
+
+Bytes go to one of two backends, both written and read in chunks:
+
+- FileBlobStore: files under a directory, fanned out by the first two hex
+  digits of the digest, written to a temporary file and renamed into place
+- GridFSBlobStore: GridFS buckets in the MongoDB database
+
+IMAGE_STORE=filesystem|gridfs picks one in blob_store_from_env(); unset,
+uploads are not kept.
+"""
+import io
+import logging
+import os
+import re
+import threading
+import uuid
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 255 * 1024
+THUMBNAIL_SIZE = 128
+
+_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+
+def make_thumbnail(stream, size=THUMBNAIL_SIZE):
+    """JPEG bytes of an image scaled to fit size x size, decoded at reduced scale"""
+    stream.seek(0)
+    with Image.open(stream) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', (size, size))
+        thumb = img.convert('RGB')
+    thumb.thumbnail((size, size))
+    out = io.BytesIO()
+    thumb.save(out, 'JPEG', quality=85)
+    return out.getvalue()
+
+
+def _stream_size(stream):
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+class BlobStore:
+    """
+    Reference-counted, content-addressed image store
+
+    Subclasses store the bytes; reference counts live in storage so every
+    worker process sees the same ones.
+
+    Args:
+    - storage: a Storage backend (see storage.py)
+    - chunk_size: bytes per write and per read
+    - thumbnail_size: longest side of the thumbnail
+    """
+
+    name = None
+
+    def __init__(self, storage, chunk_size=CHUNK_SIZE, thumbnail_size=THUMBNAIL_SIZE):
+        self.storage = storage
+        self.chunk_size = int(chunk_size)
+        self.thumbnail_size = int(thumbnail_size)
+        self._lock = threading.Lock()
+        self._counts = {'stored': 0, 'deduplicated': 0, 'released': 0, 'deleted': 0, 'bytes_written': 0}
+
+    # Backend hooks
+    def _exists(self, digest):
+        raise NotImplementedError
+
+    def _write(self, digest, chunks):
+        raise NotImplementedError
+
+    def _write_thumbnail(self, digest, data):
+        raise NotImplementedError
+
+    def _open(self, digest):
+        raise NotImplementedError
+
+    def _read_thumbnail(self, digest):
+        raise NotImplementedError
+
+    def _delete(self, digest):
+        raise NotImplementedError
+
+    def _chunks(self, stream):
+        stream.seek(0)
+        return iter(lambda: stream.read(self.chunk_size), b'')
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._counts[key] += n
+
+    def put(self, digest, stream, content_type=None):
+        """
+        Add a reference to the blob with this digest, storing stream if it is new
+
+        stream is a seekable file object holding exactly the bytes digest was
+        computed from; it is read in chunks and rewound afterwards. Returns
+        True if the bytes were written, False if they were already stored.
+        """
+        if not _DIGEST.match(digest):
+            raise ValueError(f"Not a SHA-256 hex digest: {digest!r}")
+
+        # Count the reference first, so a sweep never deletes bytes that are
+        # about to be referenced
+        self.storage.acquire_blob(digest, size=_stream_size(stream), content_type=content_type)
+        if self._exists(digest):
+            self._count('deduplicated')
+            return False
+
+        try:
+            written = self._write(digest, self._chunks(stream))
+            self._count('bytes_written', written)
+            try:
+                self._write_thumbnail(digest, make_thumbnail(stream, self.thumbnail_size))
+            except Exception as e:
+                logger.warning(f"Could not make a thumbnail for {digest}: {str(e)}")
+        except Exception:
+            self.storage.release_blob(digest)
+            raise
+        finally:
+            stream.seek(0)
+        self._count('stored')
+        return True
+
+    def release(self, digest):
+        """Drop one reference; unreferenced blobs are deleted by sweep()"""
+        remaining = self.storage.release_blob(digest)
+        self._count('released')
+        return remaining
+
+    def open(self, digest):
+        """Readable file object over the stored bytes (read() it in chunks)"""
+        return self._open(digest)
+
+    def iter_chunks(self, digest):
+        """The stored bytes, chunk_size at a time"""
+        with closing(self._open(digest)) as stream:
+            yield from iter(lambda: stream.read(self.chunk_size), b'')
+
+    def thumbnail(self, digest):
+        """JPEG thumbnail bytes, or None if there is none"""
+        return self._read_thumbnail(digest)
+
+    def sweep(self, grace_seconds=3600):
+        """
+        Delete blobs that have had no references for grace_seconds
+
+        The grace period leaves room for an upload of the same image that is
+        racing with the last release. Returns the number of blobs deleted.
+        """
+        released_before = datetime.now(timezone.utc) - timedelta(seconds=grace_seconds)
+        deleted = 0
+        for digest in self.storage.unreferenced_blobs(released_before):
+            if self.storage.forget_blob(digest, released_before):
+                self._delete(digest)
+                deleted += 1
+        self._count('deleted', deleted)
+        return deleted
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, backend=self.name)
+
+
+class FileBlobStore(BlobStore):
+    """Blobs as files under root/objects, thumbnails under root/thumbnails"""
+
+    name = 'filesystem'
+
+    def __init__(self, storage, root, **kwargs):
+        super().__init__(storage, **kwargs)
+        self.root = root
+
+    def _path(self, kind, digest):
+        return os.path.join(self.root, kind, digest[:2], digest)
+
+    def _write_file(self, path, chunks):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Concurrent writers of the same digest each use their own temporary
+        # file; whichever rename lands last leaves identical bytes
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        written = 0
+        try:
+            with open(temporary, 'wb') as out:
+                for chunk in chunks:
+                    out.write(chunk)
+                    written += len(chunk)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return written
+
+    def _exists(self, digest):
+        return os.path.exists(self._path('objects', digest))
+
+    def _write(self, digest, chunks):
+        return self._write_file(self._path('objects', digest), chunks)
+
+    def _write_thumbnail(self, digest, data):
+        self._write_file(self._path('thumbnails', digest), [data])
+
+    def _open(self, digest):
+        return open(self._path('objects', digest), 'rb', buffering=self.chunk_size)
+
+    def _read_thumbnail(self, digest):
+        try:
+            with open(self._path('thumbnails', digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _delete(self, digest):
+        for kind in ('objects', 'thumbnails'):
+            try:
+                os.remove(self._path(kind, digest))
+            except FileNotFoundError:
+                pass
+
+
+class GridFSBlobStore(BlobStore):
+    """
+    Blobs in the 'images' GridFS bucket, thumbnails in 'thumbnails'
+
+    Files are named by digest. Concurrent first uploads of one image may
+    leave two identical files under that name; reads take the newest and
+    deletes remove all of them.
+    """
+
+    name = 'gridfs'
+
+    def __init__(self, storage, **kwargs):
+        import gridfs
+
+        super().__init__(storage, **kwargs)
+        if getattr(storage, 'db', None) is None:
+            raise ValueError('GridFS needs the mongo storage backend')
+        self._images = gridfs.GridFSBucket(storage.db, bucket_name='images', chunk_size_bytes=self.chunk_size)
+        self._thumbnails = gridfs.GridFSBucket(storage.db, bucket_name='thumbnails')
+        self._files = storage.db['images.files']
+
+    def _exists(self, digest):
+        return self._files.find_one({'filename': digest}, {'_id': 1}) is not None
+
+    def _write(self, digest, chunks):
+        written = 0
+        with self._images.open_upload_stream(digest) as upload:
+            for chunk in chunks:
+                upload.write(chunk)
+                written += len(chunk)
+        return written
+
+    def _write_thumbnail(self, digest, data):
+        self._thumbnails.upload_from_stream(digest, data)
+
+    def _open(self, digest):
+        return self._images.open_download_stream_by_name(digest)
+
+    def _read_thumbnail(self, digest):
+        from gridfs.errors import NoFile
+
+        try:
+            with closing(self._thumbnails.open_download_stream_by_name(digest)) as stream:
+                return stream.read()
+        except NoFile:
+            return None
+
+    def _delete(self, digest):
+        for bucket in (self._images, self._thumbnails):
+            for grid_file in bucket.find({'filename': digest}):
+                bucket.delete(grid_file._id)
+
+
+def blob_store_from_env(storage):
+    """The image store configured by IMAGE_STORE / IMAGE_STORE_*, or None"""
+    backend = os.environ.get('IMAGE_STORE', '').lower()
+    if not backend or backend == 'none':
+        return None
+    kwargs = dict(
+        chunk_size=int(os.environ.get('IMAGE_STORE_CHUNK_KB', CHUNK_SIZE // 1024)) * 1024,
+        thumbnail_size=int(os.environ.get('THUMBNAIL_SIZE', THUMBNAIL_SIZE)),
+    )
+    if backend == 'filesystem':
+        return FileBlobStore(storage, os.environ.get('IMAGE_STORE_DIR', 'image_store'), **kwargs)
+    if backend == 'gridfs':
+        return GridFSBlobStore(storage, **kwargs)
+    raise ValueError(f"Unknown IMAGE_STORE: {backend}")
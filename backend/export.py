@@ -0,0 +1,122 @@
+"""
+Streaming export of prediction history as NDJSON or CSV.
+
+Records are read from a storage cursor one batch at a time, encoded and
+(optionally) gzip-compressed as they go, and handed out as ~64 KB chunks.
+Memory use is the same for ten records as for ten million: nothing ever
+holds the whole result, unlike a JSON list built for one response.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import datetime, timezone
+
+from history import ALLOWED_FIELDS, _to_json
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+# Exported when the caller does not pick fields; every row also has its id
+EXPORT_FIELDS = ('timestamp', 'user_id', 'predicted_class', 'label', 'confidence', 'image_name',
+                 'image_sha256')
+
+CHUNK_BYTES = 64 * 1024
+
+
+class InvalidExport(ValueError):
+    """An export parameter that cannot be used"""
+
+
+def parse_date(value, name='date'):
+    """ISO date or datetime (naive values are UTC), or None when empty"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise InvalidExport(f"{name} must be an ISO date or datetime, e.g. 2026-01-31")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def parse_export_fields(value):
+    if not value:
+        return EXPORT_FIELDS
+    fields = tuple(field.strip() for field in value.split(',') if field.strip())
+    unknown = sorted(set(fields) - set(ALLOWED_FIELDS))
+    if unknown:
+        raise InvalidExport(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def ndjson_lines(records, columns):
+    for record in records:
+        row = _to_json(record)
+        yield json.dumps({column: row.get(column) for column in columns}) + '\n'
+
+
+def _csv_value(value):
+    # Lists (all_probabilities) go into one cell as JSON
+    return json.dumps(value) if isinstance(value, (list, dict)) else value
+
+
+def csv_lines(records, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for record in records:
+        row = _to_json(record)
+        writer.writerow([_csv_value(row.get(column)) for column in columns])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _buffered(pieces, size=CHUNK_BYTES):
+    """Join small encoded lines into chunks of about size bytes"""
+    parts, length = [], 0
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        parts.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(parts)
+            parts, length = [], 0
+    if parts:
+        yield b''.join(parts)
+
+
+def gzip_chunks(chunks, level=6):
+    """gzip-compress a stream of byte chunks incrementally"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_history(storage, user_id=None, fmt='ndjson', fields=EXPORT_FIELDS, since=None,
+                   until=None, compress=False, batch_size=1000):
+    """
+    Byte chunks of an export of one user's history (or everyone's)
+
+    One user's records are oldest first. since / until limit the timestamps
+    to [since, until). Parameters are checked here, before the first chunk
+    is produced; the records are only read while the result is consumed.
+    """
+    if fmt not in FORMATS:
+        raise InvalidExport(f"format must be one of {', '.join(FORMATS)}")
+    if since is not None and until is not None and since >= until:
+        raise InvalidExport('since must be before until')
+
+    columns = ('id',) + tuple(field for field in fields if field != 'id')
+    records = storage.iter_predictions(
+        user_id=user_id, fields=fields, batch_size=batch_size, since=since, until=until
+    )
+    encode = ndjson_lines if fmt == 'ndjson' else csv_lines
+    chunks = _buffered(encode(records, columns))
+    return gzip_chunks(chunks) if compress else chunks
@@ -0,0 +1,66 @@
+"""
+Export prediction history as NDJSON or CSV, optionally gzip-compressed.
+
+Streams from the database cursor straight to the output file, so memory use
+stays flat however many predictions are exported. Without --user the
+history of every user is exported. Uses the same STORAGE_BACKEND / MONGO_*
+settings as model_api.py.
+
+Usage:
+    python export_history.py --format csv --gzip --output history.csv.gz
+    python export_history.py --user 6650c0ffee0123456789abcd --since 2026-01-01 --until 2026-04-01
+"""
+import argparse
+import sys
+
+from bson.objectid import ObjectId
+
+from export import EXPORT_FIELDS, FORMATS, InvalidExport, export_history, parse_date, parse_export_fields
+from storage import storage_from_env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user', default=None, help='only export this user id')
+    parser.add_argument('--format', choices=list(FORMATS), default='ndjson')
+    parser.add_argument('--since', default=None, help='first timestamp included (ISO date or datetime, UTC)')
+    parser.add_argument('--until', default=None, help='first timestamp excluded (ISO date or datetime, UTC)')
+    parser.add_argument('--fields', default=','.join(EXPORT_FIELDS), help='comma-separated fields to export')
+    parser.add_argument('--gzip', action='store_true', help='gzip-compress the output')
+    parser.add_argument('--batch-size', type=int, default=1000, help='predictions fetched per round trip')
+    parser.add_argument('--output', default='-', help='file to write (default: stdout)')
+    args = parser.parse_args()
+
+    try:
+        fields = parse_export_fields(args.fields)
+        since = parse_date(args.since, '--since')
+        until = parse_date(args.until, '--until')
+    except InvalidExport as e:
+        parser.error(str(e))
+
+    bytes_written = 0
+    storage = storage_from_env()
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        chunks = export_history(
+            storage,
+            user_id=ObjectId(args.user) if args.user else None,
+            fmt=args.format,
+            fields=fields,
+            since=since,
+            until=until,
+            compress=args.gzip,
+            batch_size=args.batch_size
+        )
+        for chunk in chunks:
+            output.write(chunk)
+            bytes_written += len(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+        storage.close()
+    print(f"Wrote {bytes_written} bytes", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Keyset-paginated reads of prediction history.
+
+Pages are ordered newest first on (timestamp, _id) and continue from an
+opaque cursor holding the last row's key, so every page is one bounded
+index range scan no matter how deep into a user's history it is - unlike
+skip/limit, or loading the whole history and slicing it in Python.
+"""
+import base64
+import binascii
+from datetime import datetime, timezone
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Fields returned when the client does not ask for specific ones;
+# all_probabilities is the bulk of each document and is opt-in
+DEFAULT_FIELDS = ('timestamp', 'predicted_class', 'label', 'confidence', 'image_name')
+ALLOWED_FIELDS = DEFAULT_FIELDS + ('all_probabilities', 'user_id', 'image_sha256')
+
+
+class InvalidCursor(ValueError):
+    """A cursor or page parameter that cannot be used"""
+
+
+def encode_cursor(timestamp, object_id):
+    """Opaque URL-safe token for the position after (timestamp, _id)"""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    raw = f"{timestamp.isoformat()}|{object_id}".encode('ascii')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('ascii')
+        timestamp, object_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), ObjectId(object_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError, InvalidId):
+        raise InvalidCursor('Invalid cursor')
+
+
+def parse_page_size(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    if value in (None, ''):
+        return default
+    try:
+        size = int(value)
+    except ValueError:
+        raise InvalidCursor('limit must be an integer')
+    if size < 1:
+        raise InvalidCursor('limit must be at least 1')
+    return min(size, maximum)
+
+
+def parse_fields(value):
+    if not value:
+        return DEFAULT_FIELDS
+    fields = tuple(field.strip() for field in value.split(',') if field.strip())
+    unknown = sorted(set(fields) - set(ALLOWED_FIELDS))
+    if unknown:
+        raise InvalidCursor(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def _to_json(doc):
+    doc['id'] = str(doc.pop('_id'))
+    if isinstance(doc.get('user_id'), ObjectId):
+        doc['user_id'] = str(doc['user_id'])
+    if isinstance(doc.get('timestamp'), datetime):
+        doc['timestamp'] = doc['timestamp'].isoformat()
+    return doc
+
+
+def history_page(storage, user_id, limit=DEFAULT_PAGE_SIZE, cursor=None, fields=DEFAULT_FIELDS):
+    """
+    One page of a user's predictions, newest first
+
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    # timestamp is always fetched: the cursor is built from it
+    docs = storage.prediction_page(user_id, limit + 1, after=after, fields=set(fields) | {'timestamp'})
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(docs[-1]['timestamp'], docs[-1]['_id'])
+    if 'timestamp' not in fields:
+        for doc in docs:
+            del doc['timestamp']
+    return [_to_json(doc) for doc in docs], next_cursor
@@ -0,0 +1,254 @@
+"""
+Prediction history stored with the bucket pattern.
+
+Instead of one ever-growing array inside the user document, a user's
+predictions live in a separate collection as bucket documents of at most
+BUCKET_SIZE entries:
+
+    {user_id, first_ts, last_ts, count, closed, predictions: [...]}
+
+Appends go to the user's newest open bucket (it is closed once full and a
+new one is upserted), reads walk buckets newest first and stop once they have enough
+rows, and user documents stay small so login/profile lookups never touch
+history.
+
+migrate_embedded_history() moves existing users.predictions arrays into
+buckets while the servers keep running; see model/migrate_history.py.
+"""
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+import pymongo
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+BUCKET_SIZE = int(os.environ.get('HISTORY_BUCKET_SIZE', 200))
+
+# Never load embedded history with a user document
+USER_PROJECTION = {'predictions': 0}
+
+BUCKET_INDEX = [('user_id', pymongo.ASCENDING), ('first_ts', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+_BUCKET_ORDER = [('first_ts', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+
+# Buckets written by an unfinished migration are invisible to readers
+_VISIBLE = {'pending_migration': {'$exists': False}}
+
+
+# At most one open bucket per user: of two appends that both find none and
+# upsert one, the second fails on this index and retries into the first's
+_OPEN_BUCKET_INDEX = {'keys': [('user_id', pymongo.ASCENDING)], 'unique': True,
+                      'partialFilterExpression': {'closed': False}, 'name': 'one_open_bucket_per_user'}
+
+_DUPLICATE_KEY = 11000
+
+
+def ensure_bucket_indexes(buckets):
+    buckets.create_index(BUCKET_INDEX, name='user_first_ts_id')
+    buckets.create_index('pending_migration', sparse=True, name='pending_migration')
+    try:
+        buckets.create_index(**_OPEN_BUCKET_INDEX)
+    except OperationFailure as e:
+        if e.code != _DUPLICATE_KEY:
+            raise
+        closed = _close_extra_open_buckets(buckets)
+        logger.warning(f"Closed {closed} extra open history buckets before adding the one-open-bucket index")
+        buckets.create_index(**_OPEN_BUCKET_INDEX)
+
+
+def _close_extra_open_buckets(buckets):
+    """Close all but the newest open bucket of each user; returns how many were closed"""
+    extra = buckets.aggregate([
+        {'$match': {'closed': False}},
+        {'$sort': {'first_ts': -1, '_id': -1}},
+        {'$group': {'_id': '$user_id', 'ids': {'$push': '$_id'}}},
+        {'$match': {'ids.1': {'$exists': True}}},
+    ])
+    closed = 0
+    for group in extra:
+        closed += buckets.update_many({'_id': {'$in': group['ids'][1:]}}, {'$set': {'closed': True}}).modified_count
+    return closed
+
+
+def _timestamp(prediction, default):
+    value = prediction.get('timestamp') if isinstance(prediction, dict) else None
+    return value if isinstance(value, datetime) else default
+
+
+# ------------------------------------------------------------
+# Writes and reads
+# ------------------------------------------------------------
+
+def append_predictions(buckets, user_id, predictions, bucket_size=BUCKET_SIZE, max_attempts=3):
+    """
+    Append predictions (oldest first) to the user's newest open bucket(s)
+
+    A bucket is closed once it is full, or when it cannot take the whole of
+    the next chunk, so appends only ever go to the newest bucket and
+    buckets stay in timestamp order. An upsert that loses a race with
+    another writer's on the one-open-bucket index is retried, and then
+    appends to the bucket the other writer created.
+    """
+    now = datetime.now(timezone.utc)
+    predictions = list(predictions)
+    for start in range(0, len(predictions), bucket_size):
+        chunk = predictions[start:start + bucket_size]
+        for attempt in range(max_attempts):
+            buckets.update_many(
+                {'user_id': user_id, 'closed': False, 'count': {'$gt': bucket_size - len(chunk)}, **_VISIBLE},
+                {'$set': {'closed': True}}
+            )
+            try:
+                bucket = buckets.find_one_and_update(
+                    # Any open bucket left has room for the chunk; otherwise a new one is upserted
+                    {'user_id': user_id, 'closed': False, **_VISIBLE},
+                    {
+                        '$push': {'predictions': {'$each': chunk}},
+                        '$inc': {'count': len(chunk)},
+                        '$max': {'last_ts': _timestamp(chunk[-1], now)},
+                        '$setOnInsert': {'first_ts': _timestamp(chunk[0], now)},
+                    },
+                    sort=_BUCKET_ORDER,
+                    projection={'count': 1},
+                    upsert=True,
+                    return_document=pymongo.ReturnDocument.AFTER,
+                )
+                break
+            except DuplicateKeyError:
+                if attempt == max_attempts - 1:
+                    raise
+        if bucket['count'] >= bucket_size:
+            buckets.update_one({'_id': bucket['_id']}, {'$set': {'closed': True}})
+
+
+def recent_predictions(buckets, user_id, limit=None):
+    """A user's predictions newest first, reading only as many buckets as needed"""
+    rows = []
+    for bucket in buckets.find({'user_id': user_id, **_VISIBLE}, {'predictions': 1}).sort(_BUCKET_ORDER):
+        rows.extend(reversed(bucket['predictions']))
+        if limit is not None and len(rows) >= limit:
+            return rows[:limit]
+    return rows
+
+
+def count_predictions(buckets, user_id):
+    """Total predictions of a user from the bucket counters alone"""
+    result = list(buckets.aggregate([
+        {'$match': {'user_id': user_id, **_VISIBLE}},
+        {'$group': {'_id': None, 'total': {'$sum': '$count'}}},
+    ]))
+    return result[0]['total'] if result else 0
+
+
+def legacy_predictions(users, user_id):
+    """Predictions still embedded in a not-yet-migrated user document (oldest first)"""
+    user = users.find_one({'_id': user_id, 'predictions.0': {'$exists': True}}, {'predictions': 1})
+    return user['predictions'] if user else []
+
+
+# ------------------------------------------------------------
+# Online migration of embedded arrays
+# ------------------------------------------------------------
+
+def _bucket_docs(user_id, predictions, default_ts, bucket_size, token):
+    docs = []
+    for start in range(0, len(predictions), bucket_size):
+        chunk = predictions[start:start + bucket_size]
+        docs.append({
+            'user_id': user_id,
+            'first_ts': _timestamp(chunk[0], default_ts),
+            'last_ts': _timestamp(chunk[-1], default_ts),
+            'count': len(chunk),
+            # Migrated history is older than anything appended since; never reopen it
+            'closed': True,
+            'predictions': chunk,
+            'pending_migration': token,
+        })
+    return docs
+
+
+def _finish_pending(users, buckets):
+    """Resolve buckets left behind by an interrupted migration run"""
+    for token in buckets.distinct('pending_migration'):
+        bucket = buckets.find_one({'pending_migration': token}, {'user_id': 1})
+        if bucket is None:
+            continue
+        if users.find_one({'_id': bucket['user_id'], 'predictions.0': {'$exists': True}}, {'_id': 1}):
+            # The user still has the array: the move never committed, start over
+            buckets.delete_many({'pending_migration': token})
+        else:
+            buckets.update_many({'pending_migration': token}, {'$unset': {'pending_migration': ''}})
+
+
+def migrate_user(users, buckets, user_id, bucket_size=BUCKET_SIZE, max_attempts=5):
+    """
+    Move one user's embedded predictions into buckets
+
+    The buckets are written hidden, then the array is removed from the user
+    document only if it still has the length that was copied; if a writer
+    appended meanwhile the copy is discarded and retried. Returns the number
+    of predictions moved.
+    """
+    for _ in range(max_attempts):
+        user = users.find_one({'_id': user_id}, {'predictions': 1, 'created_at': 1})
+        predictions = (user or {}).get('predictions') or []
+        if not predictions:
+            return 0
+
+        token = ObjectId()
+        default_ts = user.get('created_at') or datetime.now(timezone.utc)
+        buckets.insert_many(_bucket_docs(user_id, predictions, default_ts, bucket_size, token), ordered=True)
+
+        result = users.update_one(
+            {'_id': user_id, 'predictions': {'$size': len(predictions)}},
+            {'$unset': {'predictions': ''}, '$set': {'history_migrated_at': datetime.now(timezone.utc)}}
+        )
+        if result.modified_count:
+            buckets.update_many({'pending_migration': token}, {'$unset': {'pending_migration': ''}})
+            return len(predictions)
+        buckets.delete_many({'pending_migration': token})
+
+    raise RuntimeError(f"History of user {user_id} kept changing during migration")
+
+
+def migrate_embedded_history(users, buckets, batch_size=100, pause_s=0.0, bucket_size=BUCKET_SIZE,
+                             limit=None, dry_run=False):
+    """
+    Move every users.predictions array into buckets, batch_size users at a time
+
+    Safe to run while the servers are up and to re-run after an interruption.
+    pause_s between batches throttles the load on the database. Returns
+    (users migrated, predictions moved).
+    """
+    ensure_bucket_indexes(buckets)
+    _finish_pending(users, buckets)
+
+    query = {'predictions.0': {'$exists': True}}
+    if dry_run:
+        pipeline = [{'$match': query}, {'$group': {'_id': None, 'users': {'$sum': 1},
+                                                   'predictions': {'$sum': {'$size': '$predictions'}}}}]
+        totals = next(iter(users.aggregate(pipeline)), {'users': 0, 'predictions': 0})
+        return totals['users'], totals['predictions']
+
+    migrated_users = moved = 0
+    last_id = None
+    while limit is None or migrated_users < limit:
+        page_query = dict(query, **({'_id': {'$gt': last_id}} if last_id is not None else {}))
+        batch = [doc['_id'] for doc in users.find(page_query, {'_id': 1}).sort('_id', 1).limit(batch_size)]
+        if not batch:
+            break
+        for user_id in batch:
+            if limit is not None and migrated_users >= limit:
+                break
+            count = migrate_user(users, buckets, user_id, bucket_size=bucket_size)
+            if count:
+                migrated_users += 1
+                moved += count
+        last_id = batch[-1]
+        logger.info(f"Migrated {migrated_users} users, {moved} predictions so far")
+        if pause_s:
+            time.sleep(pause_s)
+    return migrated_users, moved
@@ -0,0 +1,112 @@
+"""
+In-process cache of JWT identity -> user summary.
+
+Authenticated routes resolve the identity in the token to a user on every
+call. The summary they need (id, name, email) changes rarely, so it is kept
+in a bounded LRU with a TTL. Writers call invalidate() after changing a user;
+the TTL bounds staleness for changes made by other processes. Password
+hashes are never cached.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CallbackCounter, Gauge
+
+
+def user_summary(user):
+    """The cached view of a user document: id, name and email"""
+    if not user:
+        return None
+    return {'id': str(user['_id']), 'name': user.get('name'), 'email': user.get('email')}
+
+
+class IdentityCache:
+    """
+    Thread-safe LRU + TTL cache in front of a user lookup
+
+    Args:
+    - loader: callable(identity) returning the summary dict, or None if unknown
+    - max_entries: identities kept (0 disables the cache)
+    - ttl_seconds: how long a summary is trusted
+    """
+
+    def __init__(self, loader, max_entries=4096, ttl_seconds=60):
+        self.loader = loader
+        self.max_entries = int(max_entries)
+        self.ttl = float(ttl_seconds)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._counts = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, identity):
+        """Summary for identity (a copy), loading it on a miss; None if there is no such user"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(identity)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._entries.move_to_end(identity)
+                self._counts['hits'] += 1
+                return dict(entry[1])
+            self._counts['misses'] += 1
+            generation = self._generation
+
+        summary = self.loader(identity)
+        if summary is None or self.max_entries <= 0:
+            return summary
+
+        with self._lock:
+            # Skip the fill if an invalidation raced with the load
+            if generation == self._generation:
+                self._entries[identity] = (now, summary)
+                self._entries.move_to_end(identity)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._counts['evictions'] += 1
+        return dict(summary)
+
+    def invalidate(self, identity):
+        """Forget one identity, e.g. after its user document was updated"""
+        with self._lock:
+            self._generation += 1
+            self._counts['invalidations'] += 1
+            self._entries.pop(identity, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def __len__(self):
+        """Entries currently held in memory"""
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+            size = len(self._entries)
+        lookups = counts['hits'] + counts['misses']
+        return dict(
+            counts,
+            entries=size,
+            max_entries=self.max_entries,
+            ttl_seconds=self.ttl,
+            hit_ratio=round(counts['hits'] / lookups, 4) if lookups else 0.0,
+        )
+
+
+def register_identity_cache_metrics(cache):
+    """Expose an identity cache's hit/miss counters and size on /metrics"""
+    def lookups():
+        stats = cache.stats()
+        return {('hit',): stats['hits'], ('miss',): stats['misses']}
+
+    CallbackCounter(
+        'abdos_identity_cache_lookups_total', 'Identity cache lookups by result',
+        lookups, ['result']
+    )
+    Gauge('abdos_identity_cache_entries', 'Identities in the identity cache').set_function(
+        lambda: len(cache)
+    )
@@ -0,0 +1,323 @@
+"""
+Inference engines shared by the Flask servers.
+
+An engine wraps one loaded model behind predict(batch) -> probabilities so the
+API code does not care whether it runs the Keras model or a TFLite export.
+The backend is picked with MODEL_BACKEND ('keras' or 'tflite').
+"""
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+logger = logging.getLogger(__name__)
+
+try:
+    # The slim runtime is enough for serving if it is installed
+    from tflite_runtime.interpreter import Interpreter as TFLiteInterpreter
+except ImportError:
+    TFLiteInterpreter = tf.lite.Interpreter
+
+
+def parse_batch_sizes(value):
+    """Parse a SERVING_BATCH_SIZES style list such as '1,2,4,8,16'"""
+    sizes = sorted({int(part) for part in str(value).split(',') if part.strip()})
+    if not sizes or sizes[0] < 1:
+        raise ValueError(f"Invalid serving batch sizes: {value!r}")
+    return tuple(sizes)
+
+
+DEFAULT_BATCH_SIZES = parse_batch_sizes(os.environ.get('SERVING_BATCH_SIZES', '1,2,4,8,16'))
+
+
+def file_version(path):
+    """Version tag for a model file: file name plus modification time"""
+    try:
+        mtime = int(os.path.getmtime(path))
+    except OSError:
+        mtime = 0
+    return f"{os.path.basename(path)}@{mtime}"
+
+
+def load_keras_model(path, **load_kwargs):
+    """
+    Load an .h5 / .keras file or a SavedModel directory as a Keras model
+
+    Keras 3 (TF 2.16+) no longer reads SavedModel directories with
+    load_model(), so those are wrapped in a TFSMLayer on their
+    serving_default signature.
+    """
+    if not os.path.isdir(path) or not hasattr(tf.keras.layers, 'TFSMLayer'):
+        return tf.keras.models.load_model(path, **load_kwargs)
+
+    signature = tf.saved_model.load(path).signatures['serving_default']
+    (input_spec,) = signature.structured_input_signature[1].values()
+    output_key = next(iter(signature.structured_outputs))
+    inputs = tf.keras.Input(shape=input_spec.shape[1:], dtype=input_spec.dtype)
+    outputs = tf.keras.layers.TFSMLayer(path, call_endpoint='serving_default')(inputs)[output_key]
+    return tf.keras.Model(inputs, outputs)
+
+
+def _time_per_call(fn, runs):
+    started = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - started) * 1000.0 / runs
+
+
+class KerasEngine:
+    """
+    Full-precision Keras model served through pre-traced concrete functions
+
+    model.predict() builds a data adapter and runs the predict loop on every
+    call. Instead the model is wrapped in a tf.function and traced once per
+    batch size in batch_sizes; incoming batches are zero-padded up to the
+    nearest traced size (or split into chunks of the largest one).
+    """
+
+    name = 'keras'
+
+    def __init__(self, model, source=None, batch_sizes=DEFAULT_BATCH_SIZES, version=None):
+        self.model = model
+        self.source = source
+        self.version = version or (file_version(source) if source else 'unversioned')
+        self.batch_sizes = tuple(sorted(batch_sizes))
+        self.input_shape = tuple(model.input_shape[1:])
+        self.ready = False
+        self.warmup_stats = None
+        self._serve = tf.function(lambda images: self.model(images, training=False))
+        self._concrete = {}
+
+    @classmethod
+    def from_path(cls, model_path, batch_sizes=DEFAULT_BATCH_SIZES, version=None, **load_kwargs):
+        model = load_keras_model(model_path, **load_kwargs)
+        return cls(model, source=model_path, batch_sizes=batch_sizes, version=version)
+
+    def _bucket(self, count):
+        for size in self.batch_sizes:
+            if size >= count:
+                return size
+        return self.batch_sizes[-1]
+
+    def _run(self, batch):
+        count = len(batch)
+        size = self._bucket(count)
+        if size != count:
+            padding = np.zeros((size - count,) + batch.shape[1:], dtype=np.float32)
+            batch = np.concatenate([batch, padding], axis=0)
+        fn = self._concrete.get(size, self._serve)
+        return fn(tf.constant(batch)).numpy()[:count]
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        largest = self.batch_sizes[-1]
+        if len(batch) <= largest:
+            return self._run(batch)
+        return np.concatenate(
+            [self._run(batch[start:start + largest]) for start in range(0, len(batch), largest)],
+            axis=0
+        )
+
+    def warm_up(self, runs=3):
+        """
+        Trace every serving batch size and run a few passes before traffic
+
+        Returns timing stats: cold start (tracing + first runs) and the
+        per-call overhead of model.predict compared with the traced function
+        for a single image.
+        """
+        started = time.perf_counter()
+        for size in self.batch_sizes:
+            spec = tf.TensorSpec((size,) + self.input_shape, tf.float32)
+            self._concrete[size] = self._serve.get_concrete_function(spec)
+            sample = tf.zeros((size,) + self.input_shape, tf.float32)
+            for _ in range(runs):
+                self._concrete[size](sample)
+        cold_start = time.perf_counter() - started
+
+        single = np.zeros((1,) + self.input_shape, dtype=np.float32)
+        self.model.predict(single, verbose=0)
+        predict_ms = _time_per_call(lambda: self.model.predict(single, verbose=0), runs)
+        traced_ms = _time_per_call(lambda: self._run(single), runs)
+
+        self.warmup_stats = {
+            'cold_start_s': round(cold_start, 3),
+            'batch_sizes': list(self.batch_sizes),
+            'model_predict_ms': round(predict_ms, 3),
+            'traced_call_ms': round(traced_ms, 3),
+            'overhead_saved_ms': round(predict_ms - traced_ms, 3),
+        }
+        self.ready = True
+        logger.info(f"Keras warm-up finished: {self.warmup_stats}")
+        return self.warmup_stats
+
+    def close(self):
+        """Drop the traced functions and the model so their memory can be freed"""
+        self.ready = False
+        self._concrete.clear()
+        self._serve = None
+        self.model = None
+
+
+class TFLiteEngine:
+    """
+    TFLite interpreter for the fp16 / int8 exports made by the training notebook
+
+    Integer models get their inputs quantized and outputs dequantized here, so
+    callers always pass and receive float32. One interpreter is allocated per
+    serving batch size (in warm_up(), or on first use of that size) and
+    batches are zero-padded up to the nearest size, as KerasEngine does, so
+    the mixed batch sizes coming out of the micro-batcher never resize and
+    reallocate tensors on the request path. Interpreters are not thread safe,
+    so calls to each one are serialized.
+    """
+
+    name = 'tflite'
+
+    def __init__(self, model_path, num_threads=None, batch_sizes=DEFAULT_BATCH_SIZES):
+        self.source = model_path
+        self.version = file_version(model_path)
+        self.num_threads = num_threads
+        self.batch_sizes = tuple(sorted(batch_sizes))
+        self.ready = False
+        self.warmup_stats = None
+        self._lock = threading.Lock()
+        self._interpreters = {}
+        _, self._input, self._output, _ = self._interpreter(self.batch_sizes[0])
+        logger.info(
+            f"TFLite model loaded from {model_path} "
+            f"(input {self._input['dtype'].__name__}, threads={num_threads})"
+        )
+
+    def _interpreter(self, batch_size):
+        """(interpreter, input details, output details, lock) allocated for batch_size"""
+        with self._lock:
+            slot = self._interpreters.get(batch_size)
+            if slot is None:
+                interpreter = TFLiteInterpreter(model_path=self.source, num_threads=self.num_threads)
+                input_index = interpreter.get_input_details()[0]['index']
+                shape = list(interpreter.get_input_details()[0]['shape'])
+                if shape[0] != batch_size:
+                    interpreter.resize_tensor_input(input_index, [batch_size] + shape[1:])
+                interpreter.allocate_tensors()
+                slot = (interpreter, interpreter.get_input_details()[0],
+                        interpreter.get_output_details()[0], threading.Lock())
+                self._interpreters[batch_size] = slot
+            return slot
+
+    def _bucket(self, count):
+        for size in self.batch_sizes:
+            if size >= count:
+                return size
+        return self.batch_sizes[-1]
+
+    def _quantize(self, batch):
+        dtype = self._input['dtype']
+        if dtype == np.float32:
+            return batch.astype(np.float32, copy=False)
+        scale, zero_point = self._input['quantization']
+        info = np.iinfo(dtype)
+        quantized = np.round(batch / scale + zero_point)
+        return np.clip(quantized, info.min, info.max).astype(dtype)
+
+    def _dequantize(self, output):
+        if self._output['dtype'] == np.float32:
+            return output
+        scale, zero_point = self._output['quantization']
+        return (output.astype(np.float32) - zero_point) * scale
+
+    def _run(self, batch):
+        count = len(batch)
+        size = self._bucket(count)
+        if size != count:
+            padding = np.zeros((size - count,) + batch.shape[1:], dtype=batch.dtype)
+            batch = np.concatenate([batch, padding], axis=0)
+        interpreter, input_details, output_details, lock = self._interpreter(size)
+        with lock:
+            interpreter.set_tensor(input_details['index'], self._quantize(batch))
+            interpreter.invoke()
+            output = interpreter.get_tensor(output_details['index'])[:count].copy()
+        return self._dequantize(output)
+
+    def warm_up(self, runs=3):
+        """Allocate an interpreter per serving batch size and run each a few times"""
+        started = time.perf_counter()
+        input_shape = tuple(self._input['shape'][1:])
+        for size in self.batch_sizes:
+            sample = np.zeros((size,) + input_shape, dtype=np.float32)
+            for _ in range(runs):
+                self._run(sample)
+        self.warmup_stats = {
+            'cold_start_s': round(time.perf_counter() - started, 3),
+            'batch_sizes': list(self.batch_sizes),
+        }
+        self.ready = True
+        logger.info(f"TFLite warm-up finished: {self.warmup_stats}")
+        return self.warmup_stats
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        largest = self.batch_sizes[-1]
+        if len(batch) <= largest:
+            return self._run(batch)
+        return np.concatenate(
+            [self._run(batch[start:start + largest]) for start in range(0, len(batch), largest)],
+            axis=0
+        )
+
+    def close(self):
+        with self._lock:
+            self.ready = False
+            self._interpreters.clear()
+
+
+def load_engine(model_path, backend=None, tflite_path=None, num_threads=None, **load_kwargs):
+    """
+    Build the inference engine selected by configuration
+
+    Args:
+    - model_path: Keras model used by the 'keras' backend
+    - backend: 'keras' or 'tflite' (defaults to MODEL_BACKEND, then 'keras')
+    - tflite_path: .tflite file for the 'tflite' backend (defaults to TFLITE_MODEL_PATH)
+    - num_threads: interpreter threads (defaults to TFLITE_NUM_THREADS)
+    """
+    backend = (backend or os.environ.get('MODEL_BACKEND', 'keras')).lower()
+
+    if backend == 'keras':
+        return KerasEngine.from_path(model_path, **load_kwargs)
+
+    if backend == 'tflite':
+        tflite_path = tflite_path or os.environ.get('TFLITE_MODEL_PATH')
+        if not tflite_path:
+            raise ValueError('MODEL_BACKEND=tflite requires TFLITE_MODEL_PATH')
+        if num_threads is None and os.environ.get('TFLITE_NUM_THREADS'):
+            num_threads = int(os.environ['TFLITE_NUM_THREADS'])
+        return TFLiteEngine(tflite_path, num_threads=num_threads)
+
+    raise ValueError(f"Unknown MODEL_BACKEND '{backend}', expected 'keras' or 'tflite'")
+
+
+def start_warm_up(engine, on_done=None):
+    """
+    Warm the engine up in a background thread
+
+    The server starts accepting connections straight away; engine.ready flips
+    to True (and /health reports ready) once warm-up has finished.
+    """
+    def run():
+        try:
+            stats = engine.warm_up()
+        except Exception as e:
+            logger.error(f"Model warm-up failed: {str(e)}")
+            # Serve anyway; shapes are traced lazily on first use
+            engine.ready = True
+            stats = None
+        if on_done is not None:
+            on_done(stats)
+
+    thread = threading.Thread(target=run, name='model-warm-up', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,373 @@
+"""
+Minimal Prometheus metrics for the Flask servers.
+
+Counters, gauges and histograms live in a process-wide registry and are
+rendered in the Prometheus text exposition format at /metrics. Pipeline
+stages are timed with `with stage('decode'):`. When METRICS_ENABLED=0,
+stage() returns a shared no-op context manager and the request hooks are
+not installed, so the hot path pays for one function call and nothing else.
+"""
+import contextlib
+import math
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('METRICS_ENABLED', '1').lower() not in ('0', 'false', 'no')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Registry:
+    """
+    Holds every metric of the process and renders them for scraping
+
+    A name can be registered once: a second family with the same name would
+    render duplicate HELP/TYPE lines, which scrapers reject.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        registry.register(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _items(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1.0):
+        self._children[()].inc(amount)
+
+    def samples(self):
+        return [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}'
+            for key, child in self._items()
+        ]
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1.0):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = float(value)
+
+
+class Gauge(Counter):
+    """Value that goes up and down, or is read from a callback at scrape time"""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self._function = None
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def dec(self, amount=1.0):
+        self._children[()].dec(amount)
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    def set_function(self, function):
+        """Read the value from function() on every scrape (unlabelled gauges only)"""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            try:
+                return [f'{self.name} {_format_value(self._function())}']
+            except Exception:
+                return []
+        return super().samples()
+
+
+class CallbackCounter(_Metric):
+    """
+    Counter whose values are read from an existing stats source at scrape time
+
+    function() returns a number, or a dict mapping label-value tuples to numbers.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help, function, labelnames=(), registry=REGISTRY):
+        self._function = function
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return None
+
+    def samples(self):
+        try:
+            values = self._function()
+        except Exception:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+            for key, value in values.items()
+        ]
+
+
+class _Timer:
+    __slots__ = ('_child', '_started')
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._child.observe(time.perf_counter() - self._started)
+        return False
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def time(self):
+        return _Timer(self)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def time(self):
+        return self._children[()].time()
+
+    def samples(self):
+        lines = []
+        for key, child in self._items():
+            with child._lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+# ------------------------------------------------------------
+# Prediction pipeline metrics
+# ------------------------------------------------------------
+
+STAGE_SECONDS = Histogram(
+    'abdos_stage_duration_seconds',
+    'Time spent in each stage of the prediction pipeline',
+    ['stage']
+)
+REQUEST_SECONDS = Histogram(
+    'abdos_request_duration_seconds',
+    'Total request handling time',
+    ['endpoint']
+)
+REQUESTS_TOTAL = Counter(
+    'abdos_requests_total',
+    'Requests handled, by endpoint and HTTP status',
+    ['endpoint', 'status']
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'abdos_requests_in_flight',
+    'Requests currently being handled',
+    ['endpoint']
+)
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def stage(name):
+    """Context manager timing one pipeline stage (no-op when metrics are disabled)"""
+    if not ENABLED:
+        return _NULL_TIMER
+    return STAGE_SECONDS.labels(stage=name).time()
+
+
+def observe_stage(name, seconds):
+    """Record a stage duration measured elsewhere"""
+    if ENABLED:
+        STAGE_SECONDS.labels(stage=name).observe(seconds)
+
+
+def instrument_app(app, path='/metrics'):
+    """
+    Add request counters, in-flight gauges and the /metrics endpoint to a Flask app
+
+    Endpoints are labelled by their URL rule (e.g. /history/<user_id>) so ids
+    in the path do not create new series.
+    """
+    from flask import Response, g, request
+
+    @app.route(path, methods=['GET'])
+    def metrics_endpoint():
+        if not ENABLED:
+            return Response('metrics disabled\n', status=404, mimetype='text/plain')
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    if not ENABLED:
+        return
+
+    def endpoint_label():
+        rule = request.url_rule
+        return rule.rule if rule is not None else 'unmatched'
+
+    @app.before_request
+    def start_request_metrics():
+        endpoint = endpoint_label()
+        if endpoint == path:
+            return
+        g._metrics_started = time.perf_counter()
+        g._metrics_endpoint = endpoint
+        REQUESTS_IN_FLIGHT.labels(endpoint=endpoint).inc()
+
+    @app.after_request
+    def count_request(response):
+        endpoint = g.pop('_metrics_endpoint', None)
+        if endpoint is not None:
+            started = g._metrics_started
+            status = response.status_code
+
+            # A streamed body (e.g. /predict/batch NDJSON) is only generated
+            # after this hook, so the request counts as finished when the
+            # server closes the response
+            def finish():
+                REQUESTS_TOTAL.labels(endpoint=endpoint, status=status).inc()
+                REQUEST_SECONDS.labels(endpoint=endpoint).observe(time.perf_counter() - started)
+                REQUESTS_IN_FLIGHT.labels(endpoint=endpoint).dec()
+
+            response.call_on_close(finish)
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        # Only reached with the endpoint still set if after_request never ran
+        endpoint = g.pop('_metrics_endpoint', None)
+        if endpoint is not None:
+            REQUESTS_TOTAL.labels(endpoint=endpoint, status=500).inc()
+            REQUESTS_IN_FLIGHT.labels(endpoint=endpoint).dec()
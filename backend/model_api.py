@@ -1,17 +1,33 @@
-from flask import Flask, request, jsonify
-from tensorflow.keras.models import load_model
+from flask import Flask, Response, request, jsonify
 import tensorflow as tf
 import numpy as np
-from PIL import Image
 from flask_cors import CORS
 import io
 import os
 import time
 from datetime import datetime, timezone
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
 from bson.objectid import ObjectId
 import re
+import atexit
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from batching import MicroBatcher, QueueFullError
+from inference import load_engine, start_warm_up
+from model_registry import ModelRegistry
+from prediction_cache import PredictionCache, digest_bytes, digest_stream, register_cache_metrics
+from preprocessing import preprocess_image
+from preprocess_pool import PreprocessBusy, PreprocessPool
+from uploads import MAX_UPLOAD_BYTES, UploadRejected, open_upload
+from write_behind import WriteBehindQueue
+from identity_cache import IdentityCache, register_identity_cache_metrics, user_summary
+from history import InvalidCursor, history_page, parse_fields, parse_page_size
+from prediction_stats import aggregate_predictions, summarize
+from export import FORMATS, InvalidExport, export_history, parse_date, parse_export_fields
+from storage import storage_from_env
+from blob_store import blob_store_from_env
+from passwords import HasherBusy, PasswordHasher
+from metrics import Gauge, instrument_app, stage
 
 app = Flask(__name__)
 
@@ -27,6 +43,17 @@ app.config['JWT_SECRET_KEY'] = 'your-secret-key'  # Change this to a secure secr
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = False  # Tokens don't expire
 jwt = JWTManager(app)
 
+# Prometheus metrics at /metrics: per-stage latency histograms, request
+# counters by status and in-flight gauges (METRICS_ENABLED=0 turns them off)
+instrument_app(app)
+
+# Bodies larger than this are refused with 413 while they are being read
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': f'Upload too large, the limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB'}), 413
+
 # Define custom preprocessing layer
 class Preprocessing(tf.keras.layers.Layer):
     def __init__(self, **kwargs):
@@ -47,136 +74,430 @@ class Preprocessing(tf.keras.layers.Layer):
 # Set the model path to only use the user's downloaded model
 MODEL_PATH = r"C:\Users\User\Downloads\skin_cancer_model.h5"
 
-# Load the model at startup
-try:
+# Versioned models come from models/model_config.config and the
+# <base_path>/<version>/saved_model layout. MODEL_VERSION pins a version;
+# otherwise the newest one is served and MODEL_POLL_INTERVAL_S controls how
+# often new versions are looked for and hot-swapped in (0 disables polling).
+# MODEL_BACKEND=tflite, or a missing config, falls back to MODEL_PATH.
+MODEL_CONFIG_PATH = os.environ.get(
+    'MODEL_CONFIG_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'model_config.config')
+)
+MODEL_NAME = os.environ.get('MODEL_NAME') or None
+MODEL_VERSION = os.environ.get('MODEL_VERSION') or None
+MODEL_POLL_INTERVAL_S = float(os.environ.get('MODEL_POLL_INTERVAL_S', 30))
+
+def load_registry():
+    if os.environ.get('MODEL_BACKEND', 'keras').lower() == 'keras' and os.path.exists(MODEL_CONFIG_PATH):
+        try:
+            registry = ModelRegistry.from_config(
+                MODEL_CONFIG_PATH, MODEL_NAME,
+                pinned_version=MODEL_VERSION,
+                poll_interval_s=MODEL_POLL_INTERVAL_S
+            )
+            registry.load_initial()
+            return registry
+        except Exception as e:
+            print(f"Failed to load a versioned model from {MODEL_CONFIG_PATH}: {e}")
+
     print(f"Loading model from: {MODEL_PATH}")
-    model = load_model(MODEL_PATH)
-    print("Model loaded successfully!")
+    return ModelRegistry.single(load_engine(MODEL_PATH))
+
+# Load the inference engine at startup (MODEL_BACKEND=keras|tflite)
+try:
+    registry = load_registry()
+    print(f"Model loaded successfully! ({registry.current.name} backend: {registry.current.source}, "
+          f"version {registry.current.version})")
 except Exception as e:
     print(f"Failed to load model from {MODEL_PATH}: {e}")
-    model = None
+    registry = None
+
+# Micro-batching: concurrent /predict requests share one forward pass.
+# BATCH_MAX_SIZE caps rows per pass, BATCH_MAX_WAIT_MS is how long the first
+# queued image waits for others before the batch runs anyway.
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 16))
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS', 5))
+BATCH_QUEUE_SIZE = int(os.environ.get('BATCH_QUEUE_SIZE', 256))
+PREDICT_TIMEOUT_S = float(os.environ.get('PREDICT_TIMEOUT_S', 30))
+
+batcher = None
+if registry is not None:
+    batcher = MicroBatcher(
+        registry.predict,
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_MAX_WAIT_MS,
+        max_queue_size=BATCH_QUEUE_SIZE
+    )
+    atexit.register(batcher.close)
+    Gauge('abdos_inference_queue_depth', 'Images waiting for the micro-batcher').set_function(
+        lambda: batcher.stats()['queue_depth']
+    )
+    print(f"Micro-batching enabled (max batch {BATCH_MAX_SIZE}, max wait {BATCH_MAX_WAIT_MS} ms)")
+
+    def report_warm_up(stats):
+        if stats is None:
+            print("Model warm-up failed; serving with lazily traced shapes")
+        elif 'overhead_saved_ms' in stats:
+            print(f"Model warm-up done in {stats['cold_start_s']}s "
+                  f"(per-call: model.predict {stats['model_predict_ms']} ms, "
+                  f"traced {stats['traced_call_ms']} ms, saved {stats['overhead_saved_ms']} ms)")
+        else:
+            print(f"Model warm-up done in {stats['cold_start_s']}s")
+
+    start_warm_up(registry.current, on_done=report_warm_up)
+
+    # New versions are loaded and warmed up in the background, then swapped in
+    registry.start_polling()
+    atexit.register(registry.close)
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    if model is None:
+    if registry is None:
         return jsonify({
             'status': 'error',
             'message': 'Model not loaded',
             'model_path': MODEL_PATH
         }), 503
+    engine = registry.current
+    if not engine.ready:
+        return jsonify({
+            'status': 'warming_up',
+            'message': 'Model warm-up in progress'
+        }), 503
     return jsonify({
-        'status': 'healthy',
-        'message': 'Backend API is running'
+        'status': 'ready',
+        'message': 'Backend API is running',
+        'model_version': engine.version,
+        'warmup': engine.warmup_stats
     })
 
+@app.route('/batching/stats', methods=['GET'])
+def batching_stats():
+    if batcher is None:
+        return jsonify({'error': 'Model not loaded'}), 503
+    return jsonify(batcher.stats())
+
+@app.route('/models/stats', methods=['GET'])
+def model_stats():
+    if registry is None:
+        return jsonify({'error': 'Model not loaded'}), 503
+    return jsonify(registry.stats())
+
+# Repeated uploads of the same image reuse the cached model output.
+# PREDICTION_CACHE_SIZE=0 disables it; PREDICTION_CACHE_DIR adds a tier on
+# disk shared by all worker processes.
+prediction_cache = PredictionCache(
+    max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', 1024)),
+    ttl_seconds=float(os.environ.get('PREDICTION_CACHE_TTL_S', 3600)),
+    disk_dir=os.environ.get('PREDICTION_CACHE_DIR') or None,
+    model_version=registry.current.version if registry is not None else None,
+    disk_max_entries=int(os.environ.get('PREDICTION_CACHE_DISK_MAX_ENTRIES', 100000)),
+    sweep_interval_s=float(os.environ.get('PREDICTION_CACHE_SWEEP_S', 300))
+)
+
+register_cache_metrics(prediction_cache)
+
+# A hot-swapped model invalidates every cached output of the old one
+if registry is not None:
+    registry.add_listener(lambda engine: prediction_cache.set_model_version(engine.version))
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(prediction_cache.stats())
+
+# Users and prediction history (STORAGE_BACKEND=mongo|memory, pool size,
+# timeouts and write concern via MONGO_* - see storage.py)
+storage = storage_from_env()
+atexit.register(storage.close)
+
+# History records are written behind the response: a background thread
+# bulk-inserts them every HISTORY_BATCH_SIZE records or HISTORY_FLUSH_MS,
+# retrying failed writes with backoff. At most HISTORY_QUEUE_SIZE records
+# are buffered; the rest are dropped (and counted) rather than slowing
+# predictions down. Whatever is buffered is flushed at shutdown.
+def write_history(records):
+    # Raises (and the batch is retried) unless every record is now stored.
+    # Records an earlier attempt wrote come back as duplicates and are
+    # skipped; none of them were counted yet, because that attempt failed
+    # before the increment below.
+    storage.insert_predictions(records)
+    # Keep the per-user monthly statistics in step with the whole batch,
+    # exactly once. A failed increment is logged rather than retried (a
+    # partly applied $inc would count twice); rebuild_stats.py recomputes
+    # the statistics from history.
+    try:
+        storage.increment_stats(aggregate_predictions(records))
+    except Exception as e:
+        print(f"Error updating prediction statistics, run rebuild_stats.py: {e}")
+
+def history_write_failed(records, error):
+    # A batch given up on may still have been partly stored: those records
+    # keep their image and are counted, the images of the rest are released
+    # so sweep_images.py can collect them
+    try:
+        stored = storage.stored_prediction_ids(record['_id'] for record in records if '_id' in record)
+    except Exception as e:
+        print(f"Could not check which of {len(records)} history records were stored, treating none as stored: {e}")
+        stored = set()
+    lost = [record for record in records if record.get('_id') not in stored]
+    release_images(lost)
+    if len(lost) < len(records):
+        try:
+            storage.increment_stats(aggregate_predictions(r for r in records if r.get('_id') in stored))
+        except Exception as e:
+            print(f"Error updating prediction statistics, run rebuild_stats.py: {e}")
+
+history_writer = WriteBehindQueue(
+    write_history,
+    on_failure=history_write_failed,
+    name='history',
+    max_batch_size=int(os.environ.get('HISTORY_BATCH_SIZE', 100)),
+    flush_interval_ms=float(os.environ.get('HISTORY_FLUSH_MS', 500)),
+    max_queue_size=int(os.environ.get('HISTORY_QUEUE_SIZE', 10000)),
+    max_retries=int(os.environ.get('HISTORY_MAX_RETRIES', 5)),
+    retry_backoff_s=float(os.environ.get('HISTORY_RETRY_BACKOFF_S', 0.5))
+)
+atexit.register(history_writer.close)
+
+@app.route('/writes/stats', methods=['GET'])
+def write_stats():
+    return jsonify(history_writer.stats())
+
+# Uploads behind saved predictions are kept for re-scoring with later model
+# versions (rescore_history.py), deduplicated by SHA-256 and reference
+# counted per prediction. IMAGE_STORE=filesystem|gridfs enables it.
+image_store = blob_store_from_env(storage)
+
+@app.route('/images/stats', methods=['GET'])
+def image_store_stats():
+    if image_store is None:
+        return jsonify({'backend': None})
+    return jsonify(image_store.stats())
+
+# JWT identity (email) -> {id, name, email}, so authenticated routes skip the
+# user lookup; update_profile() invalidates its entry, IDENTITY_CACHE_TTL_S
+# bounds staleness for changes made elsewhere (IDENTITY_CACHE_SIZE=0 disables)
+identity_cache = IdentityCache(
+    lambda email: user_summary(storage.find_user(email=email)),
+    max_entries=int(os.environ.get('IDENTITY_CACHE_SIZE', 4096)),
+    ttl_seconds=float(os.environ.get('IDENTITY_CACHE_TTL_S', 60))
+)
+register_identity_cache_metrics(identity_cache)
+
+@app.route('/identity-cache/stats', methods=['GET'])
+def identity_cache_stats():
+    return jsonify(identity_cache.stats())
+
+# Password hashing runs on its own small pool so login bursts cannot take
+# the cores and threads /predict needs. PASSWORD_HASH_METHOD sets the
+# werkzeug method and cost (default: werkzeug's own); hashes made with the
+# same method at a lower cost are upgraded on the next login.
+password_hasher = PasswordHasher(
+    method=os.environ.get('PASSWORD_HASH_METHOD') or None,
+    max_workers=int(os.environ.get('AUTH_HASH_WORKERS', 2)),
+    max_pending=int(os.environ.get('AUTH_HASH_QUEUE_SIZE', 64)),
+    timeout=float(os.environ.get('AUTH_HASH_TIMEOUT_S', 10))
+)
+atexit.register(password_hasher.close)
+
+# History pages are read newest first with a (user_id, timestamp, _id) index
+try:
+    storage.ensure_indexes()
+except Exception as e:
+    print(f"Could not create the storage indexes: {e}")
+
+# Class names in model output order
+CONDITIONS = [
+    'Actinic Keratoses',
+    'Basal Cell Carcinoma',
+    'Benign Keratosis',
+    'Dermatofibroma',
+    'Melanoma',
+    'Melanocytic Nevi',
+    'Vascular Lesions'
+]
+
+# Batch uploads: images per /predict/batch request and preprocessing threads
+BATCH_MAX_IMAGES = int(os.environ.get('BATCH_MAX_IMAGES', 64))
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', os.cpu_count() or 4))
+preprocess_executor = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix='preprocess')
+
+# PREPROCESS_PROCESSES > 0 moves decode/resize/normalize into that many
+# worker processes (results come back through shared memory) so they do not
+# contend for the GIL with the request threads
+PREPROCESS_PROCESSES = int(os.environ.get('PREPROCESS_PROCESSES', 0))
+preprocess_pool = None
+if PREPROCESS_PROCESSES > 0:
+    preprocess_pool = PreprocessPool(PREPROCESS_PROCESSES, normalization='symmetric')
+
+def preprocess_image_bytes(image_bytes):
+    # JPEGs are decoded at reduced scale, resized to 224x224 and scaled to
+    # the [-1, 1] range the model expects
+    if preprocess_pool is not None:
+        with stage('preprocess_pool'):
+            return preprocess_pool.preprocess(image_bytes, timeout=PREDICT_TIMEOUT_S)
+    return preprocess_image(io.BytesIO(image_bytes), normalization='symmetric')
+
+def preprocess_upload(img, stream):
+    # img was opened lazily from the upload stream by open_upload(); the pixels
+    # are decoded from that stream directly, without buffering it first
+    if preprocess_pool is not None:
+        stream.seek(0)
+        with stage('preprocess_pool'):
+            return preprocess_pool.preprocess(stream.read(), timeout=PREDICT_TIMEOUT_S)
+    return preprocess_image(img, normalization='symmetric')
+
+def parse_user_object_id(user_id_str):
+    if not user_id_str:
+        return None
+    try:
+        return ObjectId(user_id_str) # Convert string to ObjectId
+    except Exception as oid_error:
+        print(f"Warning: Invalid user_id format received: {user_id_str}. Error: {oid_error}")
+        # Proceed without saving history for this prediction
+        return None
+
+def format_prediction(model_output):
+    # Get raw probabilities from model and ensure they sum to 1
+    probabilities = model_output / np.sum(model_output)
+    
+    # Get predicted class and confidence
+    predicted_class = int(np.argmax(probabilities))
+    confidence_pct = float(probabilities[predicted_class] * 100)
+    
+    # Process probabilities for all conditions
+    all_probabilities = {}
+    for i, condition in enumerate(CONDITIONS):
+        prob = float(probabilities[i] * 100)
+        if prob < 1.0:
+            prob = 0.0
+        all_probabilities[condition] = round(prob, 2)
+    
+    # Get top 3 predictions
+    top_indices = np.argsort(probabilities)[-3:][::-1]
+    top_predictions = [
+        (CONDITIONS[idx], float(probabilities[idx] * 100)) for idx in top_indices
+    ]
+    
+    return {
+        'predicted_class': predicted_class,
+        'class_name': CONDITIONS[predicted_class],
+        'confidence': confidence_pct,
+        'probabilities': all_probabilities,
+        'top_predictions': top_predictions,
+        'timestamp': datetime.now(timezone.utc),
+    }
+
+def store_image(record, digest, stream, content_type=None):
+    # Keep the upload with its history record; on failure the prediction is
+    # still saved, just without an image to re-score
+    if image_store is None:
+        return
+    try:
+        with stage('image_store'):
+            image_store.put(digest, stream, content_type=content_type)
+        record['image_sha256'] = digest
+    except Exception as e:
+        print(f"Error storing image {digest}: {e}")
+
+def release_images(records):
+    # References held by records that were not saved after all
+    if image_store is None:
+        return
+    for record in records:
+        if record.get('image_sha256'):
+            try:
+                image_store.release(record['image_sha256'])
+            except Exception as e:
+                print(f"Error releasing image {record['image_sha256']}: {e}")
+
+def history_record(response, user_object_id, image_name):
+    return {
+        'user_id': user_object_id,
+        'timestamp': response['timestamp'],
+        'predicted_class': response['predicted_class'],
+        'confidence': response['confidence'],
+        'label': response['class_name'],
+        'all_probabilities': response['probabilities'],
+        'image_name': image_name
+    }
+
 @app.route('/predict', methods=['POST'])
 def predict():
-    if model is None:
+    if registry is None:
         return jsonify({'error': 'Model failed to load'}), 500
         
     try:
-        if 'image' not in request.files:
+        # Accessing request.files parses the multipart body
+        with stage('parse'):
+            files = request.files
+        if 'image' not in files:
             return jsonify({'error': 'No image provided'}), 400
 
-        file = request.files['image']
-        user_id_str = request.form.get('user_id')  # Get user_id string if provided
-        user_object_id = None
-        if user_id_str:
-            try:
-                user_object_id = ObjectId(user_id_str) # Convert string to ObjectId
-            except Exception as oid_error:
-                print(f"Warning: Invalid user_id format received: {user_id_str}. Error: {oid_error}")
-                # Decide how to handle: maybe return an error, or proceed without saving history
-                # For now, we'll proceed without saving for this prediction.
-                user_object_id = None 
-        
-        # Process the image
-        image_bytes = file.read()
-        img = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-        img = img.resize((224, 224))
-        
-        # Convert to numpy array and preprocess
-        img_array = np.array(img).astype(np.float32)
-        img_array = img_array / 127.5 - 1.0
-        img_array = np.expand_dims(img_array, axis=0)
+        file = files['image']
+        user_object_id = parse_user_object_id(request.form.get('user_id'))
         
-        # Make predictions
-        predictions = model.predict(img_array, verbose=0)
-        
-        # Define conditions first so we can use them in our print statements
-        conditions = [
-            'Actinic Keratoses',
-            'Basal Cell Carcinoma',
-            'Benign Keratosis',
-            'Dermatofibroma',
-            'Melanoma',
-            'Melanocytic Nevi',
-            'Vascular Lesions'
-        ]
-        
-        # Get raw probabilities from model and ensure they sum to 1
-        probabilities = predictions[0]
-        probabilities = probabilities / np.sum(probabilities)  # Normalize to ensure sum is 1
+        # Reject anything that is not a JPEG/PNG, or whose header dimensions
+        # exceed the pixel limit, before decoding any pixels
+        try:
+            with stage('validate'):
+                img = open_upload(file.stream)
+        except UploadRejected as rejected:
+            return jsonify({'error': str(rejected)}), rejected.status
         
-        print(f"Model probabilities: {[round(p*100, 2) for p in probabilities]}")
-        print(f"Prediction: {np.argmax(probabilities)} - {conditions[np.argmax(probabilities)]}")
+        with stage('hash'):
+            digest = digest_stream(file.stream)
+        output = prediction_cache.get(digest)
         
-        # Get predicted class and confidence
-        predicted_class = np.argmax(probabilities)
-        confidence_pct = float(probabilities[predicted_class] * 100)
+        if output is None:
+            # Process the image
+            try:
+                img_array = preprocess_upload(img, file.stream)
+            except (PreprocessBusy, FutureTimeoutError):
+                return jsonify({'error': 'Server busy, try again shortly'}), 503
+            
+            # Make predictions - the batcher may run this image together with
+            # other requests that arrived at the same time. The lease keeps
+            # this request on its model version across a hot-swap, and the
+            # queued item holds the version until the batcher is done with it
+            # even if this request times out first.
+            with registry.lease() as engine:
+                version = engine.version
+                try:
+                    future = batcher.submit(img_array, predict_fn=engine.predict)
+                    registry.hold_until_done(engine, future)
+                    predictions = future.result(timeout=PREDICT_TIMEOUT_S)
+                except QueueFullError as queue_error:
+                    return jsonify({'error': str(queue_error)}), 503
+                except FutureTimeoutError:
+                    return jsonify({'error': 'Prediction timed out'}), 504
+            output = predictions[0]
+            prediction_cache.put(digest, output, version=version)
+        else:
+            print(f"Prediction cache hit for {file.filename}")
         
-        # Process probabilities for all conditions
-        all_probabilities = {}
-        for i, condition in enumerate(conditions):
-            prob = float(probabilities[i] * 100)
-            if prob < 1.0:
-                prob = 0.0
-            all_probabilities[condition] = round(prob, 2)
+        response = format_prediction(np.asarray(output, dtype=np.float32))
         
-        # Get top 3 predictions
-        top_indices = np.argsort(probabilities)[-3:][::-1]
-        top_predictions = [
-            (conditions[idx], probabilities[idx] * 100) for idx in top_indices
-        ]
-        top_pred_info = [f"{name} ({conf:.2f}%)" for name, conf in top_predictions]
+        print(f"Prediction: {response['predicted_class']} - {response['class_name']}")
+        top_pred_info = [f"{name} ({conf:.2f}%)" for name, conf in response['top_predictions']]
         print(f"Top 3 predictions: {', '.join(top_pred_info)}")
         
-        # Prepare response
-        response = {
-            'predicted_class': int(predicted_class),
-            'class_name': conditions[predicted_class],
-            'confidence': confidence_pct,
-            'probabilities': all_probabilities,
-            'top_predictions': top_predictions,
-            'timestamp': datetime.now(timezone.utc),
-        }
-        
         # Store the prediction in MongoDB
-        prediction_data = {
-            # Store the ObjectId if conversion was successful
-            'user_id': user_object_id, 
-            'timestamp': datetime.now(timezone.utc),
-            'predicted_class': int(predicted_class),
-            'confidence': confidence_pct,
-            'label': conditions[predicted_class],
-            'all_probabilities': all_probabilities,
-            'image_name': file.filename
-        }
+        prediction_data = history_record(response, user_object_id, file.filename)
         
-        # Only store if we have a valid user ObjectId
+        # Only store if we have a valid user ObjectId; the write happens in
+        # the background so the response does not wait for MongoDB
         if user_object_id:  
-            try:
-                print(f"Attempting to save prediction for user ObjectId: {user_object_id}")
-                mongo.db.predictions.insert_one(prediction_data)
-                print("Prediction saved successfully.")
-            except Exception as db_error:
-                 print(f"!!! Database error saving prediction: {db_error}")
-                 # Decide if this error should be returned to user or just logged
+            store_image(prediction_data, digest, file.stream, file.mimetype)
+            if not history_writer.put(prediction_data):
+                print(f"!!! History buffer full, prediction for {user_object_id} not saved")
+                release_images([prediction_data])
         else:
             print("No valid user_id provided, prediction result not saved to history.")
             
         # Return prediction results regardless of saving success
-        return jsonify(response)
+        with stage('serialize'):
+            return jsonify(response)
         
     except Exception as e:
         print(f"Error during prediction: {e}")
@@ -184,37 +505,223 @@ def predict():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    """
+    Classify many images in one request
+
+    Expects multipart/form-data with one or more 'images' files (optionally
+    'user_id'). Streams one NDJSON line per image as soon as its batch is done;
+    each line has the same fields as /predict plus 'index' and 'filename'.
+    The last line is a summary with the number of results saved to history.
+    """
+    if registry is None:
+        return jsonify({'error': 'Model failed to load'}), 500
+
+    files = request.files.getlist('images') or request.files.getlist('image')
+    if not files:
+        return jsonify({'error': 'No images provided'}), 400
+    if len(files) > BATCH_MAX_IMAGES:
+        # 400, not 413: the body may be well under MAX_UPLOAD_MB, and clients
+        # should split the batch rather than shrink the files
+        return jsonify({'error': f'Too many images: {len(files)} sent, at most {BATCH_MAX_IMAGES} per request'}), 400
+
+    user_object_id = parse_user_object_id(request.form.get('user_id'))
+
+    # Validate and read the uploads before streaming starts; the request body
+    # is not available once the response generator is running
+    uploads = []
+    rejections = {}
+    content_types = [file.mimetype for file in files]
+    for index, file in enumerate(files):
+        try:
+            open_upload(file.stream)
+        except UploadRejected as rejected:
+            rejections[index] = str(rejected)
+            uploads.append((file.filename, None))
+            continue
+        file.stream.seek(0)
+        uploads.append((file.filename, file.stream.read()))
+
+    def error_line(index, filename, message):
+        return app.json.dumps({'index': index, 'filename': filename, 'error': message}) + '\n'
+
+    def predict_stream(engine):
+        records = []
+        version = engine.version
+        digests = [digest_bytes(image_bytes) if image_bytes is not None else None
+                   for _, image_bytes in uploads]
+
+        for index, message in rejections.items():
+            yield error_line(index, uploads[index][0], message)
+
+        def result_line(index, output):
+            filename = uploads[index][0]
+            response = format_prediction(np.asarray(output, dtype=np.float32))
+            if user_object_id:
+                record = history_record(response, user_object_id, filename)
+                store_image(record, digests[index], io.BytesIO(uploads[index][1]), content_types[index])
+                records.append(record)
+            return app.json.dumps(dict(response, index=index, filename=filename)) + '\n'
+
+        # Images seen before are answered from the cache straight away
+        pending = {}
+        for index, (_, image_bytes) in enumerate(uploads):
+            if image_bytes is None:
+                continue
+            cached = prediction_cache.get(digests[index])
+            if cached is not None:
+                yield result_line(index, cached)
+            else:
+                pending[preprocess_executor.submit(preprocess_image_bytes, image_bytes)] = index
+
+        # Group images into model batches in the order they finish decoding
+        batches = {}
+        chunk_indices, chunk_arrays = [], []
+
+        def flush_chunk():
+            try:
+                future = batcher.submit(np.stack(chunk_arrays), predict_fn=engine.predict)
+                # The stream's lease ends on a timeout or a closed connection
+                registry.hold_until_done(engine, future)
+                batches[future] = list(chunk_indices)
+            except QueueFullError as queue_error:
+                for index in chunk_indices:
+                    yield error_line(index, uploads[index][0], str(queue_error))
+            chunk_indices.clear()
+            chunk_arrays.clear()
+
+        for future in as_completed(pending):
+            index = pending[future]
+            try:
+                chunk_arrays.append(future.result())
+                chunk_indices.append(index)
+            except Exception as img_error:
+                yield error_line(index, uploads[index][0], f'Image preprocessing failed: {img_error}')
+                continue
+            if len(chunk_arrays) == BATCH_MAX_SIZE:
+                yield from flush_chunk()
+        if chunk_arrays:
+            yield from flush_chunk()
+
+        finished = set()
+        try:
+            for future in as_completed(batches, timeout=PREDICT_TIMEOUT_S * max(len(batches), 1)):
+                finished.add(future)
+                indices = batches[future]
+                try:
+                    outputs = future.result()
+                except Exception as pred_error:
+                    for index in indices:
+                        yield error_line(index, uploads[index][0], f'Model prediction failed: {pred_error}')
+                    continue
+                for index, output in zip(indices, outputs):
+                    prediction_cache.put(digests[index], output, version=version)
+                    yield result_line(index, output)
+        except FutureTimeoutError:
+            for future, indices in batches.items():
+                if future not in finished:
+                    for index in indices:
+                        yield error_line(index, uploads[index][0], 'Prediction timed out')
+
+        # Queued for the background bulk insert; 'saved' counts accepted records
+        saved = history_writer.put_many(records) if records else 0
+        release_images(records[saved:])
+        yield app.json.dumps({'done': True, 'count': len(uploads), 'saved': saved}) + '\n'
+
+    def generate():
+        # The whole batch runs on the model version current when it started
+        with registry.lease() as engine:
+            yield from predict_stream(engine)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
 @app.route('/history/<user_id>', methods=['GET'])
 @jwt_required()
 def get_history(user_id):
     current_user_email = get_jwt_identity()
-    user = mongo.db.users.find_one({'email': current_user_email})
+    user = identity_cache.get(current_user_email)
     
     # Verify the user ID from the token matches the requested user ID
-    # Convert ObjectId to string for comparison
-    if not user or str(user['_id']) != user_id:
+    if not user or user['id'] != user_id:
         return jsonify({'message': 'Unauthorized to view this history'}), 403
         
     try:
-        # Get user's prediction history
-        predictions = list(mongo.db.predictions.find(
-            # Query by the validated user_id (which is an ObjectId in the predictions collection)
-            {'user_id': user['_id']},
-            {'_id': 0}  # Exclude MongoDB _id from results
-        ).sort('timestamp', -1))  # Sort by timestamp descending
-        
-        # Convert ObjectId in user_id field to string for JSON response if needed
-        for p in predictions:
-            if 'user_id' in p and isinstance(p['user_id'], ObjectId):
-                 p['user_id'] = str(p['user_id'])
-            if 'timestamp' in p and isinstance(p['timestamp'], datetime):
-                 p['timestamp'] = p['timestamp'].isoformat()
-                 
-        return jsonify(predictions)
+        # One page of the user's prediction history, newest first.
+        # ?limit= sets the page size, ?fields= picks the returned fields and
+        # ?cursor= continues from the X-Next-Cursor header of the last page.
+        limit = parse_page_size(request.args.get('limit'))
+        fields = parse_fields(request.args.get('fields'))
+        predictions, next_cursor = history_page(
+            storage, ObjectId(user['id']),
+            limit=limit, cursor=request.args.get('cursor'), fields=fields
+        )
+
+        response = jsonify(predictions)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+            next_args = dict(request.args, limit=limit, cursor=next_cursor)
+            response.headers['Link'] = f'<{request.base_url}?{urlencode(next_args)}>; rel="next"'
+        return response
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Error fetching history: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/export/<user_id>', methods=['GET'])
+@jwt_required()
+def export_user_history(user_id):
+    current_user_email = get_jwt_identity()
+    user = identity_cache.get(current_user_email)
+
+    if not user or user['id'] != user_id:
+        return jsonify({'message': 'Unauthorized to export this history'}), 403
+
+    try:
+        # The whole history (or ?since=/?until=), oldest first, streamed from
+        # a database cursor as ?format=ndjson|csv. ?gzip=1 downloads a .gz
+        # file; otherwise clients sending Accept-Encoding: gzip get it
+        # compressed in transit.
+        fmt = request.args.get('format', 'ndjson')
+        download_gzip = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+        transfer_gzip = not download_gzip and request.accept_encodings['gzip'] > 0
+        chunks = export_history(
+            storage, ObjectId(user['id']),
+            fmt=fmt,
+            fields=parse_export_fields(request.args.get('fields')),
+            since=parse_date(request.args.get('since'), 'since'),
+            until=parse_date(request.args.get('until'), 'until'),
+            compress=download_gzip or transfer_gzip
+        )
+    except InvalidExport as e:
+        return jsonify({'error': str(e)}), 400
+
+    filename = f"history_{user_id}.{fmt}" + ('.gz' if download_gzip else '')
+    response = Response(chunks, mimetype='application/gzip' if download_gzip else FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    if transfer_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.route('/stats/<user_id>', methods=['GET'])
+@jwt_required()
+def get_stats(user_id):
+    current_user_email = get_jwt_identity()
+    user = identity_cache.get(current_user_email)
+
+    if not user or user['id'] != user_id:
+        return jsonify({'message': 'Unauthorized to view these statistics'}), 403
+
+    try:
+        # Totals, average confidence and class counts overall and per month,
+        # read from the pre-aggregated monthly documents
+        return jsonify(summarize(storage.stats_months(ObjectId(user['id']))))
+    except Exception as e:
+        print(f"Error fetching statistics: {e}")
+        return jsonify({'error': str(e)}), 500
+
 # Authentication routes
 @app.route('/api/auth/register', methods=['POST'])
 def register():
@@ -240,14 +747,13 @@ def register():
              
         # Check if user already exists
         print(f"Checking if user exists: {email}") # Log check
-        existing_user = mongo.db.users.find_one({'email': email})
-        if existing_user:
+        if storage.user_exists(email=email):
             print(f"User {email} already exists.") # Log result
             return jsonify({'message': 'User already exists'}), 400
         print(f"User {email} does not exist. Proceeding with registration.") # Log result
 
         # Create new user document
-        hashed_password = generate_password_hash(password)
+        hashed_password = password_hasher.hash(password)
         user_doc = {
             'name': name,
             'email': email,
@@ -257,8 +763,7 @@ def register():
         
         print(f"Attempting to insert user document for {email}") # Log before insert
         try:
-            result = mongo.db.users.insert_one(user_doc)
-            user_id = str(result.inserted_id)
+            user_id = str(storage.insert_user(user_doc))
             print(f"Successfully inserted user {email} with ID: {user_id}") # Log success
         except Exception as db_error:
             print(f"!!! Database insertion error for {email}: {db_error}") # Log specific DB error
@@ -278,6 +783,8 @@ def register():
             }
         }), 201
 
+    except (HasherBusy, FutureTimeoutError):
+        return jsonify({'message': 'Too many authentication requests, try again shortly'}), 503
     except Exception as e:
         print(f"!!! Overall error during registration for {email}: {e}") # Log the actual error
         import traceback
@@ -298,10 +805,16 @@ def login():
         if not all([email, password]):
             return jsonify({'message': 'Missing required fields (email, password)'}), 400
             
-        user = mongo.db.users.find_one({'email': email})
-        if not user or not check_password_hash(user['password'], password):
+        user = storage.find_user(include_password=True, email=email)
+        if not user or not password_hasher.verify(user['password'], password):
             return jsonify({'message': 'Invalid credentials'}), 401
 
+        # Hashes made with an older method or cost are replaced in the background
+        if password_hasher.needs_rehash(user['password']):
+            password_hasher.upgrade(
+                password, lambda new_hash: storage.update_user({'password': new_hash}, _id=user['_id'])
+            )
+
         access_token = create_access_token(identity=email)
         user_id = str(user['_id']) # Get user ID as string
         
@@ -315,6 +828,8 @@ def login():
             }
         })
 
+    except (HasherBusy, FutureTimeoutError):
+        return jsonify({'message': 'Too many authentication requests, try again shortly'}), 503
     except Exception as e:
         print(f"Error during login: {e}") # Log the actual error
         import traceback
@@ -326,17 +841,12 @@ def login():
 def profile():
     try:
         current_user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({'email': current_user_email}, {'password': 0})
+        user = identity_cache.get(current_user_email)
         
         if not user:
             return jsonify({'message': 'User not found'}), 404
 
-        user_id = str(user['_id']) # Get user ID as string
-        return jsonify({
-            'id': user_id, # Add user ID
-            'name': user['name'],
-            'email': user['email']
-        })
+        return jsonify(user)
 
     except Exception as e:
         print(f"Error fetching profile: {e}")
@@ -368,16 +878,14 @@ def update_profile():
         update_fields['updated_at'] = datetime.now(timezone.utc)
         
         print(f"Attempting to update profile for {current_user_email} with: {update_fields}")
-        result = mongo.db.users.update_one(
-            {'email': current_user_email},
-            {'$set': update_fields}
-        )
+        result = storage.update_user(update_fields, email=current_user_email)
+        identity_cache.invalidate(current_user_email)
         
-        if result.matched_count == 0:
+        if result.matched == 0:
              print(f"User not found during update attempt for {current_user_email}")
              return jsonify({'message': 'User not found'}), 404
              
-        if result.modified_count == 0 and result.matched_count == 1:
+        if result.modified == 0 and result.matched == 1:
              print(f"Profile data was the same for {current_user_email}, no update performed.")
              # Return success even if no change, or a specific message
              # return jsonify({'message': 'No changes detected'}), 200 
@@ -385,21 +893,15 @@ def update_profile():
         else:     
             print(f"Profile updated successfully for {current_user_email}")
         
-        # Fetch and return the updated profile data
-        updated_user = mongo.db.users.find_one({'email': current_user_email}, {'password': 0})
+        # Fetch and return the updated profile data (reloads the cache entry)
+        updated_user = identity_cache.get(current_user_email)
         if not updated_user:
              # Should not happen if update matched, but handle defensively
              return jsonify({'message': 'Failed to retrieve updated profile'}), 500
              
-        updated_user_id = str(updated_user['_id'])
         return jsonify({
             'message': 'Profile updated successfully',
-            'user': {
-                 'id': updated_user_id,
-                 'name': updated_user['name'],
-                 'email': updated_user['email']
-                 # Include other fields returned by profile GET route
-            }
+            'user': updated_user
         })
 
     except Exception as e:
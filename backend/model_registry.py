@@ -0,0 +1,387 @@
+"""
+Versioned model registry with hot-swapping.
+
+Reads a TF-Serving style model_config.config (models/model_config.config)
+and serves one version of a model from the <base_path>/<version>/saved_model
+layout. A background poller notices new version directories, loads and warms
+the new version up off the request path, then swaps it in atomically.
+
+Requests take a lease on the engine they start with, so in-flight work
+finishes on the version it began on; a replaced version is unloaded once its
+last lease is released, and work queued elsewhere can hold it until it is done.
+"""
+import collections
+import contextlib
+import gc
+import logging
+import os
+import re
+import threading
+import time
+
+from inference import KerasEngine
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r'\s+|#[^\n]*|([{}:]|\'[^\']*\'|"[^"]*"|[^\s{}:\'"]+)')
+
+
+# ------------------------------------------------------------
+# model_config.config parsing
+# ------------------------------------------------------------
+
+def _tokenize(text):
+    return [match.group(1) for match in _TOKEN.finditer(text) if match.group(1)]
+
+
+def _scalar(token):
+    if token[0] in '\'"':
+        return token[1:-1]
+    try:
+        return int(token)
+    except ValueError:
+        return token
+
+
+def _parse_block(tokens, pos):
+    # Every field maps to a list, since protobuf text fields may repeat
+    fields = {}
+    while pos < len(tokens):
+        key = tokens[pos]
+        if key == '}':
+            return fields, pos + 1
+        pos += 1
+        if tokens[pos] == ':':
+            pos += 1
+        if tokens[pos] == '{':
+            value, pos = _parse_block(tokens, pos + 1)
+        else:
+            value, pos = _scalar(tokens[pos]), pos + 1
+        fields.setdefault(key, []).append(value)
+    return fields, pos
+
+
+def _first(fields, key, default=None):
+    values = fields.get(key)
+    return values[0] if values else default
+
+
+def parse_model_config(text):
+    """
+    Parse the text-format ModelServerConfig used by TF Serving
+
+    Returns a list of dicts with name, base_path, model_platform and
+    version_policy, where version_policy is ('all' | 'latest' | 'specific', arg):
+    num_versions for 'latest', the list of allowed versions for 'specific'.
+    """
+    fields, _ = _parse_block(_tokenize(text), 0)
+    model_list = _first(fields, 'model_config_list', {})
+
+    models = []
+    for config in model_list.get('config', []):
+        policy_fields = _first(config, 'model_version_policy', {})
+        if 'specific' in policy_fields:
+            policy = ('specific', sorted(int(v) for v in _first(policy_fields, 'specific').get('versions', [])))
+        elif 'all' in policy_fields:
+            policy = ('all', None)
+        else:
+            # TF Serving's default policy: the latest single version
+            latest = _first(policy_fields, 'latest', {})
+            policy = ('latest', int(_first(latest, 'num_versions', 1)))
+        models.append({
+            'name': _first(config, 'name'),
+            'base_path': _first(config, 'base_path'),
+            'model_platform': _first(config, 'model_platform', 'tensorflow'),
+            'version_policy': policy,
+        })
+    return models
+
+
+def read_model_config(config_path, name=None):
+    """Load one model's entry (the first one if name is None) from a config file"""
+    with open(config_path, 'r') as f:
+        models = parse_model_config(f.read())
+    for config in models:
+        if name is None or config['name'] == name:
+            return config
+    raise ValueError(f"Model '{name}' is not declared in {config_path}")
+
+
+def resolve_base_path(base_path, config_path, name):
+    """
+    Resolve a config base_path on this machine
+
+    Relative paths are taken from the config file's directory. The container
+    path in the checked-in config (/models/<name>) falls back to the copy next
+    to the config file when it does not exist locally.
+    """
+    config_dir = os.path.dirname(os.path.abspath(config_path))
+    if not os.path.isabs(base_path):
+        return os.path.normpath(os.path.join(config_dir, base_path))
+    if not os.path.isdir(base_path) and os.path.isdir(os.path.join(config_dir, name)):
+        return os.path.join(config_dir, name)
+    return base_path
+
+
+def keras_loader(**load_kwargs):
+    """Loader building a KerasEngine from a SavedModel directory"""
+    def load(path, version):
+        return KerasEngine.from_path(path, version=version, **load_kwargs)
+    return load
+
+
+# ------------------------------------------------------------
+# Registry
+# ------------------------------------------------------------
+
+class ModelRegistry:
+    """
+    Serve one version of a model and hot-swap it when a newer one appears
+
+    Args:
+    - name: model name from the config
+    - base_path: directory holding numeric version directories
+    - loader: callable(saved_model_path, version_tag) returning an engine
+    - version_policy: ('all' | 'latest' | 'specific', arg) from the config
+    - pinned_version: serve exactly this version (overrides the policy)
+    - poll_interval_s: how often to look for new versions (0 disables polling)
+    - warm_up: warm a new version up before it receives traffic
+    """
+
+    def __init__(self, name, base_path, loader=None, version_policy=('latest', 1),
+                 pinned_version=None, poll_interval_s=30.0, warm_up=True):
+        self.name = name
+        self.base_path = base_path
+        self.loader = loader or keras_loader()
+        self.version_policy = version_policy
+        self.pinned_version = int(pinned_version) if pinned_version not in (None, '') else None
+        self.poll_interval = float(poll_interval_s)
+        self.warm_up = warm_up
+
+        self.version = None
+        self._current = None
+        self._leases = {}
+        self._draining = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._swap_lock = threading.Lock()
+        self._swaps = collections.deque(maxlen=20)
+        self._stop = threading.Event()
+        self._poller = None
+
+    @classmethod
+    def from_config(cls, config_path, name=None, **kwargs):
+        config = read_model_config(config_path, name)
+        base_path = resolve_base_path(config['base_path'], config_path, config['name'])
+        return cls(config['name'], base_path, version_policy=config['version_policy'], **kwargs)
+
+    @classmethod
+    def single(cls, engine, name='model'):
+        """Registry around an already loaded engine that never changes"""
+        registry = cls(name, None, loader=lambda path, version: engine, poll_interval_s=0)
+        registry._activate(None, engine)
+        return registry
+
+    # ------------------------------------------------------------
+    # Versions on disk
+    # ------------------------------------------------------------
+
+    def version_path(self, version):
+        return os.path.join(self.base_path, str(version), 'saved_model')
+
+    def available_versions(self):
+        """Numeric version directories that contain a complete SavedModel"""
+        if not self.base_path:
+            return []
+        try:
+            entries = list(os.scandir(self.base_path))
+        except OSError:
+            return []
+        return sorted(
+            int(entry.name) for entry in entries
+            if entry.is_dir() and entry.name.isdigit()
+            and os.path.isfile(os.path.join(self.version_path(entry.name), 'saved_model.pb'))
+        )
+
+    def target_version(self, versions=None):
+        """Version that should be served given the pin, the policy and what is on disk"""
+        versions = self.available_versions() if versions is None else versions
+        if self.pinned_version is not None:
+            return self.pinned_version if self.pinned_version in versions else None
+        kind, allowed = self.version_policy
+        if kind == 'specific':
+            versions = [version for version in versions if version in allowed]
+        # 'all' and 'latest' both serve the newest version; one is enough in-process
+        return versions[-1] if versions else None
+
+    # ------------------------------------------------------------
+    # Loading and swapping
+    # ------------------------------------------------------------
+
+    def _load(self, version):
+        path = self.version_path(version)
+        started = time.perf_counter()
+        engine = self.loader(path, f"{self.name}/{version}")
+        logger.info(f"Loaded {self.name} version {version} from {path} in {time.perf_counter() - started:.2f}s")
+        return engine
+
+    def load_initial(self):
+        """Load the target version synchronously; warm-up is left to the caller"""
+        version = self.target_version()
+        if version is None:
+            raise FileNotFoundError(f"No servable version of '{self.name}' under {self.base_path}")
+        engine = self._load(version)
+        self._activate(version, engine)
+        return engine
+
+    def refresh(self):
+        """
+        Switch to the target version if it differs from the one being served
+
+        The new version is loaded and warmed up before the swap, so requests
+        never wait on it. Returns True if a swap happened.
+        """
+        with self._swap_lock:
+            version = self.target_version()
+            if version is None or version == self.version:
+                return False
+
+            engine = self._load(version)
+            if self.warm_up:
+                try:
+                    engine.warm_up()
+                except Exception as e:
+                    logger.error(f"Warm-up of {self.name} version {version} failed: {str(e)}")
+                    engine.ready = True
+            self._activate(version, engine)
+            return True
+
+    def _activate(self, version, engine):
+        with self._lock:
+            old, old_version = self._current, self.version
+            self._current, self.version = engine, version
+            drain = old is not None and self._leases.get(old, 0) > 0
+            if drain:
+                self._draining[old] = old_version
+            self._swaps.append({'version': version, 'replaced': old_version, 'at': time.time()})
+
+        if old is not None:
+            logger.info(f"Serving {self.name} version {version} (was {old_version})")
+            if not drain:
+                self._unload(old, old_version)
+
+        for listener in list(self._listeners):
+            try:
+                listener(engine)
+            except Exception as e:
+                logger.error(f"Model swap listener failed: {str(e)}")
+
+    def _unload(self, engine, version):
+        close = getattr(engine, 'close', None)
+        if close is not None:
+            close()
+        gc.collect()
+        logger.info(f"Unloaded {self.name} version {version}")
+
+    def add_listener(self, listener):
+        """Call listener(engine) after every swap (e.g. to invalidate caches)"""
+        self._listeners.append(listener)
+
+    # ------------------------------------------------------------
+    # Serving
+    # ------------------------------------------------------------
+
+    @property
+    def current(self):
+        return self._current
+
+    @contextlib.contextmanager
+    def lease(self):
+        """
+        Hold the current engine for the duration of a request
+
+        A swap during the block does not affect the leased engine; it is
+        unloaded after the last lease on it is released.
+        """
+        with self._lock:
+            engine = self._current
+            if engine is None:
+                raise RuntimeError(f"No version of '{self.name}' is loaded")
+            self._leases[engine] = self._leases.get(engine, 0) + 1
+        try:
+            yield engine
+        finally:
+            self._release(engine)
+
+    def hold_until_done(self, engine, future):
+        """
+        Keep a leased engine loaded until future is done
+
+        For work handed to another thread (e.g. a micro-batcher item) that
+        can outlive the request's lease: a request that times out while its
+        item is still queued must not let the engine be unloaded under it.
+        Call this while the lease on engine is still held.
+        """
+        with self._lock:
+            if not self._leases.get(engine):
+                raise RuntimeError('hold_until_done() needs a leased engine')
+            self._leases[engine] += 1
+        future.add_done_callback(lambda _: self._release(engine))
+
+    def _release(self, engine):
+        with self._lock:
+            count = self._leases[engine] - 1
+            if count:
+                self._leases[engine] = count
+                return
+            del self._leases[engine]
+            if engine not in self._draining:
+                return
+            version = self._draining.pop(engine)
+        self._unload(engine, version)
+
+    def predict(self, batch):
+        """Run a batch on whichever version is current"""
+        return self._current.predict(batch)
+
+    # ------------------------------------------------------------
+    # Polling and stats
+    # ------------------------------------------------------------
+
+    def start_polling(self):
+        """Check for new versions every poll_interval_s in a daemon thread"""
+        if self.poll_interval <= 0 or not self.base_path or self._poller is not None:
+            return
+
+        def run():
+            while not self._stop.wait(self.poll_interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logger.error(f"Loading a new version of {self.name} failed: {str(e)}")
+
+        self._poller = threading.Thread(target=run, name='model-registry-poller', daemon=True)
+        self._poller.start()
+
+    def close(self, timeout=5.0):
+        self._stop.set()
+        if self._poller is not None:
+            self._poller.join(timeout=timeout)
+
+    def stats(self):
+        with self._lock:
+            engine = self._current
+            draining = {str(version): self._leases.get(old, 0) for old, version in self._draining.items()}
+            swaps = list(self._swaps)
+        return {
+            'name': self.name,
+            'base_path': self.base_path,
+            'version_policy': self.version_policy[0],
+            'pinned_version': self.pinned_version,
+            'serving_version': self.version,
+            'engine_version': engine.version if engine is not None else None,
+            'available_versions': self.available_versions(),
+            'draining_leases': draining,
+            'poll_interval_s': self.poll_interval,
+            'swaps': swaps,
+        }
@@ -0,0 +1,150 @@
+"""
+Password hashing off the request threads.
+
+Key-derivation functions are meant to be slow, and a burst of logins would
+otherwise take cores and waitress threads from /predict. PasswordHasher runs
+every hash and check on its own small thread pool (hashlib releases the GIL
+while deriving keys), so at most max_workers cores ever do auth work and
+excess requests are refused instead of queuing without bound.
+
+The cost comes from the werkzeug method string (e.g. 'scrypt:65536:8:1' or
+'pbkdf2:sha256:1000000'); by default werkzeug's own default is used. Hashes
+made with the same method at a lower cost are upgraded after the next
+successful login; hashes made with a different method are left alone, so
+changing the method never silently downgrades existing users.
+"""
+import inspect
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+AUTH_CPU_SECONDS = Histogram(
+    'abdos_auth_cpu_seconds',
+    'CPU time spent hashing and checking passwords',
+    ['operation'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+
+class HasherBusy(RuntimeError):
+    """Raised when too many password operations are already waiting"""
+
+
+def hash_method(stored_hash):
+    """Method and cost a werkzeug hash was made with, e.g. 'pbkdf2:sha256:600000'"""
+    return stored_hash.split('$', 1)[0]
+
+
+def default_method():
+    """werkzeug's default hashing method ('scrypt' in werkzeug 3)"""
+    return inspect.signature(generate_password_hash).parameters['method'].default
+
+
+def parse_method(method):
+    """
+    (algorithm, cost) of a werkzeug method string, filling in werkzeug's defaults
+
+    'scrypt' -> ('scrypt', (32768, 8, 1)), 'pbkdf2:sha256:600000' ->
+    ('pbkdf2:sha256', (600000,)). Costs of one algorithm compare with <.
+    """
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        return name, tuple(int(arg) for arg in args) if args else (2 ** 15, 8, 1)
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f'{name}:{hash_name}', (iterations,)
+    return method, ()
+
+
+class PasswordHasher:
+    """
+    Bounded executor for password hashing
+
+    Args:
+    - method: werkzeug hashing method including its cost parameters
+      (None for werkzeug's default)
+    - max_workers: threads (and so cores) doing key derivation at once
+    - max_pending: operations running or queued before HasherBusy is raised
+    - timeout: longest a request waits for its operation
+    """
+
+    def __init__(self, method=None, max_workers=2, max_pending=64, timeout=10.0):
+        self.method = method or default_method()
+        self._algorithm, self._cost = parse_method(self.method)
+        self.max_workers = int(max_workers)
+        self.timeout = float(timeout)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(int(max_pending))
+        self._lock = threading.Lock()
+        self._counts = {'hashes': 0, 'checks': 0, 'rehashes': 0, 'rejected': 0}
+
+    def _timed(self, operation, fn, *args):
+        started = time.thread_time()
+        try:
+            return fn(*args)
+        finally:
+            AUTH_CPU_SECONDS.labels(operation=operation).observe(time.thread_time() - started)
+
+    def _submit(self, operation, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counts['rejected'] += 1
+            raise HasherBusy('Too many authentication requests, try again shortly')
+        future = self._executor.submit(self._timed, operation, fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def hash(self, password):
+        """Hash a new password with the configured method (blocks for the result)"""
+        with self._lock:
+            self._counts['hashes'] += 1
+        return self._submit('hash', generate_password_hash, password, self.method).result(self.timeout)
+
+    def verify(self, stored_hash, password):
+        """Check a password against its stored hash (blocks for the result)"""
+        with self._lock:
+            self._counts['checks'] += 1
+        return self._submit('verify', check_password_hash, stored_hash, password).result(self.timeout)
+
+    def needs_rehash(self, stored_hash):
+        """True if stored_hash uses the configured algorithm at a lower cost"""
+        algorithm, cost = parse_method(hash_method(stored_hash))
+        return algorithm == self._algorithm and cost < self._cost
+
+    def upgrade(self, password, save):
+        """
+        Rehash with the current method in the background and pass the result to save()
+
+        Call after a successful verify() when needs_rehash() is true; the
+        login response does not wait for it.
+        """
+        def rehash():
+            new_hash = generate_password_hash(password, self.method)
+            try:
+                save(new_hash)
+                with self._lock:
+                    self._counts['rehashes'] += 1
+            except Exception as e:
+                logger.error(f"Could not store upgraded password hash: {str(e)}")
+
+        try:
+            self._submit('rehash', rehash)
+        except HasherBusy:
+            # Upgrading can wait for a quieter login
+            pass
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        return dict(counts, method=self.method, max_workers=self.max_workers)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,303 @@
+"""
+Content-addressed cache of model outputs.
+
+Entries are keyed by the SHA-256 of the raw uploaded bytes plus the model
+version, so re-uploads of the same photo skip decode, resize and inference.
+The in-process tier is a bounded LRU with a TTL. An optional on-disk tier
+(one small JSON file per entry under <disk_dir>/<model version>/) lets several
+worker processes share each other's hits. It is bounded by a periodic sweep
+that deletes expired entries (of any version) and then the oldest ones
+beyond disk_max_entries.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CallbackCounter, Gauge
+
+logger = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def digest_bytes(data):
+    """SHA-256 hex digest of an in-memory upload"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def digest_stream(stream):
+    """SHA-256 hex digest of a seekable upload stream, rewound afterwards"""
+    sha = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(_CHUNK_SIZE), b''):
+        sha.update(chunk)
+    stream.seek(0)
+    return sha.hexdigest()
+
+
+def _safe_dirname(version):
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', str(version))
+
+
+class PredictionCache:
+    """
+    Bounded LRU + TTL cache of model output rows keyed by image digest
+
+    Args:
+    - max_entries: in-memory entries kept (0 disables the cache)
+    - ttl_seconds: entry lifetime in both tiers
+    - disk_dir: optional directory for the shared on-disk tier
+    - model_version: version the cached outputs belong to
+    - disk_max_entries: files the disk tier keeps after a sweep (None: no limit)
+    - sweep_interval_s: least time between two sweeps of the disk tier by
+      this process; a put that finds it elapsed starts one in the background
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, disk_dir=None, model_version=None,
+                 disk_max_entries=100000, sweep_interval_s=300):
+        self.max_entries = int(max_entries)
+        self.ttl = float(ttl_seconds)
+        self.disk_dir = disk_dir
+        self.model_version = model_version
+        self.disk_max_entries = int(disk_max_entries) if disk_max_entries is not None else None
+        self.sweep_interval = float(sweep_interval_s)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0,
+                        'disk_evictions': 0}
+        self._last_sweep = time.time()
+        self._sweeping = False
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    # ------------------------------------------------------------
+    # Lookup / store
+    # ------------------------------------------------------------
+
+    def _disk_path(self, digest, version):
+        return os.path.join(self.disk_dir, _safe_dirname(version), digest[:2], f"{digest}.json")
+
+    def get(self, digest):
+        """Return the cached output row (list of floats) or None"""
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self._lock:
+            version = self.model_version
+            entry = self._entries.get(digest)
+            if entry is not None:
+                stored_at, value = entry
+                if now - stored_at <= self.ttl:
+                    self._entries.move_to_end(digest)
+                    self._counts['memory_hits'] += 1
+                    return value
+                del self._entries[digest]
+
+        value = self._read_disk(digest, version, now)
+        with self._lock:
+            if value is not None and version == self.model_version:
+                self._counts['disk_hits'] += 1
+                self._store_memory(digest, value, now)
+                return value
+            self._counts['misses'] += 1
+        return None
+
+    def put(self, digest, value, version=None):
+        """
+        Cache an output row for an image digest
+
+        version is the model version that produced the value; results from a
+        version that has since been replaced are dropped.
+        """
+        if not self.enabled:
+            return
+        value = [float(v) for v in value]
+        now = time.time()
+        with self._lock:
+            if version is not None and version != self.model_version:
+                return
+            version = self.model_version
+            self._store_memory(digest, value, now)
+            sweep = bool(self.disk_dir) and not self._sweeping and now - self._last_sweep >= self.sweep_interval
+            if sweep:
+                self._sweeping = True
+        self._write_disk(digest, version, value)
+        if sweep:
+            threading.Thread(target=self._background_sweep, name='prediction-cache-sweep', daemon=True).start()
+
+    def _store_memory(self, digest, value, now):
+        self._entries[digest] = (now, value)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counts['evictions'] += 1
+
+    # ------------------------------------------------------------
+    # Disk tier
+    # ------------------------------------------------------------
+
+    def _read_disk(self, digest, version, now):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(digest, version)
+        try:
+            if now - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, digest, version, value):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(digest, version)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so other processes never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(value, f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not write prediction cache entry {digest}: {str(e)}")
+
+    def sweep_disk(self, now=None):
+        """
+        Delete expired disk entries of every version, then the oldest beyond disk_max_entries
+
+        Safe to run from several processes at once. Directories left empty
+        (e.g. of replaced model versions) are removed. Returns the number of
+        files deleted.
+        """
+        if not self.disk_dir:
+            return 0
+        now = time.time() if now is None else now
+        entries = []
+        removed = 0
+        for root, _, files in os.walk(self.disk_dir, topdown=False):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                    # Expired entries, and temp files a crashed write left behind
+                    if now - mtime > self.ttl:
+                        os.remove(path)
+                        removed += 1
+                    elif name.endswith('.json'):
+                        entries.append((mtime, path))
+                except OSError:
+                    continue
+            if root != self.disk_dir:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+
+        if self.disk_max_entries is not None and len(entries) > self.disk_max_entries:
+            entries.sort()
+            for _, path in entries[:len(entries) - self.disk_max_entries]:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    continue
+
+        with self._lock:
+            self._counts['disk_evictions'] += removed
+        return removed
+
+    def _background_sweep(self):
+        try:
+            removed = self.sweep_disk()
+            if removed:
+                logger.info(f"Prediction cache sweep deleted {removed} disk entries")
+        except Exception as e:
+            logger.warning(f"Prediction cache sweep failed: {str(e)}")
+        finally:
+            with self._lock:
+                self._sweeping = False
+                self._last_sweep = time.time()
+
+    # ------------------------------------------------------------
+    # Invalidation and stats
+    # ------------------------------------------------------------
+
+    def set_model_version(self, version):
+        """
+        Switch to a new model version, dropping the in-memory entries of the old one
+
+        Its disk entries stay: other worker processes may still serve that
+        version from the shared tier. The sweep removes them once they expire.
+        """
+        with self._lock:
+            if version == self.model_version:
+                return
+            old_version = self.model_version
+            self.model_version = version
+            self._entries.clear()
+            self._counts['invalidations'] += 1
+
+        logger.info(f"Prediction cache invalidated: model version {old_version} -> {version}")
+
+    def __len__(self):
+        """Entries currently held in memory"""
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+            size = len(self._entries)
+        hits = counts['memory_hits'] + counts['disk_hits']
+        lookups = hits + counts['misses']
+        return dict(
+            counts,
+            enabled=self.enabled,
+            model_version=self.model_version,
+            entries=size,
+            max_entries=self.max_entries,
+            ttl_seconds=self.ttl,
+            disk_tier=bool(self.disk_dir),
+            disk_max_entries=self.disk_max_entries,
+            hit_ratio=round(hits / lookups, 4) if lookups else 0.0,
+        )
+
+
+def register_cache_metrics(cache):
+    """Expose a cache's lookup counters and size on /metrics"""
+    def lookups():
+        stats = cache.stats()
+        return {
+            ('memory_hit',): stats['memory_hits'],
+            ('disk_hit',): stats['disk_hits'],
+            ('miss',): stats['misses'],
+        }
+
+    CallbackCounter(
+        'abdos_prediction_cache_lookups_total', 'Prediction cache lookups by result',
+        lookups, ['result']
+    )
+    Gauge('abdos_prediction_cache_entries', 'Entries in the in-memory prediction cache').set_function(
+        lambda: len(cache)
+    )
@@ -0,0 +1,150 @@
+"""
+Pre-aggregated prediction statistics per user and month.
+
+Every batch of history records written also increments one summary
+document per (user, month):
+
+    {user_id, month: 'YYYY-MM', count, confidence_sum, classes: {label: count}, version}
+
+so the statistics endpoint reads a handful of small documents instead of
+scanning the user's history. Every increment also bumps version.
+rebuild_stats() recomputes the summaries from raw history in one streaming
+pass, e.g. after a failed increment or a change to what is counted.
+"""
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+def month_key(timestamp):
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc)
+    return f"{timestamp.year:04d}-{timestamp.month:02d}"
+
+
+def month_range(month):
+    """[first instant, first instant of the next month) of a 'YYYY-MM' key, in UTC"""
+    year, number = (int(part) for part in month.split('-'))
+    start = datetime(year, number, 1, tzinfo=timezone.utc)
+    end = datetime(year + number // 12, number % 12 + 1, 1, tzinfo=timezone.utc)
+    return start, end
+
+
+def _label_key(label):
+    # Field names may not contain '.' or start with '$'
+    return str(label).replace('.', '_').lstrip('$') or 'unknown'
+
+
+def _new_delta():
+    return {'count': 0, 'confidence_sum': 0.0, 'classes': defaultdict(int)}
+
+
+def aggregate_predictions(records, deltas=None):
+    """Fold history records into {(user_id, month): delta} counters"""
+    deltas = {} if deltas is None else deltas
+    for record in records:
+        if record.get('user_id') is None or record.get('timestamp') is None:
+            continue
+        key = (record['user_id'], month_key(record['timestamp']))
+        delta = deltas.get(key)
+        if delta is None:
+            delta = deltas[key] = _new_delta()
+        delta['count'] += 1
+        delta['confidence_sum'] += float(record.get('confidence') or 0.0)
+        delta['classes'][_label_key(record.get('label', record.get('predicted_class')))] += 1
+    return deltas
+
+
+def summarize(months):
+    """
+    Statistics response from a user's month documents (oldest month first)
+
+    Confidence values are the percentages stored with each prediction.
+    """
+    totals = defaultdict(int)
+    count = 0
+    confidence_sum = 0.0
+    monthly = []
+    for doc in months:
+        count += doc['count']
+        confidence_sum += doc['confidence_sum']
+        for label, n in doc.get('classes', {}).items():
+            totals[label] += n
+        monthly.append({
+            'month': doc['month'],
+            'count': doc['count'],
+            'average_confidence': round(doc['confidence_sum'] / doc['count'], 2) if doc['count'] else None,
+            'by_class': dict(doc.get('classes', {})),
+        })
+    return {
+        'total_predictions': count,
+        'average_confidence': round(confidence_sum / count, 2) if count else None,
+        'by_class': dict(sorted(totals.items(), key=lambda item: -item[1])),
+        'monthly': monthly,
+    }
+
+
+def _aggregate_pass(storage, user_id, batch_size, since=None, until=None, deltas=None):
+    deltas = {} if deltas is None else deltas
+    read = 0
+    for record in storage.iter_predictions(user_id=user_id, batch_size=batch_size, since=since, until=until,
+                                           fields=('user_id', 'timestamp', 'confidence', 'label')):
+        aggregate_predictions((record,), deltas)
+        read += 1
+        if read % 100000 == 0:
+            logger.info(f"Rebuilding statistics: {read} predictions read")
+    return deltas, read
+
+
+def rebuild_stats(storage, user_id=None, batch_size=1000, settle_seconds=5.0, max_rounds=3):
+    """
+    Recompute the summaries from raw history in one streaming pass
+
+    Safe to run while the servers write history. The summary versions are
+    read first and the pass only counts predictions made before that
+    moment. A summary is then replaced (or, without history left, deleted)
+    only if no increment changed its version in the meantime; months that
+    did change are recomputed on their own, up to max_rounds passes in
+    all, and are otherwise left with their live counts. settle_seconds is
+    waited before replacing, so the increment of a prediction the pass
+    already read has landed (and shows up as a change) by then; a batch
+    whose increment is delayed longer, e.g. by write retries, can still be
+    counted twice.
+
+    Memory grows with the number of (user, month) pairs, not with the
+    number of predictions. Returns (predictions read, summaries written).
+    """
+    read = written = 0
+    pending = None  # None: every month of user_id (or of everyone)
+    for round_number in range(max_rounds):
+        # Versions first: an increment after this point changes the version
+        # of its summary, whether or not the pass below sees its prediction
+        if pending is None:
+            versions = storage.stats_versions(user_id)
+            until = datetime.now(timezone.utc)
+            deltas, count = _aggregate_pass(storage, user_id, batch_size, until=until)
+        else:
+            versions = storage.stats_versions(keys=pending)
+            until = datetime.now(timezone.utc)
+            deltas, count = {}, 0
+            for pending_user, month in sorted(pending, key=lambda key: (str(key[0]), key[1])):
+                since, month_end = month_range(month)
+                _, month_count = _aggregate_pass(storage, pending_user, batch_size, since=since,
+                                                 until=min(month_end, until), deltas=deltas)
+                count += month_count
+        read += count
+        if settle_seconds:
+            time.sleep(settle_seconds)
+        changed = storage.replace_stats(deltas, versions)
+        written += sum(1 for key in deltas if key not in changed)
+        if not changed:
+            break
+        logger.info(f"Rebuilding statistics: {len(changed)} summaries changed during pass {round_number + 1}")
+        pending = changed
+    else:
+        logger.warning(f"Left {len(changed)} summaries with their live counts, they kept changing during "
+                       f"{max_rounds} passes: {sorted((str(uid), month) for uid, month in changed)}")
+    return read, written
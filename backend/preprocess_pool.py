@@ -0,0 +1,142 @@
+"""
+Process-pool image preprocessing.
+
+Decode, resize and normalize hold the GIL for most of their runtime, so a
+thread-per-request server cannot spread them over several cores. This pool
+runs them in worker processes instead. Each worker writes its result
+directly into a slot of one shared-memory array, so only the raw upload bytes
+and a slot number cross the process boundary - the float32 arrays are never
+pickled. Inference stays in the main process.
+"""
+import atexit
+import io
+import logging
+import multiprocessing
+import queue
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from preprocessing import TARGET_SIZE, preprocess_image
+
+logger = logging.getLogger(__name__)
+
+# Set in each worker process by _init_worker
+_worker_shm = None
+_worker_buffer = None
+_worker_options = None
+
+
+def _init_worker(shm_name, shape, size, normalization, resample):
+    global _worker_shm, _worker_buffer, _worker_options
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_buffer = np.ndarray(shape, dtype=np.float32, buffer=_worker_shm.buf)
+    _worker_options = {'size': size, 'normalization': normalization, 'resample': resample}
+
+
+def _preprocess_into_slot(image_bytes, slot):
+    preprocess_image(io.BytesIO(image_bytes), out=_worker_buffer[slot], **_worker_options)
+    return slot
+
+
+def _mp_context():
+    if sys.platform != 'win32':
+        # Fork workers from a small server process that has only imported this
+        # module, not the Flask app and TensorFlow
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['preprocess_pool'])
+        return context
+    # Windows only has spawn; workers re-import the main module
+    return multiprocessing.get_context('spawn')
+
+
+class PreprocessBusy(RuntimeError):
+    """Raised when no shared-memory slot frees up within the timeout"""
+
+
+class PreprocessPool:
+    """
+    Preprocess raw image bytes in worker processes via shared memory
+
+    Args:
+    - processes: number of worker processes
+    - slots: images that can be in flight at once (defaults to 2 per worker)
+    - size: (width, height) of the model input
+    - normalization: see preprocessing.NORMALIZATIONS
+    - resample: final resize filter, see preprocessing.RESAMPLING
+    """
+
+    def __init__(self, processes, slots=None, size=TARGET_SIZE, normalization='symmetric',
+                 resample='bicubic'):
+        self.processes = int(processes)
+        self.slots = int(slots or self.processes * 2)
+        width, height = size
+        shape = (self.slots, height, width, 3)
+
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        )
+        self._buffer = np.ndarray(shape, dtype=np.float32, buffer=self._shm.buf)
+        self._free_slots = queue.Queue()
+        for slot in range(self.slots):
+            self._free_slots.put(slot)
+
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=_mp_context(),
+            initializer=_init_worker,
+            initargs=(self._shm.name, shape, tuple(size), normalization, resample)
+        )
+        self._closed = False
+        atexit.register(self.close)
+        logger.info(f"Preprocessing pool started: {self.processes} processes, {self.slots} shared slots")
+
+    def preprocess(self, image_bytes, timeout=None):
+        """
+        Preprocess one image in a worker process
+
+        Blocks until a shared-memory slot is free and the worker is done.
+        Returns a (H, W, 3) float32 array owned by the caller. timeout bounds
+        both waits together: PreprocessBusy is raised if no slot frees up in
+        time, concurrent.futures.TimeoutError if the worker does not finish.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            slot = self._free_slots.get(timeout=timeout)
+        except queue.Empty:
+            raise PreprocessBusy('Too many images being preprocessed, try again shortly') from None
+        try:
+            future = self._executor.submit(_preprocess_into_slot, image_bytes, slot)
+        except Exception:
+            self._free_slots.put(slot)
+            raise
+        try:
+            future.result(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            # The worker may still write to the slot; recycle it only once it is done
+            future.add_done_callback(lambda _: self._free_slots.put(slot))
+            raise
+        except Exception:
+            self._free_slots.put(slot)
+            raise
+
+        try:
+            return self._buffer[slot].copy()
+        finally:
+            self._free_slots.put(slot)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        # Drop our view before releasing the segment
+        self._buffer = None
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,94 @@
+"""
+Image preprocessing for the 224x224 model input.
+
+JPEG uploads are decoded with PIL's draft mode, which lets libjpeg scale the
+image down by 1/2, 1/4 or 1/8 in the DCT domain while decoding. Only the
+nearest scale at or above the target size is decoded, so a 12 MP phone photo
+is never fully materialised. The final resize to the exact input size uses
+the same filter each server used before (see RESAMPLING), and the pixels
+are normalized straight into a float32 buffer.
+"""
+import numpy as np
+from PIL import Image
+
+from metrics import stage
+
+TARGET_SIZE = (224, 224)
+
+# (scale, offset) applied as pixel * scale + offset
+NORMALIZATIONS = {
+    # [-1, 1], what MobileNetV2 expects
+    'symmetric': (1.0 / 127.5, -1.0),
+    # [0, 1]
+    'unit': (1.0 / 255.0, 0.0),
+}
+
+# Filters for the final resize. Each server keeps the one its model was
+# validated with: bicubic (PIL's default) for the backend, lanczos for the
+# model server.
+RESAMPLING = {
+    'bicubic': Image.BICUBIC,
+    'lanczos': Image.LANCZOS,
+    'bilinear': Image.BILINEAR,
+}
+
+
+def load_image(source, size=TARGET_SIZE, resample='bicubic'):
+    """
+    Decode an image at (roughly) the resolution needed and resize it to size
+
+    Args:
+    - source: file path, file object or upload stream
+    - size: (width, height) of the result
+    - resample: name of the filter for the final resize (see RESAMPLING)
+    """
+    img = source if isinstance(source, Image.Image) else Image.open(source)
+
+    with stage('decode'):
+        if img.format == 'JPEG':
+            # Picks the smallest 1/2^n scale that is still >= size in both dimensions
+            img.draft('RGB', size)
+
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        else:
+            img.load()
+
+    if img.size != tuple(size):
+        with stage('resize'):
+            img = img.resize(size, RESAMPLING[resample])
+    return img
+
+
+def preprocess_image(source, size=TARGET_SIZE, normalization='symmetric', out=None,
+                     resample='bicubic'):
+    """
+    Decode, resize and normalize one image into a float32 (H, W, 3) array
+
+    out may be a preallocated float32 array of that shape (for example one row
+    of a batch buffer); it is filled in place and returned.
+    """
+    scale, offset = NORMALIZATIONS[normalization]
+    img = load_image(source, size=size, resample=resample)
+
+    with stage('normalize'):
+        pixels = np.asarray(img, dtype=np.uint8)
+        if out is None:
+            out = np.empty(pixels.shape, dtype=np.float32)
+        np.multiply(pixels, np.float32(scale), out=out, casting='unsafe')
+        if offset:
+            out += np.float32(offset)
+    return out
+
+
+def preprocess_image_reference(source, size=TARGET_SIZE, normalization='symmetric',
+                               resample='bicubic'):
+    """
+    The original full-resolution path: decode everything, convert, resize once
+
+    Kept for parity checks and benchmarks against preprocess_image().
+    """
+    scale, offset = NORMALIZATIONS[normalization]
+    img = Image.open(source).convert('RGB')
+    img = img.resize(size, RESAMPLING[resample])
+    return np.array(img, dtype=np.float32) * np.float32(scale) + np.float32(offset)
@@ -0,0 +1,48 @@
+"""
+Recompute the per-user monthly prediction statistics from raw history.
+
+Streams the predictions collection once and replaces the prediction_stats
+documents (of one user, or everyone) with the result. Run it after history
+was written while the statistics update failed, or after changing what is
+counted. The API can keep serving: documents the history writer changes
+during the pass are recounted on their own (see rebuild_stats()). Uses the
+same STORAGE_BACKEND / MONGO_* settings as model_api.py.
+
+Usage:
+    python rebuild_stats.py
+    python rebuild_stats.py --user 6650c0ffee0123456789abcd
+"""
+import argparse
+import logging
+
+from bson.objectid import ObjectId
+
+from prediction_stats import rebuild_stats
+from storage import storage_from_env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user', default=None, help='only rebuild this user id')
+    parser.add_argument('--batch-size', type=int, default=1000, help='predictions fetched per round trip')
+    parser.add_argument('--settle-seconds', type=float, default=5.0,
+                        help='wait for in-flight increments before replacing documents')
+    parser.add_argument('--max-rounds', type=int, default=3,
+                        help='passes over months that changed while they were being counted')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    storage = storage_from_env()
+    try:
+        storage.ensure_indexes()
+        user_id = ObjectId(args.user) if args.user else None
+        read, written = rebuild_stats(storage, user_id=user_id, batch_size=args.batch_size,
+                                      settle_seconds=args.settle_seconds, max_rounds=args.max_rounds)
+        print(f"Read {read} predictions, wrote {written} monthly summaries to prediction_stats")
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
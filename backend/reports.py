@@ -0,0 +1,152 @@
+"""
+Disease reports for the model server's /api/generate-report(s) endpoints.
+
+The catalog is built once at import and is read-only: each report is a
+mappingproxy with its recommendations as a tuple. Rendering a report copies
+only the top-level mapping and adds the confidence, so requests never modify
+(or race on) shared data.
+"""
+from types import MappingProxyType
+
+
+class InvalidReportRequest(ValueError):
+    """A report request that cannot be rendered"""
+
+
+def _freeze_report(report):
+    return MappingProxyType(dict(report, recommendations=tuple(report['recommendations'])))
+
+
+REPORT_CATALOG = MappingProxyType({key: _freeze_report(report) for key, report in {
+    'actinic keratoses': {
+        'diagnosis': 'Actinic Keratoses',
+        'description': 'Precancerous skin lesions caused by sun damage detected.',
+        'recommendations': [
+            'Consult with a dermatologist',
+            'Consider cryotherapy or topical treatments',
+            'Regular skin monitoring required',
+            'Sun protection measures essential'
+        ]
+    },
+    'basal cell carcinoma': {
+        'diagnosis': 'Basal Cell Carcinoma',
+        'description': 'Most common type of skin cancer detected.',
+        'recommendations': [
+            'Immediate dermatologist consultation required',
+            'Biopsy confirmation needed',
+            'Surgical removal likely necessary',
+            'Regular follow-up appointments essential'
+        ]
+    },
+    'benign keratosis': {
+        'diagnosis': 'Benign Keratosis',
+        'description': 'Non-cancerous skin growth detected.',
+        'recommendations': [
+            'Regular monitoring recommended',
+            'Consider removal if causing discomfort',
+            'No immediate treatment required',
+            'Maintain regular skin checks'
+        ]
+    },
+    'dermatofibroma': {
+        'diagnosis': 'Dermatofibroma',
+        'description': 'Common benign skin growth detected.',
+        'recommendations': [
+            'No treatment necessary unless symptomatic',
+            'Monitor for any changes',
+            'Consider removal if causing discomfort',
+            'Regular skin checks recommended'
+        ]
+    },
+    'melanoma': {
+        'diagnosis': 'Melanoma',
+        'description': 'Serious type of skin cancer detected.',
+        'recommendations': [
+            'Urgent dermatologist consultation required',
+            'Immediate biopsy confirmation needed',
+            'Surgical intervention likely necessary',
+            'Regular monitoring and follow-up essential'
+        ]
+    },
+    'melanocytic nevi': {
+        'diagnosis': 'Melanocytic Nevi',
+        'description': 'Common mole detected.',
+        'recommendations': [
+            'Regular monitoring recommended',
+            'Consider removal if changing in appearance',
+            'No immediate treatment required',
+            'Maintain regular skin checks'
+        ]
+    },
+    'vascular lesions': {
+        'diagnosis': 'Vascular Lesions',
+        'description': 'Blood vessel-related skin marks detected.',
+        'recommendations': [
+            'Consult with dermatologist',
+            'Consider laser treatment if desired',
+            'Monitor for any changes',
+            'No immediate treatment required'
+        ]
+    }
+}.items()})
+
+# Returned for a disease that is not in the catalog
+UNKNOWN_REPORT = _freeze_report({
+    'diagnosis': 'Unknown Condition',
+    'description': 'The detected condition requires further evaluation.',
+    'recommendations': [
+        'Consult with a dermatologist',
+        'Further diagnostic tests may be needed',
+        'Regular monitoring recommended'
+    ]
+})
+
+
+def generate_disease_report(disease, confidence):
+    """Report for a disease name (case-insensitive) with the confidence added, as a new dict"""
+    template = REPORT_CATALOG.get(disease.lower().strip(), UNKNOWN_REPORT)
+    report = dict(template)
+    report['confidence'] = f"{confidence:.2%}"
+    return report
+
+
+def generate_disease_reports(items, max_items):
+    """
+    Reports for a list of {"disease": ..., "confidence": ...} items, in order
+
+    Raises InvalidReportRequest, naming the first bad item, before any
+    report is rendered.
+    """
+    if not isinstance(items, list) or not items:
+        raise InvalidReportRequest('items must be a non-empty list')
+    if len(items) > max_items:
+        raise InvalidReportRequest(f'Too many items: {len(items)} sent, at most {max_items} per request')
+
+    parsed = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('disease'):
+            raise InvalidReportRequest(f'Disease not specified for item {index}')
+        try:
+            parsed.append((item['disease'], float(item.get('confidence', 0))))
+        except (TypeError, ValueError):
+            raise InvalidReportRequest(f'Invalid confidence for item {index}')
+    return [generate_disease_report(disease, confidence) for disease, confidence in parsed]
+
+
+def report_response(payload, max_age_s):
+    """
+    JSON response with an ETag of its content and private client cache headers
+
+    A request whose If-None-Match already holds that ETag gets an empty 304.
+    """
+    from flask import jsonify, request
+
+    response = jsonify(payload)
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.max_age = max_age_s
+    etag, _ = response.get_etag()
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        response.set_data(b'')
+    return response
@@ -0,0 +1,120 @@
+"""
+Re-run stored prediction images through another model version.
+
+Walks prediction history (one user's, or everyone's), streams each stored
+upload back out of the image store in chunks, and classifies it with the
+given model. Prints how many predictions change class and, with --output,
+writes one NDJSON line per changed prediction. Needs IMAGE_STORE (and the
+STORAGE_BACKEND / MONGO_* settings) as used by model_api.py when the
+predictions were made.
+
+Usage:
+    python rescore_history.py --model models/skin_condition/2/saved_model
+    python rescore_history.py --model new_model.h5 --user 6650c0ffee0123456789abcd --output changes.ndjson
+"""
+import argparse
+import json
+import sys
+from contextlib import closing
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from blob_store import blob_store_from_env
+from export import parse_date
+from inference import load_engine
+from preprocessing import preprocess_image
+from storage import storage_from_env
+
+
+def rescore(storage, image_store, engine, user_id=None, since=None, until=None, batch_size=32, limit=None):
+    """
+    Yield (record, new_class, new_confidence) for predictions with a stored image
+
+    Images are decoded batch_size at a time; only the current batch is held
+    in memory.
+    """
+    fields = ('user_id', 'timestamp', 'predicted_class', 'confidence', 'image_sha256')
+    records = (
+        record for record in storage.iter_predictions(user_id=user_id, fields=fields, since=since, until=until)
+        if record.get('image_sha256')
+    )
+
+    batch, arrays = [], []
+
+    def run():
+        outputs = np.asarray(engine.predict(np.stack(arrays)), dtype=np.float32)
+        for record, output in zip(batch, outputs):
+            probabilities = output / np.sum(output)
+            new_class = int(np.argmax(probabilities))
+            yield record, new_class, float(probabilities[new_class] * 100)
+        batch.clear()
+        arrays.clear()
+
+    for seen, record in enumerate(records):
+        if limit is not None and seen >= limit:
+            break
+        try:
+            with closing(image_store.open(record['image_sha256'])) as stream:
+                arrays.append(preprocess_image(stream, normalization='symmetric'))
+        except Exception as e:
+            print(f"Skipping {record['_id']}: {e}", file=sys.stderr)
+            continue
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield from run()
+    if batch:
+        yield from run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='.h5 file or SavedModel directory to score with')
+    parser.add_argument('--user', default=None, help='only re-score this user id')
+    parser.add_argument('--since', default=None, help='first timestamp included (ISO date or datetime, UTC)')
+    parser.add_argument('--until', default=None, help='first timestamp excluded (ISO date or datetime, UTC)')
+    parser.add_argument('--batch-size', type=int, default=32, help='images per forward pass')
+    parser.add_argument('--limit', type=int, default=None, help='stop after this many predictions')
+    parser.add_argument('--output', default=None, help='NDJSON file for predictions whose class changed')
+    args = parser.parse_args()
+
+    storage = storage_from_env()
+    image_store = blob_store_from_env(storage)
+    if image_store is None:
+        parser.error('IMAGE_STORE is not configured, there are no stored images to re-score')
+    engine = load_engine(args.model)
+    output = open(args.output, 'w') if args.output else None
+
+    scored = changed = 0
+    try:
+        for record, new_class, new_confidence in rescore(
+                storage, image_store, engine,
+                user_id=ObjectId(args.user) if args.user else None,
+                since=parse_date(args.since, '--since'),
+                until=parse_date(args.until, '--until'),
+                batch_size=args.batch_size,
+                limit=args.limit):
+            scored += 1
+            if new_class == record['predicted_class']:
+                continue
+            changed += 1
+            if output is not None:
+                output.write(json.dumps({
+                    'id': str(record['_id']),
+                    'image_sha256': record['image_sha256'],
+                    'predicted_class': record['predicted_class'],
+                    'confidence': record['confidence'],
+                    'new_predicted_class': new_class,
+                    'new_confidence': round(new_confidence, 2),
+                }) + '\n')
+    finally:
+        if output is not None:
+            output.close()
+        storage.close()
+
+    share = f" ({changed / scored:.1%})" if scored else ''
+    print(f"Re-scored {scored} predictions, {changed} changed class{share}")
+
+
+if __name__ == '__main__':
+    main()
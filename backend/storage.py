@@ -0,0 +1,710 @@
+"""
+Storage for users and prediction history.
+
+The API servers talk to a Storage object instead of raw collections, so the
+database can be tuned or swapped by configuration:
+
+- MongoStorage: pooled MongoClient with configurable pool size, timeouts
+  and write concern
+- MemoryStorage: everything in process memory with the same semantics
+  (ObjectId ids, copies on read and write, newest-first keyset pages), for
+  load tests and benchmarks without a database
+
+STORAGE_BACKEND=mongo|memory picks one in storage_from_env().
+"""
+import bisect
+import copy
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from bson.objectid import ObjectId
+
+import history_buckets
+
+logger = logging.getLogger(__name__)
+
+UpdateOutcome = namedtuple('UpdateOutcome', ['matched', 'modified'])
+
+# Serves the user_id filter and the (timestamp, _id) sort of history pages from one index
+HISTORY_INDEX = [('user_id', 1), ('timestamp', -1), ('_id', -1)]
+
+_USER_KEYS = ('_id', 'email', 'username')
+
+_DUPLICATE_KEY = 11000
+
+
+def _user_filter(by):
+    if len(by) != 1 or next(iter(by)) not in _USER_KEYS:
+        raise ValueError(f"Look users up by exactly one of {', '.join(_USER_KEYS)}")
+    return dict(by)
+
+
+class Storage(ABC):
+    """
+    Interface shared by the storage backends
+
+    Users are looked up by exactly one of _id, email or username. Returned
+    documents never contain embedded history, and the password hash only
+    with include_password=True. A backend that leaves any abstract method
+    out cannot be instantiated.
+    """
+
+    name = None
+
+    # Users
+    @abstractmethod
+    def find_user(self, include_password=False, **by):
+        raise NotImplementedError
+
+    @abstractmethod
+    def user_exists(self, **by):
+        raise NotImplementedError
+
+    @abstractmethod
+    def insert_user(self, user):
+        """Insert a user document and return its ObjectId"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_user(self, fields, **by):
+        """$set fields on one user; returns UpdateOutcome(matched, modified)"""
+        raise NotImplementedError
+
+    # Flat prediction history (backend server)
+    @abstractmethod
+    def insert_predictions(self, records):
+        """
+        Insert history records, setting _id on them; returns how many were new
+
+        Records whose _id is already stored (written by an earlier attempt
+        of a retried batch) are skipped rather than raising.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def stored_prediction_ids(self, ids):
+        """The subset of ids that are in the history"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def prediction_page(self, user_id, limit, after=None, fields=None):
+        """
+        Up to limit predictions of a user ordered by (timestamp, _id) descending
+
+        after is a (timestamp, _id) key; only rows strictly after it in that
+        order are returned. fields limits the returned fields (_id is always
+        included).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_predictions(self, user_id=None, fields=None, batch_size=1000, since=None, until=None):
+        """
+        Stream history records of one user (oldest first) or of everyone (in no set order)
+
+        Records are fetched batch_size at a time. since / until limit the
+        timestamps to [since, until).
+        """
+        raise NotImplementedError
+
+    # Per-user, per-month statistics (see prediction_stats.py)
+    @abstractmethod
+    def increment_stats(self, deltas):
+        """Add {(user_id, month): {count, confidence_sum, classes}} to the summaries and bump their versions"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def stats_months(self, user_id):
+        """A user's month summaries, oldest first"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def stats_versions(self, user_id=None, keys=None):
+        """{(user_id, month): version} of every summary (of one user, of the given keys, or everyone)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def replace_stats(self, deltas, versions):
+        """
+        Write freshly computed summaries where nothing changed them meanwhile
+
+        Every key of deltas or versions whose summary still has the version
+        in versions (0: no summary) is overwritten with its delta, or
+        deleted when it has none. Keys in neither, e.g. summaries a live
+        increment created while the deltas were computed, are left alone.
+        Returns the set of keys skipped because their version changed.
+        """
+        raise NotImplementedError
+
+    # Bucketed prediction history (model server)
+    @abstractmethod
+    def append_history(self, user_id, predictions):
+        raise NotImplementedError
+
+    @abstractmethod
+    def recent_history(self, user_id, limit=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_history(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def legacy_history(self, user_id):
+        """Predictions still embedded in a not-yet-migrated user document"""
+        raise NotImplementedError
+
+    # Reference counts of stored images (see blob_store.py)
+    @abstractmethod
+    def acquire_blob(self, digest, size=None, content_type=None):
+        """Count one more reference to a blob, creating its entry; returns the new count"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_blob(self, digest):
+        """Drop one reference; returns the remaining count, or None for an unknown blob"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def unreferenced_blobs(self, released_before):
+        """Digests whose count dropped to zero before released_before"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def forget_blob(self, digest, released_before):
+        """Delete a blob entry if it is still unreferenced; True if it was deleted"""
+        raise NotImplementedError
+
+    def ensure_indexes(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# ------------------------------------------------------------
+# MongoDB
+# ------------------------------------------------------------
+
+class MongoStorage(Storage):
+    """
+    MongoDB with an explicitly configured connection pool
+
+    Args:
+    - uri / database: where to connect
+    - max_pool_size / min_pool_size: connections kept per server
+    - connect_timeout_ms / server_selection_timeout_ms / socket_timeout_ms:
+      fail fast instead of hanging request threads when Mongo is unreachable
+    - wait_queue_timeout_ms: longest a thread waits for a free pooled connection
+    - write_concern: w value ('majority' or a number of nodes)
+    - journal: wait for the journal on writes
+    """
+
+    name = 'mongo'
+
+    def __init__(self, uri='mongodb://localhost:27017/', database='abdos_db', max_pool_size=100,
+                 min_pool_size=0, connect_timeout_ms=5000, server_selection_timeout_ms=5000,
+                 socket_timeout_ms=None, wait_queue_timeout_ms=None, write_concern=1, journal=None):
+        from pymongo import MongoClient
+        from pymongo.write_concern import WriteConcern
+
+        self.client = MongoClient(
+            uri,
+            maxPoolSize=max_pool_size,
+            minPoolSize=min_pool_size,
+            connectTimeoutMS=connect_timeout_ms,
+            serverSelectionTimeoutMS=server_selection_timeout_ms,
+            socketTimeoutMS=socket_timeout_ms,
+            waitQueueTimeoutMS=wait_queue_timeout_ms,
+            tz_aware=True,
+        )
+        self.db = self.client.get_database(
+            database, write_concern=WriteConcern(w=write_concern, j=journal)
+        )
+        self.users = self.db.users
+        self.predictions = self.db.predictions
+        self.buckets = self.db.prediction_buckets
+        self.stats = self.db.prediction_stats
+        self.blobs = self.db.image_blobs
+
+    def find_user(self, include_password=False, **by):
+        projection = dict(history_buckets.USER_PROJECTION)
+        if not include_password:
+            projection['password'] = 0
+        return self.users.find_one(_user_filter(by), projection)
+
+    def user_exists(self, **by):
+        return self.users.find_one(_user_filter(by), {'_id': 1}) is not None
+
+    def insert_user(self, user):
+        return self.users.insert_one(user).inserted_id
+
+    def update_user(self, fields, **by):
+        result = self.users.update_one(_user_filter(by), {'$set': fields})
+        return UpdateOutcome(result.matched_count, result.modified_count)
+
+    def insert_predictions(self, records):
+        from pymongo.errors import BulkWriteError
+
+        try:
+            return len(self.predictions.insert_many(records, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            # insert_many sets _id on the records in place, so records an
+            # earlier attempt did write come back as duplicate-key errors
+            details = e.details
+            if details.get('writeConcernErrors') or \
+                    any(error.get('code') != _DUPLICATE_KEY for error in details.get('writeErrors', [])):
+                raise
+            return details['nInserted']
+
+    def stored_prediction_ids(self, ids):
+        return {doc['_id'] for doc in self.predictions.find({'_id': {'$in': list(ids)}}, {'_id': 1})}
+
+    def prediction_page(self, user_id, limit, after=None, fields=None):
+        query = {'user_id': user_id}
+        if after is not None:
+            timestamp, object_id = after
+            query['$or'] = [
+                {'timestamp': {'$lt': timestamp}},
+                {'timestamp': timestamp, '_id': {'$lt': object_id}},
+            ]
+        projection = dict.fromkeys(fields, 1) if fields else None
+        return list(
+            self.predictions.find(query, projection)
+            .sort([('timestamp', -1), ('_id', -1)])
+            .limit(limit)
+        )
+
+    def iter_predictions(self, user_id=None, fields=None, batch_size=1000, since=None, until=None):
+        query = {} if user_id is None else {'user_id': user_id}
+        if since is not None or until is not None:
+            query['timestamp'] = {}
+            if since is not None:
+                query['timestamp']['$gte'] = since
+            if until is not None:
+                query['timestamp']['$lt'] = until
+        projection = dict.fromkeys(fields, 1) if fields else None
+        cursor = self.predictions.find(query, projection, batch_size=batch_size)
+        if user_id is not None:
+            # Walks the history index backwards; no in-memory sort
+            cursor = cursor.sort([('timestamp', 1), ('_id', 1)])
+        return cursor
+
+    def increment_stats(self, deltas):
+        from pymongo import UpdateOne
+
+        operations = [
+            UpdateOne(
+                {'user_id': user_id, 'month': month},
+                {'$inc': {
+                    'count': delta['count'],
+                    'confidence_sum': delta['confidence_sum'],
+                    **{f'classes.{label}': n for label, n in delta['classes'].items()},
+                    'version': 1,
+                }},
+                upsert=True
+            )
+            for (user_id, month), delta in deltas.items()
+        ]
+        if operations:
+            self.stats.bulk_write(operations, ordered=False)
+
+    def stats_months(self, user_id):
+        return list(self.stats.find({'user_id': user_id}, {'_id': 0, 'rebuilt_at': 0, 'version': 0}).sort('month', 1))
+
+    def stats_versions(self, user_id=None, keys=None):
+        if keys is not None:
+            keys = list(keys)
+            if not keys:
+                return {}
+            query = {'$or': [{'user_id': key_user_id, 'month': month} for key_user_id, month in keys]}
+        else:
+            query = {} if user_id is None else {'user_id': user_id}
+        docs = self.stats.find(query, {'_id': 0, 'user_id': 1, 'month': 1, 'version': 1})
+        return {(doc['user_id'], doc['month']): doc.get('version', 0) for doc in docs}
+
+    def replace_stats(self, deltas, versions, batch_size=1000):
+        from pymongo import DeleteOne, ReplaceOne
+        from pymongo.errors import BulkWriteError
+
+        # Replace in place, then drop the stale summaries, so readers never
+        # see the statistics missing. A replacement matches only the version
+        # it was computed against; when another one is stored the upsert
+        # runs into the user_month index instead.
+        rebuilt_at = datetime.now(timezone.utc)
+        keys = list(deltas) + [key for key in versions if key not in deltas]
+        changed = set()
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            operations = []
+            for doc_user_id, month in batch:
+                expected = versions.get((doc_user_id, month), 0)
+                # Summaries written before versions existed have none
+                query = {'user_id': doc_user_id, 'month': month, 'version': expected or None}
+                if (doc_user_id, month) in deltas:
+                    doc = _stats_doc(doc_user_id, month, deltas[(doc_user_id, month)])
+                    doc['rebuilt_at'] = rebuilt_at
+                    doc['version'] = expected + 1
+                    operations.append(ReplaceOne(query, doc, upsert=True))
+                else:
+                    operations.append(DeleteOne(query))
+            try:
+                self.stats.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                details = e.details
+                if details.get('writeConcernErrors') or \
+                        any(error.get('code') != _DUPLICATE_KEY for error in details.get('writeErrors', [])):
+                    raise
+                changed.update(batch[error['index']] for error in details['writeErrors'])
+        # A delete that matched nothing leaves the summary in place
+        stale = [key for key in versions if key not in deltas]
+        changed.update(self.stats_versions(keys=stale))
+        return changed
+
+    def append_history(self, user_id, predictions):
+        history_buckets.append_predictions(self.buckets, user_id, predictions)
+
+    def recent_history(self, user_id, limit=None):
+        return history_buckets.recent_predictions(self.buckets, user_id, limit)
+
+    def count_history(self, user_id):
+        return history_buckets.count_predictions(self.buckets, user_id)
+
+    def legacy_history(self, user_id):
+        return history_buckets.legacy_predictions(self.users, user_id)
+
+    def acquire_blob(self, digest, size=None, content_type=None):
+        from pymongo import ReturnDocument
+
+        doc = self.blobs.find_one_and_update(
+            {'_id': digest},
+            {
+                '$inc': {'refcount': 1},
+                '$setOnInsert': {'size': size, 'content_type': content_type,
+                                 'created_at': datetime.now(timezone.utc)},
+                '$unset': {'released_at': ''},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return doc['refcount']
+
+    def release_blob(self, digest):
+        from pymongo import ReturnDocument
+
+        doc = self.blobs.find_one_and_update(
+            {'_id': digest, 'refcount': {'$gt': 0}},
+            {'$inc': {'refcount': -1}, '$set': {'released_at': datetime.now(timezone.utc)}},
+            return_document=ReturnDocument.AFTER
+        )
+        return doc['refcount'] if doc else None
+
+    def unreferenced_blobs(self, released_before):
+        query = {'refcount': {'$lte': 0}, 'released_at': {'$lt': released_before}}
+        return [doc['_id'] for doc in self.blobs.find(query, {'_id': 1})]
+
+    def forget_blob(self, digest, released_before):
+        result = self.blobs.delete_one(
+            {'_id': digest, 'refcount': {'$lte': 0}, 'released_at': {'$lt': released_before}}
+        )
+        return result.deleted_count == 1
+
+    def ensure_indexes(self):
+        self.predictions.create_index(HISTORY_INDEX, name='user_timestamp_id')
+        self.stats.create_index([('user_id', 1), ('month', 1)], unique=True, name='user_month')
+        history_buckets.ensure_bucket_indexes(self.buckets)
+
+    def close(self):
+        self.client.close()
+
+
+def _stats_doc(user_id, month, delta):
+    return {
+        'user_id': user_id,
+        'month': month,
+        'count': delta['count'],
+        'confidence_sum': delta['confidence_sum'],
+        'classes': dict(delta['classes']),
+    }
+
+
+# ------------------------------------------------------------
+# In-memory
+# ------------------------------------------------------------
+
+def _utc(timestamp):
+    # Mongo keeps millisecond precision and (tz_aware) hands back UTC datetimes
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+
+
+class MemoryStorage(Storage):
+    """
+    Process-local stand-in for MongoStorage
+
+    Documents are deep-copied in and out, so callers can mutate what they
+    get back just as with pymongo. Each user's flat history is kept sorted
+    by (timestamp, _id) so pages are a bisect and a slice.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+        self._predictions = {}
+        self._prediction_keys = {}
+        self._prediction_ids = set()
+        self._history = {}
+        self._stats = {}
+        self._blobs = {}
+
+    def _match_user(self, by):
+        key, value = next(iter(_user_filter(by).items()))
+        if key == '_id':
+            return self._users.get(value)
+        return next((user for user in self._users.values() if user.get(key) == value), None)
+
+    def find_user(self, include_password=False, **by):
+        with self._lock:
+            user = self._match_user(by)
+            if user is None:
+                return None
+            user = copy.deepcopy(user)
+        user.pop('predictions', None)
+        if not include_password:
+            user.pop('password', None)
+        return user
+
+    def user_exists(self, **by):
+        with self._lock:
+            return self._match_user(by) is not None
+
+    def insert_user(self, user):
+        user.setdefault('_id', ObjectId())
+        with self._lock:
+            if user['_id'] in self._users:
+                raise ValueError(f"Duplicate user _id {user['_id']}")
+            self._users[user['_id']] = copy.deepcopy(user)
+        return user['_id']
+
+    def update_user(self, fields, **by):
+        with self._lock:
+            user = self._match_user(by)
+            if user is None:
+                return UpdateOutcome(0, 0)
+            modified = any(user.get(key) != value for key, value in fields.items())
+            user.update(copy.deepcopy(fields))
+        return UpdateOutcome(1, int(modified))
+
+    def insert_predictions(self, records):
+        inserted = 0
+        with self._lock:
+            for record in records:
+                # pymongo sets _id on the caller's documents too
+                record.setdefault('_id', ObjectId())
+                if record['_id'] in self._prediction_ids:
+                    continue
+                self._prediction_ids.add(record['_id'])
+                inserted += 1
+                stored = copy.deepcopy(record)
+                stored['timestamp'] = _utc(stored['timestamp'])
+                key = (stored['timestamp'], stored['_id'])
+                keys = self._prediction_keys.setdefault(stored['user_id'], [])
+                index = bisect.bisect(keys, key)
+                keys.insert(index, key)
+                self._predictions.setdefault(stored['user_id'], []).insert(index, stored)
+        return inserted
+
+    def stored_prediction_ids(self, ids):
+        with self._lock:
+            return set(ids) & self._prediction_ids
+
+    def prediction_page(self, user_id, limit, after=None, fields=None):
+        with self._lock:
+            keys = self._prediction_keys.get(user_id, [])
+            rows = self._predictions.get(user_id, [])
+            end = bisect.bisect_left(keys, (_utc(after[0]), after[1])) if after is not None else len(rows)
+            page = rows[max(0, end - limit):end][::-1]
+            if fields:
+                wanted = set(fields) | {'_id'}
+                return [{k: copy.deepcopy(v) for k, v in row.items() if k in wanted} for row in page]
+            return copy.deepcopy(page)
+
+    def iter_predictions(self, user_id=None, fields=None, batch_size=1000, since=None, until=None):
+        with self._lock:
+            user_ids = list(self._predictions) if user_id is None else [user_id]
+        wanted = set(fields) | {'_id'} if fields else None
+        until = _utc(until) if until is not None else None
+        for uid in user_ids:
+            # Continue from the last key rather than an index, so records
+            # inserted between batches do not shift the position
+            position = None
+            while True:
+                with self._lock:
+                    keys = self._prediction_keys.get(uid, [])
+                    if position is not None:
+                        start = bisect.bisect_right(keys, position)
+                    elif since is not None:
+                        start = bisect.bisect_left(keys, (_utc(since),))
+                    else:
+                        start = 0
+                    batch_keys = keys[start:start + batch_size]
+                    if until is not None:
+                        batch_keys = batch_keys[:bisect.bisect_left(batch_keys, (until,))]
+                    batch = [
+                        {k: copy.deepcopy(v) for k, v in row.items() if wanted is None or k in wanted}
+                        for row in self._predictions.get(uid, [])[start:start + len(batch_keys)]
+                    ]
+                yield from batch
+                if len(batch) < batch_size:
+                    break
+                position = batch_keys[-1]
+
+    def increment_stats(self, deltas):
+        with self._lock:
+            for (user_id, month), delta in deltas.items():
+                doc = self._stats.get((user_id, month))
+                if doc is None:
+                    doc = self._stats[(user_id, month)] = _stats_doc(user_id, month, delta)
+                    doc['version'] = 1
+                    continue
+                doc['version'] = doc.get('version', 0) + 1
+                doc['count'] += delta['count']
+                doc['confidence_sum'] += delta['confidence_sum']
+                for label, n in delta['classes'].items():
+                    doc['classes'][label] = doc['classes'].get(label, 0) + n
+
+    def stats_months(self, user_id):
+        with self._lock:
+            docs = [doc for (uid, _), doc in self._stats.items() if uid == user_id]
+            docs = copy.deepcopy(sorted(docs, key=lambda doc: doc['month']))
+        for doc in docs:
+            doc.pop('version', None)
+        return docs
+
+    def stats_versions(self, user_id=None, keys=None):
+        with self._lock:
+            if keys is not None:
+                return {key: self._stats[key]['version'] for key in keys if key in self._stats}
+            return {key: doc['version'] for key, doc in self._stats.items()
+                    if user_id is None or key[0] == user_id}
+
+    def replace_stats(self, deltas, versions):
+        changed = set()
+        with self._lock:
+            for key in list(deltas) + [key for key in versions if key not in deltas]:
+                expected = versions.get(key, 0)
+                current = self._stats.get(key)
+                if (current['version'] if current is not None else 0) != expected:
+                    changed.add(key)
+                elif key in deltas:
+                    doc = self._stats[key] = _stats_doc(key[0], key[1], deltas[key])
+                    doc['version'] = expected + 1
+                else:
+                    del self._stats[key]
+        return changed
+
+    def append_history(self, user_id, predictions):
+        with self._lock:
+            self._history.setdefault(user_id, []).extend(copy.deepcopy(list(predictions)))
+
+    def recent_history(self, user_id, limit=None):
+        with self._lock:
+            rows = self._history.get(user_id, [])
+            rows = rows[::-1] if limit is None else rows[:-limit - 1:-1]
+            return copy.deepcopy(rows)
+
+    def count_history(self, user_id):
+        with self._lock:
+            return len(self._history.get(user_id, []))
+
+    def legacy_history(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id) or {}
+            return copy.deepcopy(user.get('predictions') or [])
+
+    def acquire_blob(self, digest, size=None, content_type=None):
+        with self._lock:
+            blob = self._blobs.setdefault(digest, {
+                'refcount': 0, 'size': size, 'content_type': content_type,
+                'created_at': datetime.now(timezone.utc),
+            })
+            blob['refcount'] += 1
+            blob.pop('released_at', None)
+            return blob['refcount']
+
+    def release_blob(self, digest):
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is None or blob['refcount'] <= 0:
+                return None
+            blob['refcount'] -= 1
+            blob['released_at'] = datetime.now(timezone.utc)
+            return blob['refcount']
+
+    def _unreferenced(self, blob, released_before):
+        return blob['refcount'] <= 0 and blob.get('released_at', released_before) < released_before
+
+    def unreferenced_blobs(self, released_before):
+        with self._lock:
+            return [digest for digest, blob in self._blobs.items()
+                    if self._unreferenced(blob, released_before)]
+
+    def forget_blob(self, digest, released_before):
+        with self._lock:
+            blob = self._blobs.get(digest)
+            if blob is None or not self._unreferenced(blob, released_before):
+                return False
+            del self._blobs[digest]
+            return True
+
+
+# ------------------------------------------------------------
+# Configuration
+# ------------------------------------------------------------
+
+def _optional_int(name):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else None
+
+
+def storage_from_env(default_database='abdos_db'):
+    """
+    Build the storage backend selected by STORAGE_BACKEND (mongo or memory)
+
+    Mongo settings: MONGO_URI, MONGO_DB, MONGO_MAX_POOL_SIZE,
+    MONGO_MIN_POOL_SIZE, MONGO_CONNECT_TIMEOUT_MS,
+    MONGO_SERVER_SELECTION_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS,
+    MONGO_WAIT_QUEUE_TIMEOUT_MS, MONGO_WRITE_CONCERN (w), MONGO_JOURNAL.
+    """
+    backend = os.environ.get('STORAGE_BACKEND', 'mongo').lower()
+
+    if backend == 'memory':
+        logger.info("Using in-memory storage; data is lost on restart")
+        return MemoryStorage()
+
+    if backend == 'mongo':
+        write_concern = os.environ.get('MONGO_WRITE_CONCERN', '1')
+        journal = os.environ.get('MONGO_JOURNAL')
+        storage = MongoStorage(
+            uri=os.environ.get('MONGO_URI', 'mongodb://localhost:27017/'),
+            database=os.environ.get('MONGO_DB', default_database),
+            max_pool_size=int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+            min_pool_size=int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+            connect_timeout_ms=int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+            server_selection_timeout_ms=int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+            socket_timeout_ms=_optional_int('MONGO_SOCKET_TIMEOUT_MS'),
+            wait_queue_timeout_ms=_optional_int('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+            write_concern=int(write_concern) if write_concern.isdigit() else write_concern,
+            journal=journal.lower() in ('1', 'true', 'yes') if journal else None,
+        )
+        logger.info(f"Using MongoDB storage (database {storage.db.name})")
+        return storage
+
+    raise ValueError(f"Unknown STORAGE_BACKEND '{backend}', expected 'mongo' or 'memory'")
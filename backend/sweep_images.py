@@ -0,0 +1,35 @@
+"""
+Delete stored images that no prediction refers to any more.
+
+Blobs whose reference count has been zero for longer than --grace-hours are
+removed from the image store together with their thumbnails. Uses the same
+IMAGE_STORE / STORAGE_BACKEND / MONGO_* settings as model_api.py.
+
+Usage:
+    python sweep_images.py --grace-hours 24
+"""
+import argparse
+
+from blob_store import blob_store_from_env
+from storage import storage_from_env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--grace-hours', type=float, default=1.0,
+                        help='how long a blob must have been unreferenced')
+    args = parser.parse_args()
+
+    storage = storage_from_env()
+    try:
+        image_store = blob_store_from_env(storage)
+        if image_store is None:
+            parser.error('IMAGE_STORE is not configured')
+        deleted = image_store.sweep(grace_seconds=args.grace_hours * 3600)
+        print(f"Deleted {deleted} unreferenced images from the {image_store.name} store")
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+"""
+A small in-memory stand-in for the pymongo collection methods storage.py and history_buckets.py use.
+
+Only the query and update operators those modules need are implemented:
+equality (None also matches a missing field), $exists, $size, $gt, $gte,
+$lt, $lte, $ne, $in and $or on (dotted) fields; $set, $unset, $inc, $max,
+$push with $each and $setOnInsert. aggregate() runs $match, $sort and
+$group (with $push and $sum). bulk_write() takes UpdateOne, ReplaceOne and
+DeleteOne. _id and unique indexes (optionally partial) are enforced on
+inserts and upserts, and when an index is created over existing documents.
+"""
+import copy
+from types import SimpleNamespace
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+_MISSING = object()
+
+
+def _get(doc, path):
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit():
+            value = value[int(part)] if int(part) < len(value) else _MISSING
+        else:
+            return _MISSING
+    return value
+
+
+def _parent(doc, path, create=True):
+    # The dict holding the last part of a dotted path
+    *parents, last = path.split('.')
+    for part in parents:
+        if part not in doc:
+            if not create:
+                return None, last
+            doc[part] = {}
+        doc = doc[part]
+    return doc, last
+
+
+def _matches_condition(value, condition):
+    if not (isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition)):
+        if condition is None:
+            return value is _MISSING or value is None
+        return value is not _MISSING and value == condition
+    for op, operand in condition.items():
+        if op == '$exists':
+            if (value is not _MISSING) != bool(operand):
+                return False
+        elif op == '$size':
+            if not isinstance(value, list) or len(value) != operand:
+                return False
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            if value is _MISSING or value is None:
+                return False
+            if not {'$gt': value > operand, '$gte': value >= operand,
+                    '$lt': value < operand, '$lte': value <= operand}[op]:
+                return False
+        elif op == '$ne':
+            if value is not _MISSING and value == operand:
+                return False
+        elif op == '$in':
+            if value is _MISSING or value not in operand:
+                return False
+        else:
+            raise NotImplementedError(op)
+    return True
+
+
+def _value(doc, expression):
+    # '$field' paths and constants, as aggregation expressions
+    if isinstance(expression, str) and expression.startswith('$'):
+        return _get(doc, expression[1:])
+    return expression
+
+
+def matches(doc, query):
+    for path, condition in query.items():
+        if path == '$or':
+            if not any(matches(doc, branch) for branch in condition):
+                return False
+        elif not _matches_condition(_get(doc, path), condition):
+            return False
+    return True
+
+
+def _project(doc, projection):
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    if any(projection.values()):
+        keep_id = projection.get('_id', 1)
+        return {k: v for k, v in doc.items() if (k == '_id' and keep_id) or (k != '_id' and projection.get(k))}
+    return {k: v for k, v in doc.items() if k not in projection}
+
+
+def _apply(doc, update, inserting=False):
+    for op, fields in update.items():
+        for field, operand in fields.items():
+            parent, key = _parent(doc, field, create=op != '$unset')
+            if op == '$set':
+                parent[key] = copy.deepcopy(operand)
+            elif op == '$unset':
+                if parent is not None:
+                    parent.pop(key, None)
+            elif op == '$inc':
+                parent[key] = parent.get(key, 0) + operand
+            elif op == '$max':
+                if parent.get(key) is None or operand > parent[key]:
+                    parent[key] = operand
+            elif op == '$push':
+                items = operand['$each'] if isinstance(operand, dict) and '$each' in operand else [operand]
+                parent.setdefault(key, []).extend(copy.deepcopy(items))
+            elif op == '$setOnInsert':
+                if inserting:
+                    parent[key] = copy.deepcopy(operand)
+            else:
+                raise NotImplementedError(op)
+
+
+def _sort_key(order):
+    def key(doc):
+        return tuple(_Reverse(doc.get(field)) if direction < 0 else doc.get(field) for field, direction in order)
+    return key
+
+
+class _Reverse:
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        order = key if isinstance(key, list) else [(key, direction)]
+        self._docs = sorted(self._docs, key=_sort_key(order))
+        return self
+
+    def limit(self, n):
+        self._docs = self._docs[:n]
+        return self
+
+    def __iter__(self):
+        return iter(self._docs)
+
+
+class FakeCollection:
+    def __init__(self, docs=()):
+        self.docs = [copy.deepcopy(doc) for doc in docs]
+        self.unique_indexes = [(['_id'], {})]
+
+    def _matching(self, query):
+        return [doc for doc in self.docs if matches(doc, query)]
+
+    def create_index(self, keys, unique=False, partialFilterExpression=None, **kwargs):
+        if unique:
+            fields = [keys] if isinstance(keys, str) else [field for field, _ in keys]
+            index = (fields, partialFilterExpression or {})
+            seen = set()
+            for doc in self._matching(index[1]):
+                key = repr([_get(doc, field) for field in fields])
+                if key in seen:
+                    raise OperationFailure(f"E11000 duplicate key {key}", code=11000)
+                seen.add(key)
+            if index not in self.unique_indexes:
+                self.unique_indexes.append(index)
+
+    def aggregate(self, pipeline):
+        docs = copy.deepcopy(self.docs)
+        for stage in pipeline:
+            (op, spec), = stage.items()
+            if op == '$match':
+                docs = [doc for doc in docs if matches(doc, spec)]
+            elif op == '$sort':
+                docs = sorted(docs, key=_sort_key(list(spec.items())))
+            elif op == '$group':
+                groups = {}
+                for doc in docs:
+                    key = _value(doc, spec['_id'])
+                    group = groups.setdefault(repr(key), {'_id': key})
+                    for name, accumulation in spec.items():
+                        if name == '_id':
+                            continue
+                        (accumulator, operand), = accumulation.items()
+                        if accumulator == '$push':
+                            group.setdefault(name, []).append(_value(doc, operand))
+                        elif accumulator == '$sum':
+                            group[name] = group.get(name, 0) + _value(doc, operand)
+                        else:
+                            raise NotImplementedError(accumulator)
+                docs = list(groups.values())
+            else:
+                raise NotImplementedError(op)
+        return iter(docs)
+
+    def _check_unique(self, new_doc, replacing=None):
+        for fields, partial in self.unique_indexes:
+            if not matches(new_doc, partial):
+                continue
+            key = [_get(new_doc, field) for field in fields]
+            for doc in self.docs:
+                if doc is not new_doc and doc is not replacing and matches(doc, partial) and \
+                        [_get(doc, f) for f in fields] == key:
+                    raise DuplicateKeyError(f"E11000 duplicate key {dict(zip(fields, key))}", code=11000)
+
+    def _upsert_doc(self, query):
+        doc = {k: copy.deepcopy(v) for k, v in query.items()
+               if not k.startswith('$') and not isinstance(v, dict) and v is not None}
+        doc.setdefault('_id', ObjectId())
+        return doc
+
+    def find_one(self, query=None, projection=None):
+        found = self._matching(query or {})
+        return _project(found[0], projection) if found else None
+
+    def find(self, query=None, projection=None, batch_size=None):
+        return FakeCursor([_project(doc, projection) for doc in self._matching(query or {})])
+
+    def distinct(self, field):
+        values = []
+        for doc in self.docs:
+            value = doc.get(field, _MISSING)
+            if value is not _MISSING and value not in values:
+                values.append(value)
+        return values
+
+    def insert_one(self, doc):
+        doc.setdefault('_id', ObjectId())
+        self._check_unique(doc)
+        self.docs.append(copy.deepcopy(doc))
+        return SimpleNamespace(inserted_id=doc['_id'])
+
+    def insert_many(self, docs, ordered=True):
+        inserted, errors = [], []
+        for index, doc in enumerate(docs):
+            try:
+                inserted.append(self.insert_one(doc).inserted_id)
+            except DuplicateKeyError:
+                errors.append({'index': index, 'code': 11000})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({'nInserted': len(inserted), 'writeErrors': errors, 'writeConcernErrors': []})
+        return SimpleNamespace(inserted_ids=inserted)
+
+    def update_one(self, query, update, upsert=False):
+        found = self._matching(query)[:1]
+        modified = 0
+        if found:
+            before = copy.deepcopy(found[0])
+            _apply(found[0], update)
+            modified = int(found[0] != before)
+        elif upsert:
+            doc = self._upsert_doc(query)
+            _apply(doc, update, inserting=True)
+            self._check_unique(doc)
+            self.docs.append(doc)
+        return SimpleNamespace(matched_count=len(found), modified_count=modified)
+
+    def replace_one(self, query, replacement, upsert=False):
+        found = self._matching(query)[:1]
+        if found:
+            doc = dict(copy.deepcopy(replacement), _id=found[0]['_id'])
+            self._check_unique(doc, replacing=found[0])
+            self.docs[self.docs.index(found[0])] = doc
+        elif upsert:
+            doc = copy.deepcopy(replacement)
+            doc.setdefault('_id', query.get('_id', ObjectId()))
+            self._check_unique(doc)
+            self.docs.append(doc)
+        return SimpleNamespace(matched_count=len(found), modified_count=len(found))
+
+    def update_many(self, query, update):
+        found = self._matching(query)
+        for doc in found:
+            _apply(doc, update)
+        return SimpleNamespace(matched_count=len(found), modified_count=len(found))
+
+    def delete_one(self, query):
+        found = self._matching(query)[:1]
+        if found:
+            self.docs = [doc for doc in self.docs if doc is not found[0]]
+        return SimpleNamespace(deleted_count=len(found))
+
+    def delete_many(self, query):
+        found = [id(doc) for doc in self._matching(query)]
+        self.docs = [doc for doc in self.docs if id(doc) not in found]
+        return SimpleNamespace(deleted_count=len(found))
+
+    def bulk_write(self, operations, ordered=True):
+        from pymongo import DeleteOne, ReplaceOne, UpdateOne
+
+        errors = []
+        for index, operation in enumerate(operations):
+            try:
+                if isinstance(operation, UpdateOne):
+                    self.update_one(operation._filter, operation._doc, upsert=operation._upsert)
+                elif isinstance(operation, ReplaceOne):
+                    self.replace_one(operation._filter, operation._doc, upsert=operation._upsert)
+                elif isinstance(operation, DeleteOne):
+                    self.delete_one(operation._filter)
+                else:
+                    raise NotImplementedError(type(operation).__name__)
+            except DuplicateKeyError:
+                errors.append({'index': index, 'code': 11000})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'writeConcernErrors': []})
+
+    def find_one_and_update(self, query, update, sort=None, projection=None, upsert=False,
+                            return_document=False):
+        found = self._matching(query)
+        if sort:
+            found = sorted(found, key=_sort_key(sort))
+        if found:
+            doc = found[0]
+            before = _project(doc, projection)
+            _apply(doc, update)
+        elif upsert:
+            doc = self._upsert_doc(query)
+            _apply(doc, update, inserting=True)
+            self._check_unique(doc)
+            self.docs.append(doc)
+            before = None
+        else:
+            return None
+        return _project(doc, projection) if return_document else before
@@ -0,0 +1,126 @@
+"""MicroBatcher: grouping concurrent items into forward passes, and its stats."""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from batching import MicroBatcher, QueueFullError
+
+
+class RecordingModel:
+    """Returns each row's first pixel and records the size of every forward pass"""
+
+    def __init__(self, gate=None):
+        self.batches = []
+        self.gate = gate
+
+    def __call__(self, batch):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.batches.append(len(batch))
+        return batch[:, 0, 0, :1]
+
+
+def rows(*values):
+    return np.stack([np.full((2, 2, 3), value, dtype=np.float32) for value in values])
+
+
+@pytest.fixture
+def blocked():
+    """A batcher whose worker is busy until gate is set, so submitted items queue up"""
+    gate = threading.Event()
+    model = RecordingModel()
+    batcher = MicroBatcher(model, max_batch_size=4, max_wait_ms=50)
+    batcher.submit(rows(-1), predict_fn=RecordingModel(gate))
+    yield batcher, model, gate
+    gate.set()
+    batcher.close()
+
+
+def test_queued_items_share_a_forward_pass_and_get_their_own_rows(blocked):
+    batcher, model, gate = blocked
+    futures = [batcher.submit(rows(1)), batcher.submit(rows(2, 3)), batcher.submit(rows(4)[0])]
+    gate.set()
+
+    results = [future.result(timeout=5) for future in futures]
+
+    assert [r.ravel().tolist() for r in results] == [[1.0], [2.0, 3.0], [4.0]]
+    assert model.batches == [4]
+
+
+def test_an_item_that_does_not_fit_opens_the_next_batch(blocked):
+    batcher, model, gate = blocked
+    futures = [batcher.submit(rows(1, 2, 3)), batcher.submit(rows(4, 5))]
+    gate.set()
+
+    assert futures[1].result(timeout=5).ravel().tolist() == [4.0, 5.0]
+    assert model.batches == [3, 2]
+
+
+def test_items_for_different_model_versions_are_not_mixed(blocked):
+    batcher, model, gate = blocked
+    other = RecordingModel()
+    futures = [batcher.submit(rows(1)), batcher.submit(rows(2), predict_fn=other), batcher.submit(rows(3))]
+    gate.set()
+
+    for future in futures:
+        future.result(timeout=5)
+    assert sum(model.batches) == 2 and other.batches == [1]
+
+
+def test_a_failed_pass_fails_only_its_items(blocked):
+    batcher, model, gate = blocked
+
+    def broken(batch):
+        raise RuntimeError('out of memory')
+
+    failed = batcher.submit(rows(1), predict_fn=broken)
+    ok = batcher.submit(rows(2))
+    gate.set()
+
+    with pytest.raises(RuntimeError, match='out of memory'):
+        failed.result(timeout=5)
+    assert ok.result(timeout=5).ravel().tolist() == [2.0]
+    assert batcher.stats()['failed_batches'] == 1
+
+
+def test_a_full_queue_rejects_work():
+    gate = threading.Event()
+    batcher = MicroBatcher(RecordingModel(gate), max_batch_size=1, max_queue_size=1)
+    try:
+        batcher.submit(rows(1))
+        # Once the worker holds the first item, one more fits in the queue
+        while batcher.stats()['queue_depth']:
+            time.sleep(0.001)
+        batcher.submit(rows(2))
+        with pytest.raises(QueueFullError):
+            batcher.submit(rows(3))
+    finally:
+        gate.set()
+        batcher.close()
+
+
+def test_oversized_items_are_refused():
+    batcher = MicroBatcher(RecordingModel(), max_batch_size=2)
+    try:
+        with pytest.raises(ValueError):
+            batcher.submit(rows(1, 2, 3))
+    finally:
+        batcher.close()
+
+
+def test_stats_describe_the_batches_formed(blocked):
+    batcher, model, gate = blocked
+    futures = [batcher.submit(rows(1, 2)), batcher.submit(rows(3))]
+    gate.set()
+    for future in futures:
+        future.result(timeout=5)
+    batcher.close()
+
+    stats = batcher.stats()
+    assert stats['total_batches'] == 2 and stats['total_rows'] == 4
+    assert stats['batch_size_distribution'] == {1: 1, 3: 1}
+    assert stats['mean_batch_size'] == 2.0
+    assert stats['queue_depth'] == 0
+    assert stats['queue_wait_ms']['p99'] >= stats['queue_wait_ms']['p50'] >= 0
@@ -0,0 +1,114 @@
+"""Content-addressed image store: reference counts, deduplication and sweeps."""
+import hashlib
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from blob_store import FileBlobStore
+from storage import MemoryStorage
+
+
+def jpeg(seed=0, size=(300, 200)):
+    pixels = np.random.default_rng(seed).integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, 'RGB').save(buffer, format='JPEG')
+    data = buffer.getvalue()
+    return hashlib.sha256(data).hexdigest(), data
+
+
+@pytest.fixture
+def storage():
+    return MemoryStorage()
+
+
+@pytest.fixture
+def store(storage, tmp_path):
+    return FileBlobStore(storage, str(tmp_path), chunk_size=1024, thumbnail_size=64)
+
+
+def put(store, image):
+    digest, data = image
+    return store.put(digest, io.BytesIO(data), content_type='image/jpeg')
+
+
+def test_first_put_stores_bytes_and_thumbnail(store):
+    digest, data = image = jpeg()
+
+    assert put(store, image) is True
+    assert b''.join(store.iter_chunks(digest)) == data
+    with Image.open(io.BytesIO(store.thumbnail(digest))) as thumb:
+        assert max(thumb.size) <= 64
+    stats = store.stats()
+    assert (stats['stored'], stats['bytes_written'], stats['backend']) == (1, len(data), 'filesystem')
+
+
+def test_repeated_uploads_are_stored_once_and_counted(store, storage, tmp_path):
+    image = jpeg()
+
+    assert [put(store, image) for _ in range(3)] == [True, False, False]
+    assert storage.acquire_blob(image[0]) == 4
+    assert store.stats()['deduplicated'] == 2
+    assert len(os.listdir(tmp_path / 'objects' / image[0][:2])) == 1
+
+
+def test_sweep_deletes_only_blobs_without_references(store):
+    kept, dropped = jpeg(1), jpeg(2)
+    put(store, kept)
+    put(store, kept)
+    put(store, dropped)
+
+    assert store.release(kept[0]) == 1
+    assert store.release(dropped[0]) == 0
+    assert store.sweep(grace_seconds=0) == 1
+
+    assert b''.join(store.iter_chunks(kept[0])) == kept[1]
+    with pytest.raises(FileNotFoundError):
+        store.open(dropped[0])
+    assert store.thumbnail(dropped[0]) is None
+    # Releasing an unknown blob is not an error and does not go negative
+    assert store.release(dropped[0]) is None
+
+
+def test_sweep_waits_for_the_grace_period(store):
+    image = jpeg()
+    put(store, image)
+    store.release(image[0])
+
+    assert store.sweep(grace_seconds=3600) == 0
+    assert store.open(image[0]).close() is None
+
+
+def test_a_blob_referenced_again_before_the_sweep_is_kept(store, storage):
+    image = jpeg()
+    put(store, image)
+    store.release(image[0])
+    put(store, image)
+
+    assert store.sweep(grace_seconds=0) == 0
+    assert storage.release_blob(image[0]) == 0
+    assert store.sweep(grace_seconds=0) == 1
+
+
+def test_a_failed_write_releases_its_reference(store, storage):
+    digest, data = jpeg()
+
+    class Broken(io.BytesIO):
+        def read(self, *args):
+            raise OSError('upload stream closed')
+
+    with pytest.raises(OSError):
+        store.put(digest, Broken(data))
+    assert storage.unreferenced_blobs(released_before=_far_future()) == [digest]
+
+
+def test_digest_must_be_sha256_hex(store):
+    with pytest.raises(ValueError):
+        store.put('../../etc/passwd', io.BytesIO(b'x'))
+
+
+def _far_future():
+    from datetime import datetime, timezone
+    return datetime(2100, 1, 1, tzinfo=timezone.utc)
@@ -0,0 +1,95 @@
+"""History export: parameter checks, user/time filtering, CSV/NDJSON encoding and gzip."""
+import csv
+import gzip
+import io
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson.objectid import ObjectId
+
+import export
+from export import InvalidExport, export_history, parse_date, parse_export_fields
+from storage import MemoryStorage
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def history():
+    storage = MemoryStorage()
+    alice, bob = ObjectId(), ObjectId()
+    storage.insert_predictions(
+        [{'user_id': alice, 'timestamp': START + timedelta(days=day), 'label': 'Melanoma', 'predicted_class': 4,
+          'confidence': 90.0 + day, 'image_name': f'day{day}.jpg', 'all_probabilities': [0.1, 0.9]}
+         for day in range(5)]
+        + [{'user_id': bob, 'timestamp': START, 'label': 'Acne', 'predicted_class': 0, 'confidence': 70.0}]
+    )
+    return storage, alice, bob
+
+
+def ndjson(chunks):
+    return [json.loads(line) for line in b''.join(chunks).decode('utf-8').splitlines()]
+
+
+def test_parameters_are_checked_before_any_record_is_read():
+    assert parse_date('2026-01-31') == datetime(2026, 1, 31, tzinfo=timezone.utc)
+    assert parse_date('2026-01-31T10:00:00Z') == datetime(2026, 1, 31, 10, tzinfo=timezone.utc)
+    assert parse_date('') is None
+    assert parse_export_fields('label, confidence') == ('label', 'confidence')
+    for bad in (lambda: parse_date('31/01/2026'), lambda: parse_export_fields('label,password'),
+                lambda: export_history(None, fmt='xml'),
+                lambda: export_history(None, since=START, until=START)):
+        with pytest.raises(InvalidExport):
+            bad()
+
+
+def test_one_users_records_in_a_time_range(history):
+    storage, alice, bob = history
+
+    rows = ndjson(export_history(storage, user_id=alice, since=START + timedelta(days=1),
+                                 until=START + timedelta(days=3), fields=('timestamp', 'confidence')))
+
+    assert [row['confidence'] for row in rows] == [91.0, 92.0]
+    assert set(rows[0]) == {'id', 'timestamp', 'confidence'}
+    assert rows[0]['timestamp'] == (START + timedelta(days=1)).isoformat()
+
+
+def test_every_users_records_without_a_user(history):
+    storage, alice, bob = history
+
+    rows = ndjson(export_history(storage))
+
+    assert sorted(row['user_id'] for row in rows) == sorted([str(alice)] * 5 + [str(bob)])
+    assert rows[0]['image_sha256'] is None
+
+
+def test_csv_has_a_header_and_lists_in_one_cell(history):
+    storage, alice, _ = history
+
+    text = b''.join(export_history(storage, user_id=alice, fmt='csv',
+                                   fields=('label', 'all_probabilities'))).decode('utf-8')
+    rows = list(csv.reader(io.StringIO(text)))
+
+    assert rows[0] == ['id', 'label', 'all_probabilities']
+    assert len(rows) == 6
+    assert rows[1][1:] == ['Melanoma', '[0.1, 0.9]']
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv'])
+def test_gzip_output_decompresses_to_the_plain_export(history, fmt):
+    storage, _, _ = history
+    plain = b''.join(export_history(storage, fmt=fmt, batch_size=2))
+
+    compressed = b''.join(export_history(storage, fmt=fmt, batch_size=2, compress=True))
+
+    assert compressed[:2] == b'\x1f\x8b'
+    assert gzip.decompress(compressed) == plain
+
+
+def test_chunks_are_buffered_up_to_the_chunk_size():
+    pieces = ['x' * 10] * 25
+
+    chunks = list(export._buffered(iter(pieces), size=100))
+
+    assert [len(chunk) for chunk in chunks] == [100, 100, 50]
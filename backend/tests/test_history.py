@@ -0,0 +1,84 @@
+"""Keyset pages of prediction history (history.history_page) on MemoryStorage."""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson.objectid import ObjectId
+
+from history import InvalidCursor, history_page
+from storage import MemoryStorage
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def make_history(storage, user_id, timestamps):
+    records = [
+        {'user_id': user_id, 'timestamp': ts, 'predicted_class': i % 7, 'label': 'Melanoma',
+         'confidence': 50.0, 'image_name': f'{i}.jpg'}
+        for i, ts in enumerate(timestamps)
+    ]
+    storage.insert_predictions(records)
+    # Newest first on (timestamp, _id)
+    return [str(r['_id']) for r in sorted(records, key=lambda r: (r['timestamp'], r['_id']), reverse=True)]
+
+
+def all_pages(storage, user_id, limit):
+    pages, cursor = [], None
+    while True:
+        rows, cursor = history_page(storage, user_id, limit=limit, cursor=cursor)
+        pages.append([row['id'] for row in rows])
+        if cursor is None:
+            return pages
+
+
+@pytest.mark.parametrize('count,limit', [(0, 5), (1, 5), (5, 5), (6, 5), (10, 5), (23, 4)])
+def test_pages_cover_history_once_in_order(count, limit):
+    storage = MemoryStorage()
+    user_id = ObjectId()
+    expected = make_history(storage, user_id, [START + timedelta(minutes=i) for i in range(count)])
+    make_history(storage, ObjectId(), [START] * 3)
+
+    pages = all_pages(storage, user_id, limit)
+
+    assert [row for page in pages for row in page] == expected
+    assert all(len(page) == limit for page in pages[:-1])
+    # No empty trailing page when the history divides evenly
+    assert len(pages) == max(1, -(-count // limit))
+
+
+def test_rows_sharing_a_timestamp_are_split_by_id():
+    storage = MemoryStorage()
+    user_id = ObjectId()
+    expected = make_history(storage, user_id, [START] * 7 + [START + timedelta(seconds=1)] * 3)
+
+    pages = all_pages(storage, user_id, limit=3)
+
+    assert [row for page in pages for row in page] == expected
+
+
+def test_rows_inserted_after_the_first_page_do_not_shift_later_pages():
+    storage = MemoryStorage()
+    user_id = ObjectId()
+    expected = make_history(storage, user_id, [START + timedelta(minutes=i) for i in range(6)])
+
+    first, cursor = history_page(storage, user_id, limit=3)
+    make_history(storage, user_id, [START + timedelta(hours=1)])
+    second, cursor = history_page(storage, user_id, limit=3, cursor=cursor)
+
+    assert [row['id'] for row in first + second] == expected
+    assert cursor is None
+
+
+def test_fields_are_limited_and_timestamp_only_when_asked():
+    storage = MemoryStorage()
+    user_id = ObjectId()
+    make_history(storage, user_id, [START, START + timedelta(minutes=1)])
+
+    rows, cursor = history_page(storage, user_id, limit=1, fields=('label',))
+
+    assert set(rows[0]) == {'id', 'label'}
+    assert cursor is not None
+
+
+def test_invalid_cursor_is_rejected():
+    with pytest.raises(InvalidCursor):
+        history_page(MemoryStorage(), ObjectId(), cursor='not-a-cursor')
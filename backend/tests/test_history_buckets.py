@@ -0,0 +1,208 @@
+"""Bucketed history (history_buckets.py): appends and resumable migration."""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+import history_buckets
+from fake_mongo import FakeCollection
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def predictions(count, offset=0):
+    return [{'timestamp': START + timedelta(minutes=offset + i), 'n': offset + i} for i in range(count)]
+
+
+def visible(buckets, user_id):
+    return [b for b in buckets.docs if b['user_id'] == user_id and 'pending_migration' not in b]
+
+
+class FailOnce(FakeCollection):
+    """Raises from the named method the first time it is called"""
+
+    def __init__(self, docs=(), fail=None):
+        super().__init__(docs)
+        self.fail = fail
+
+    def _maybe_fail(self, name):
+        if self.fail == name:
+            self.fail = None
+            raise ConnectionError(f"lost connection during {name}")
+
+    def update_one(self, query, update, upsert=False):
+        self._maybe_fail('update_one')
+        return super().update_one(query, update, upsert)
+
+    def update_many(self, query, update):
+        self._maybe_fail('update_many')
+        return super().update_many(query, update)
+
+
+# ------------------------------------------------------------
+# Appends
+# ------------------------------------------------------------
+
+def test_buckets_are_closed_when_full():
+    buckets = FakeCollection()
+    user_id = ObjectId()
+    for i in range(7):
+        history_buckets.append_predictions(buckets, user_id, predictions(1, offset=i), bucket_size=3)
+
+    docs = sorted(visible(buckets, user_id), key=lambda b: b['first_ts'])
+    assert [b['count'] for b in docs] == [3, 3, 1]
+    assert [b['closed'] for b in docs] == [True, True, False]
+    assert [p['n'] for b in docs for p in b['predictions']] == list(range(7))
+
+
+def test_a_bucket_that_cannot_take_the_chunk_is_closed_not_reused():
+    buckets = FakeCollection()
+    user_id = ObjectId()
+    history_buckets.append_predictions(buckets, user_id, predictions(2), bucket_size=3)
+    history_buckets.append_predictions(buckets, user_id, predictions(2, offset=2), bucket_size=3)
+    # Room for one more in the first bucket, but appends only go to the newest
+    history_buckets.append_predictions(buckets, user_id, predictions(1, offset=4), bucket_size=3)
+
+    docs = sorted(visible(buckets, user_id), key=lambda b: b['first_ts'])
+    assert [b['count'] for b in docs] == [2, 3]
+    assert [b['closed'] for b in docs] == [True, True]
+    newest_first = history_buckets.recent_predictions(buckets, user_id)
+    assert [p['n'] for p in newest_first] == [4, 3, 2, 1, 0]
+
+
+class RacingUpsert(FakeCollection):
+    """Another writer's upsert commits between this one's match and its insert"""
+
+    def __init__(self, user_id, docs=()):
+        super().__init__(docs)
+        self.rival = {'user_id': user_id, 'closed': False, 'count': 1, 'first_ts': START,
+                      'last_ts': START, 'predictions': [{'timestamp': START, 'n': -1}]}
+        history_buckets.ensure_bucket_indexes(self)
+
+    def _matching(self, query):
+        # Only the upsert's query: the user's open buckets, whatever their count
+        if self.rival is not None and 'user_id' in query and query.get('closed') is False and 'count' not in query:
+            rival, self.rival = self.rival, None
+            self.insert_one(rival)
+            return []
+        return super()._matching(query)
+
+
+def test_a_racing_upsert_appends_to_the_other_writers_bucket():
+    user_id = ObjectId()
+    buckets = RacingUpsert(user_id)
+
+    history_buckets.append_predictions(buckets, user_id, predictions(2), bucket_size=3)
+
+    docs = visible(buckets, user_id)
+    assert len(docs) == 1
+    assert (docs[0]['count'], docs[0]['closed']) == (3, True)
+    assert [p['n'] for p in docs[0]['predictions']] == [-1, 0, 1]
+
+
+def test_a_race_does_not_overfill_the_other_writers_bucket():
+    user_id = ObjectId()
+    buckets = RacingUpsert(user_id)
+
+    history_buckets.append_predictions(buckets, user_id, predictions(3), bucket_size=3)
+
+    docs = sorted(visible(buckets, user_id), key=lambda b: b['first_ts'])
+    assert [(b['count'], b['closed']) for b in docs] == [(1, True), (3, True)]
+
+
+def test_index_creation_closes_extra_open_buckets_first():
+    user_id = ObjectId()
+    open_bucket = {'user_id': user_id, 'closed': False, 'count': 1, 'predictions': []}
+    buckets = FakeCollection([
+        dict(open_bucket, _id=ObjectId(), first_ts=START),
+        dict(open_bucket, _id=ObjectId(), first_ts=START + timedelta(days=1)),
+        dict(open_bucket, _id=ObjectId(), user_id=ObjectId(), first_ts=START),
+    ])
+
+    history_buckets.ensure_bucket_indexes(buckets)
+
+    assert [(b['first_ts'], b['closed']) for b in buckets.docs if b['user_id'] == user_id] == \
+        [(START, True), (START + timedelta(days=1), False)]
+    with pytest.raises(DuplicateKeyError):
+        buckets.insert_one(dict(open_bucket, first_ts=START))
+
+
+def test_recent_predictions_reads_newest_first_with_limit():
+    buckets = FakeCollection()
+    user_id = ObjectId()
+    history_buckets.append_predictions(buckets, user_id, predictions(10), bucket_size=4)
+
+    assert [p['n'] for p in history_buckets.recent_predictions(buckets, user_id, limit=5)] == [9, 8, 7, 6, 5]
+
+
+# ------------------------------------------------------------
+# Migration
+# ------------------------------------------------------------
+
+def make_users(count, history=5):
+    return [{'_id': ObjectId(), 'created_at': START, 'predictions': predictions(history)} for _ in range(count)]
+
+
+def assert_migrated(users, buckets, bucket_size, history=5):
+    for user in users.docs:
+        assert 'predictions' not in user
+        docs = visible(buckets, user['_id'])
+        assert all(b['closed'] for b in docs)
+        assert max(b['count'] for b in docs) <= bucket_size
+        moved = sorted(p['n'] for b in docs for p in b['predictions'])
+        assert moved == list(range(history))
+    assert not [b for b in buckets.docs if 'pending_migration' in b]
+
+
+def test_migrate_user_moves_the_array_into_closed_buckets():
+    users = FakeCollection(make_users(1))
+    buckets = FakeCollection()
+    user_id = users.docs[0]['_id']
+
+    assert history_buckets.migrate_user(users, buckets, user_id, bucket_size=2) == 5
+    assert_migrated(users, buckets, bucket_size=2)
+    assert history_buckets.migrate_user(users, buckets, user_id, bucket_size=2) == 0
+
+
+def test_rerun_discards_buckets_of_a_move_that_never_committed():
+    users = FailOnce(make_users(3), fail='update_one')
+    buckets = FakeCollection()
+
+    with pytest.raises(ConnectionError):
+        history_buckets.migrate_embedded_history(users, buckets, bucket_size=2)
+    # The copy is hidden while the user document still holds the array
+    assert buckets.docs and all('pending_migration' in b for b in buckets.docs)
+
+    assert history_buckets.migrate_embedded_history(users, buckets, bucket_size=2) == (3, 15)
+    assert_migrated(users, buckets, bucket_size=2)
+
+
+def test_rerun_reveals_buckets_of_a_move_that_committed():
+    users = FakeCollection(make_users(3))
+    buckets = FailOnce(fail='update_many')
+
+    with pytest.raises(ConnectionError):
+        history_buckets.migrate_embedded_history(users, buckets, bucket_size=2)
+    # The array is gone but its buckets are still hidden
+    assert sum('predictions' not in user for user in users.docs) == 1
+
+    assert history_buckets.migrate_embedded_history(users, buckets, bucket_size=2) == (2, 10)
+    assert_migrated(users, buckets, bucket_size=2)
+
+
+def test_migration_retries_when_the_array_changes_during_the_copy():
+    class AppendDuringCopy(FakeCollection):
+        appended = False
+
+        def update_one(self, query, update, upsert=False):
+            if not self.appended:
+                self.appended = True
+                self.docs[0]['predictions'].append({'timestamp': START + timedelta(hours=1), 'n': 5})
+            return super().update_one(query, update, upsert)
+
+    users = AppendDuringCopy(make_users(1))
+    buckets = FakeCollection()
+
+    assert history_buckets.migrate_user(users, buckets, users.docs[0]['_id'], bucket_size=4) == 6
+    assert_migrated(users, buckets, bucket_size=4, history=6)
@@ -0,0 +1,130 @@
+"""Identity cache: LRU and TTL, and invalidations racing with a load."""
+import threading
+from types import SimpleNamespace
+
+import pytest
+from bson.objectid import ObjectId
+
+import identity_cache
+from identity_cache import IdentityCache, user_summary
+
+
+class Users:
+    """Loader over a dict of summaries that counts its calls"""
+
+    def __init__(self, **users):
+        self.users = users
+        self.loads = 0
+
+    def __call__(self, identity):
+        self.loads += 1
+        summary = self.users.get(identity)
+        return dict(summary) if summary else None
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=100.0)
+    monkeypatch.setattr(identity_cache, 'time', SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def test_user_summary_never_carries_the_password():
+    user_id = ObjectId()
+    summary = user_summary({'_id': user_id, 'name': 'Ada', 'email': 'ada@example.com', 'password': 'hash'})
+
+    assert summary == {'id': str(user_id), 'name': 'Ada', 'email': 'ada@example.com'}
+    assert user_summary(None) is None
+
+
+def test_hits_are_served_from_memory_as_copies():
+    users = Users(ada={'name': 'Ada'})
+    cache = IdentityCache(users)
+
+    cache.get('ada')['name'] = 'changed by the caller'
+
+    assert cache.get('ada') == {'name': 'Ada'}
+    assert users.loads == 1
+    assert cache.stats()['hit_ratio'] == 0.5
+
+
+def test_unknown_identities_are_not_cached():
+    users = Users()
+    cache = IdentityCache(users)
+
+    assert cache.get('ghost') is None and cache.get('ghost') is None
+    assert users.loads == 2 and len(cache) == 0
+
+
+def test_entries_expire_after_the_ttl(clock):
+    users = Users(ada={'name': 'Ada'})
+    cache = IdentityCache(users, ttl_seconds=60)
+    cache.get('ada')
+    clock.now += 60
+    cache.get('ada')
+    assert users.loads == 1
+
+    clock.now += 1
+    cache.get('ada')
+    assert users.loads == 2
+
+
+def test_the_least_recently_used_identity_is_evicted():
+    users = Users(a={'n': 1}, b={'n': 2}, c={'n': 3})
+    cache = IdentityCache(users, max_entries=2)
+    cache.get('a')
+    cache.get('b')
+    cache.get('a')
+    cache.get('c')
+
+    cache.get('a')
+    assert users.loads == 3
+    cache.get('b')
+    assert users.loads == 4
+    assert cache.stats()['evictions'] == 2
+
+
+def test_invalidate_reloads_the_changed_user():
+    users = Users(ada={'name': 'Ada'})
+    cache = IdentityCache(users)
+    cache.get('ada')
+
+    users.users['ada'] = {'name': 'Ada Lovelace'}
+    cache.invalidate('ada')
+
+    assert cache.get('ada') == {'name': 'Ada Lovelace'}
+    assert cache.stats()['invalidations'] == 1
+
+
+@pytest.mark.parametrize('forget', [lambda cache: cache.invalidate('ada'), IdentityCache.clear],
+                         ids=['invalidate', 'clear'])
+def test_a_load_racing_with_an_invalidation_is_not_cached(forget):
+    loading, invalidated = threading.Event(), threading.Event()
+    users = Users(ada={'name': 'Ada'})
+
+    def slow_loader(identity):
+        # Reads the user before the update and returns after the invalidation
+        summary = users(identity)
+        loading.set()
+        invalidated.wait(5)
+        return summary
+
+    cache = IdentityCache(slow_loader)
+    reader = threading.Thread(target=cache.get, args=('ada',))
+    reader.start()
+    loading.wait(5)
+    users.users['ada'] = {'name': 'Ada Lovelace'}
+    forget(cache)
+    invalidated.set()
+    reader.join(5)
+
+    assert len(cache) == 0
+    assert cache.get('ada') == {'name': 'Ada Lovelace'}
+
+
+def test_size_zero_disables_the_cache():
+    users = Users(ada={'name': 'Ada'})
+    cache = IdentityCache(users, max_entries=0)
+
+    assert cache.get('ada') == cache.get('ada') == {'name': 'Ada'}
+    assert users.loads == 2 and len(cache) == 0
@@ -0,0 +1,137 @@
+"""Inference engines: traced Keras serving, padded batch sizes and TFLite (de)quantization."""
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from inference import KerasEngine, TFLiteEngine, load_engine, start_warm_up
+
+INPUT_SHAPE = (8, 8, 3)
+
+
+@pytest.fixture(scope='module')
+def model():
+    tf.keras.utils.set_random_seed(0)
+    inputs = tf.keras.Input(shape=INPUT_SHAPE)
+    x = tf.keras.layers.Conv2D(4, 3, activation='relu')(inputs)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    outputs = tf.keras.layers.Dense(5, activation='softmax')(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+def images(count, seed=0):
+    return np.random.default_rng(seed).uniform(-1, 1, (count,) + INPUT_SHAPE).astype(np.float32)
+
+
+def export_tflite(model, path, int8=False):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if int8:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([images(1, seed)] for seed in range(20))
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    path.write_bytes(converter.convert())
+    return str(path)
+
+
+@pytest.fixture(scope='module')
+def float_tflite(model, tmp_path_factory):
+    return export_tflite(model, tmp_path_factory.mktemp('tflite') / 'model.tflite')
+
+
+@pytest.mark.parametrize('count', [1, 3, 4, 9])
+def test_keras_engine_pads_and_splits_to_the_traced_sizes(model, count):
+    engine = KerasEngine(model, batch_sizes=(4, 1, 2))
+    engine.warm_up(runs=1)
+    batch = images(count)
+
+    output = engine.predict(batch)
+
+    assert output.shape == (count, 5)
+    np.testing.assert_allclose(output, model(batch).numpy(), atol=1e-5)
+
+
+def test_keras_warm_up_traces_every_batch_size_once(model):
+    engine = KerasEngine(model, batch_sizes=(1, 2), version='test/1')
+
+    stats = engine.warm_up(runs=1)
+    engine.predict(images(2))
+
+    assert engine.ready and engine.version == 'test/1'
+    assert sorted(engine._concrete) == [1, 2]
+    assert stats['batch_sizes'] == [1, 2] and stats['cold_start_s'] >= 0
+    # Calls after warm-up reuse the concrete functions instead of retracing
+    assert engine._serve.experimental_get_tracing_count() == 2
+    engine.close()
+    assert not engine.ready and engine.model is None
+
+
+def test_a_saved_keras_file_is_served_with_a_file_version(model, tmp_path):
+    path = str(tmp_path / 'model.keras')
+    model.save(path)
+
+    engine = load_engine(path, backend='keras', batch_sizes=(1,))
+
+    assert engine.version.startswith('model.keras@')
+    np.testing.assert_allclose(engine.predict(images(1)), model(images(1)).numpy(), atol=1e-5)
+
+
+def test_a_failed_warm_up_still_serves(monkeypatch):
+    class Broken:
+        ready = False
+
+        def warm_up(self):
+            raise RuntimeError('no memory')
+
+    engine, done = Broken(), []
+    start_warm_up(engine, on_done=done.append).join(timeout=5)
+
+    assert engine.ready and done == [None]
+
+
+@pytest.mark.parametrize('count', [1, 3, 4, 9])
+def test_tflite_matches_keras_for_any_batch_size(model, float_tflite, count):
+    engine = TFLiteEngine(float_tflite, batch_sizes=(1, 2, 4))
+    batch = images(count)
+
+    output = engine.predict(batch)
+
+    assert output.dtype == np.float32 and output.shape == (count, 5)
+    np.testing.assert_allclose(output, model(batch).numpy(), atol=1e-5)
+
+
+def test_tflite_warm_up_allocates_one_interpreter_per_batch_size(float_tflite):
+    engine = TFLiteEngine(float_tflite, batch_sizes=(1, 2, 4))
+
+    stats = engine.warm_up(runs=1)
+
+    assert engine.ready and stats['batch_sizes'] == [1, 2, 4]
+    assert sorted(engine._interpreters) == [1, 2, 4]
+    # A padded batch reuses the interpreter of its size
+    engine.predict(images(3))
+    assert sorted(engine._interpreters) == [1, 2, 4]
+    engine.close()
+    assert not engine.ready and not engine._interpreters
+
+
+def test_int8_models_take_and_return_float32(model, tmp_path):
+    engine = TFLiteEngine(export_tflite(model, tmp_path / 'model_int8.tflite', int8=True), batch_sizes=(1, 4))
+    batch = images(3)
+
+    output = engine.predict(batch)
+
+    assert engine._input['dtype'] == np.int8
+    assert output.dtype == np.float32
+    np.testing.assert_allclose(output, model(batch).numpy(), atol=0.05)
+
+
+def test_load_engine_picks_the_configured_backend(float_tflite, monkeypatch):
+    monkeypatch.setenv('MODEL_BACKEND', 'tflite')
+    monkeypatch.setenv('TFLITE_MODEL_PATH', float_tflite)
+
+    assert isinstance(load_engine('unused.h5'), TFLiteEngine)
+    monkeypatch.delenv('TFLITE_MODEL_PATH')
+    with pytest.raises(ValueError):
+        load_engine('unused.h5')
+    with pytest.raises(ValueError):
+        load_engine('unused.h5', backend='onnx')
@@ -0,0 +1,99 @@
+"""/metrics renders valid Prometheus text, including queues that share a name."""
+import re
+import threading
+
+import pytest
+from flask import Flask
+
+from metrics import CONTENT_TYPE, Counter, Registry, instrument_app
+from write_behind import WriteBehindQueue
+
+_SAMPLE = re.compile(
+    r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)'
+    r'(?P<labels>\{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*",?)*\})?'
+    r' (?P<value>[-+]?(?:[0-9.]+(?:e[-+]?[0-9]+)?|Inf|NaN))$'
+)
+_SUFFIXES = {'histogram': ('_bucket', '_sum', '_count')}
+
+
+def parse_exposition(text):
+    """Family name -> {sample line key: value}; fails on anything a scraper would reject"""
+    assert text.endswith('\n')
+    families, types, current = {}, {}, None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            current = line.split(' ', 3)[2]
+            assert current not in families, f'{current} declared twice'
+            families[current] = {}
+        elif line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            assert name == current and kind in ('counter', 'gauge', 'histogram', 'untyped')
+            types[name] = kind
+        else:
+            match = _SAMPLE.match(line)
+            assert match, f'invalid sample line {line!r}'
+            name = match['name']
+            suffixes = _SUFFIXES.get(types[current], ())
+            assert name == current or (name.endswith(suffixes) and name.rsplit('_', 1)[0] == current), line
+            key = name + (match['labels'] or '')
+            assert key not in families[current], f'duplicate sample {key}'
+            families[current][key] = float(match['value'])
+    return families
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    instrument_app(app)
+
+    @app.route('/ping')
+    def ping():
+        return 'pong'
+
+    return app.test_client()
+
+
+def test_metrics_endpoint_renders_valid_exposition_text(client):
+    gate = threading.Event()
+    queues = [WriteBehindQueue(lambda batch: gate.wait(5), name='metrics_test', flush_interval_ms=0)
+              for _ in range(2)]
+    try:
+        for queue in queues:
+            queue.put_many([{'n': 1}, {'n': 2}])
+        client.get('/ping').close()
+
+        response = client.get('/metrics')
+
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == CONTENT_TYPE
+        families = parse_exposition(response.get_data(as_text=True))
+        assert families['abdos_requests_total']['abdos_requests_total{endpoint="/ping",status="200"}'] == 1.0
+        # Both queues report into one family; the depth covers both
+        assert families['abdos_metrics_test_write_queue_depth'] == {'abdos_metrics_test_write_queue_depth': 4.0}
+    finally:
+        gate.set()
+        for queue in queues:
+            queue.close()
+
+
+def test_a_metric_name_can_only_be_registered_once():
+    registry = Registry()
+    Counter('abdos_things_total', 'Things', registry=registry)
+
+    with pytest.raises(ValueError):
+        Counter('abdos_things_total', 'Things again', registry=registry)
+
+
+def test_queues_with_their_own_registry_render_their_own_metrics():
+    registry = Registry()
+    queue = WriteBehindQueue(lambda batch: None, name='metrics_test', registry=registry)
+    try:
+        queue.put({'n': 1})
+        queue.flush(timeout=5)
+    finally:
+        queue.close()
+
+    families = parse_exposition(registry.render())
+    assert families['abdos_metrics_test_write_records_total'] == {
+        'abdos_metrics_test_write_records_total{result="written"}': 1.0
+    }
@@ -0,0 +1,148 @@
+"""Model registry: config parsing, hot-swapping and unloading once leases and queued work drain."""
+import os
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+from batching import MicroBatcher
+from model_registry import ModelRegistry, parse_model_config, read_model_config
+
+
+class FakeEngine:
+    def __init__(self, version):
+        self.version = version
+        self.closed = False
+        self.warmed_up = False
+
+    def predict(self, batch):
+        assert not self.closed, f'{self.version} was unloaded'
+        return np.zeros((len(batch), 2), dtype=np.float32)
+
+    def warm_up(self):
+        self.warmed_up = True
+
+    def close(self):
+        self.closed = True
+
+
+def add_version(base, version):
+    path = base / str(version) / 'saved_model'
+    path.mkdir(parents=True)
+    (path / 'saved_model.pb').write_bytes(b'')
+
+
+@pytest.fixture
+def registry(tmp_path):
+    add_version(tmp_path, 1)
+    registry = ModelRegistry('skin', str(tmp_path), loader=lambda path, version: FakeEngine(version),
+                             poll_interval_s=0)
+    registry.load_initial()
+    return registry
+
+
+def test_parse_model_config_reads_every_version_policy():
+    models = parse_model_config("""
+        model_config_list {
+          config {
+            name: 'a'  # comment
+            base_path: "/models/a"
+            model_version_policy { specific { versions: 3 versions: 1 } }
+          }
+          config { name: 'b' base_path: '/models/b' model_version_policy { all {} } }
+          config { name: 'c' base_path: 'relative/c' model_platform: 'tflite'
+                   model_version_policy { latest { num_versions: 2 } } }
+          config { name: 'd' base_path: '/models/d' }
+        }
+    """)
+
+    assert models == [
+        {'name': 'a', 'base_path': '/models/a', 'model_platform': 'tensorflow', 'version_policy': ('specific', [1, 3])},
+        {'name': 'b', 'base_path': '/models/b', 'model_platform': 'tensorflow', 'version_policy': ('all', None)},
+        {'name': 'c', 'base_path': 'relative/c', 'model_platform': 'tflite', 'version_policy': ('latest', 2)},
+        {'name': 'd', 'base_path': '/models/d', 'model_platform': 'tensorflow', 'version_policy': ('latest', 1)},
+    ]
+
+
+def test_the_checked_in_config_declares_the_served_model():
+    config_path = os.path.join(os.path.dirname(__file__), '..', 'models', 'model_config.config')
+
+    assert read_model_config(config_path)['name'] == 'skin_condition'
+    with pytest.raises(ValueError):
+        read_model_config(config_path, 'missing')
+
+
+def test_only_complete_versions_allowed_by_the_policy_are_served(tmp_path):
+    add_version(tmp_path, 1)
+    add_version(tmp_path, 4)
+    (tmp_path / '7' / 'saved_model').mkdir(parents=True)
+
+    assert ModelRegistry('skin', str(tmp_path)).target_version() == 4
+    assert ModelRegistry('skin', str(tmp_path), version_policy=('specific', [1])).target_version() == 1
+    assert ModelRegistry('skin', str(tmp_path), pinned_version='7').target_version() is None
+
+
+def test_refresh_warms_up_and_swaps_in_a_new_version(registry, tmp_path):
+    old = registry.current
+    swapped = []
+    registry.add_listener(swapped.append)
+    assert registry.refresh() is False
+
+    add_version(tmp_path, 2)
+    assert registry.refresh() is True
+
+    assert registry.version == 2
+    assert registry.current.warmed_up and swapped == [registry.current]
+    # Nothing held version 1, so it is unloaded straight away
+    assert old.closed
+
+
+def test_a_leased_version_is_unloaded_when_the_last_lease_ends(registry, tmp_path):
+    with registry.lease() as engine:
+        add_version(tmp_path, 2)
+        registry.refresh()
+        assert registry.stats()['draining_leases'] == {'1': 1}
+        engine.predict(np.zeros((1, 4)))
+        assert not engine.closed
+
+    assert engine.closed
+    assert registry.stats()['draining_leases'] == {}
+
+
+def test_queued_work_holds_its_version_after_the_lease_ends(registry, tmp_path):
+    future = Future()
+    with registry.lease() as engine:
+        registry.hold_until_done(engine, future)
+    add_version(tmp_path, 2)
+    registry.refresh()
+
+    assert not engine.closed
+    future.set_result(None)
+    assert engine.closed
+
+
+def test_a_timed_out_request_does_not_unload_its_queued_batch(registry, tmp_path):
+    gate = threading.Event()
+    batcher = MicroBatcher(None, max_wait_ms=0)
+    try:
+        # Occupy the batcher's worker so the request's item stays queued
+        batcher.submit(np.zeros((1, 4)), predict_fn=lambda batch: gate.wait(5) and np.zeros((len(batch), 2)))
+        with registry.lease() as engine:
+            future = batcher.submit(np.zeros((1, 4)), predict_fn=engine.predict)
+            registry.hold_until_done(engine, future)
+        add_version(tmp_path, 2)
+        registry.refresh()
+        assert not engine.closed
+        gate.set()
+
+        assert future.result(timeout=5).shape == (1, 2)
+    finally:
+        gate.set()
+        batcher.close()
+    assert engine.closed
+
+
+def test_hold_until_done_needs_a_lease(registry):
+    with pytest.raises(RuntimeError):
+        registry.hold_until_done(registry.current, Future())
@@ -0,0 +1,84 @@
+"""PasswordHasher: which stored hashes get upgraded, and the bounded executor."""
+import threading
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from passwords import HasherBusy, PasswordHasher, default_method, parse_method
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(method='pbkdf2:sha256:2000', max_workers=1, max_pending=2)
+    yield hasher
+    hasher.close()
+
+
+def test_default_is_werkzeugs_default():
+    hasher = PasswordHasher()
+    try:
+        assert hasher.method == default_method()
+        # A hash made the way the servers made them before is not touched
+        assert not hasher.needs_rehash(generate_password_hash('secret'))
+    finally:
+        hasher.close()
+
+
+@pytest.mark.parametrize('method,expected', [
+    ('scrypt', ('scrypt', (32768, 8, 1))),
+    ('scrypt:65536:8:1', ('scrypt', (65536, 8, 1))),
+    ('pbkdf2:sha256:600000', ('pbkdf2:sha256', (600000,))),
+    ('pbkdf2:sha512:1000', ('pbkdf2:sha512', (1000,))),
+])
+def test_parse_method(method, expected):
+    assert parse_method(method) == expected
+
+
+@pytest.mark.parametrize('configured,stored,expected', [
+    # Same algorithm, lower cost: upgrade
+    ('pbkdf2:sha256:600000', 'pbkdf2:sha256:260000$salt$hash', True),
+    ('scrypt:65536:8:1', 'scrypt:32768:8:1$salt$hash', True),
+    # Same or higher cost: leave alone
+    ('pbkdf2:sha256:600000', 'pbkdf2:sha256:600000$salt$hash', False),
+    ('pbkdf2:sha256:600000', 'pbkdf2:sha256:1000000$salt$hash', False),
+    ('scrypt', 'scrypt:32768:8:1$salt$hash', False),
+    # Different algorithm: never converted, in either direction
+    ('pbkdf2:sha256:600000', 'scrypt:32768:8:1$salt$hash', False),
+    ('scrypt:65536:8:1', 'pbkdf2:sha256:260000$salt$hash', False),
+    ('pbkdf2:sha512:600000', 'pbkdf2:sha256:1000$salt$hash', False),
+])
+def test_needs_rehash(configured, stored, expected):
+    hasher = PasswordHasher(method=configured)
+    try:
+        assert hasher.needs_rehash(stored) is expected
+    finally:
+        hasher.close()
+
+
+def test_hash_and_verify(hasher):
+    stored = hasher.hash('secret')
+    assert stored.startswith('pbkdf2:sha256:2000$')
+    assert hasher.verify(stored, 'secret')
+    assert not hasher.verify(stored, 'wrong')
+
+
+def test_upgrade_saves_a_hash_with_the_configured_cost(hasher):
+    saved = []
+    done = threading.Event()
+    hasher.upgrade('secret', lambda new_hash: (saved.append(new_hash), done.set()))
+
+    assert done.wait(5)
+    assert saved[0].startswith('pbkdf2:sha256:2000$')
+    assert hasher.verify(saved[0], 'secret')
+
+
+def test_excess_operations_are_refused(hasher):
+    release = threading.Event()
+    hasher._submit('hash', release.wait)
+    hasher._submit('hash', release.wait)
+    try:
+        with pytest.raises(HasherBusy):
+            hasher.hash('secret')
+        assert hasher.stats()['rejected'] == 1
+    finally:
+        release.set()
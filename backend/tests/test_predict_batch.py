@@ -0,0 +1,89 @@
+"""/predict/batch end to end, on a tiny TFLite model and in-memory storage."""
+import importlib
+import io
+import json
+import sys
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from PIL import Image
+
+
+def tiny_model(path):
+    tf.keras.utils.set_random_seed(0)
+    inputs = tf.keras.Input(shape=(224, 224, 3))
+    x = tf.keras.layers.GlobalAveragePooling2D()(inputs)
+    outputs = tf.keras.layers.Dense(7, activation='softmax')(x)
+    path.write_bytes(tf.lite.TFLiteConverter.from_keras_model(tf.keras.Model(inputs, outputs)).convert())
+    return str(path)
+
+
+@pytest.fixture(scope='module')
+def model_api(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('model_api')
+    with pytest.MonkeyPatch.context() as patch:
+        for name, value in {
+            'MODEL_BACKEND': 'tflite', 'TFLITE_MODEL_PATH': tiny_model(tmp / 'model.tflite'),
+            'STORAGE_BACKEND': 'memory', 'BATCH_MAX_IMAGES': '3', 'IMAGE_STORE': '',
+            'PREDICTION_CACHE_DIR': '', 'MODEL_POLL_INTERVAL_S': '0',
+        }.items():
+            patch.setenv(name, value)
+        sys.modules.pop('model_api', None)
+        module = importlib.import_module('model_api')
+    yield module
+    module.batcher.close()
+    module.history_writer.close()
+
+
+def image(color, fmt='PNG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), color).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def post_batch(model_api, uploads):
+    client = model_api.app.test_client()
+    data = {'images': [(io.BytesIO(body), name) for name, body in uploads]}
+    return client.post('/predict/batch', data=data, content_type='multipart/form-data')
+
+
+def test_every_image_gets_a_line_then_a_summary(model_api):
+    response = post_batch(model_api, [('red.png', image('red')), ('blue.jpg', image('blue', 'JPEG')),
+                                      ('notes.txt', b'not an image')])
+
+    assert response.status_code == 200 and response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    results = {line['index']: line for line in lines[:-1]}
+    assert sorted(results) == [0, 1, 2]
+    assert results[0]['filename'] == 'red.png' and results[0]['class_name'] in model_api.CONDITIONS
+    assert 'error' in results[2] and 'JPEG and PNG' in results[2]['error']
+    assert lines[-1] == {'done': True, 'count': 3, 'saved': 0}
+
+
+def test_a_repeated_image_is_answered_like_the_first(model_api):
+    first = post_batch(model_api, [('a.png', image('green'))]).get_data(as_text=True).splitlines()[0]
+    again = post_batch(model_api, [('a.png', image('green'))]).get_data(as_text=True).splitlines()[0]
+
+    assert json.loads(first) == json.loads(again)
+
+
+def test_too_many_images_is_a_bad_request(model_api):
+    response = post_batch(model_api, [(f'{i}.png', image('red')) for i in range(4)])
+
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Too many images: 4 sent, at most 3 per request'
+
+
+def test_no_images_is_a_bad_request(model_api):
+    response = model_api.app.test_client().post('/predict/batch', data={}, content_type='multipart/form-data')
+
+    assert response.status_code == 400
+
+
+def test_predictions_match_the_engine(model_api):
+    body = image((10, 200, 30))
+    line = json.loads(post_batch(model_api, [('x.png', body)]).get_data(as_text=True).splitlines()[0])
+
+    expected = model_api.registry.current.predict(model_api.preprocess_image_bytes(body)[np.newaxis])[0]
+    assert line['predicted_class'] == int(np.argmax(expected))
@@ -0,0 +1,146 @@
+"""Prediction cache: LRU and TTL, model version changes and the shared disk tier."""
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import prediction_cache
+from prediction_cache import PredictionCache, digest_bytes
+
+A, B, C = (digest_bytes(name) for name in (b'a', b'b', b'c'))
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(prediction_cache, 'time', SimpleNamespace(time=clock))
+    return clock
+
+
+def disk_files(root, suffix=''):
+    return sorted(name for _, _, files in os.walk(root) for name in files if name.endswith(suffix))
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = PredictionCache(max_entries=2, model_version='1')
+    cache.put(A, [0.1, 0.9])
+    cache.put(B, [0.2, 0.8])
+    assert cache.get(A) == [0.1, 0.9]
+    cache.put(C, [0.3, 0.7])
+
+    assert cache.get(B) is None
+    assert cache.get(A) == [0.1, 0.9] and cache.get(C) == [0.3, 0.7]
+    assert len(cache) == 2
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = PredictionCache(ttl_seconds=60, model_version='1')
+    cache.put(A, [1.0])
+    clock.now += 60
+    assert cache.get(A) == [1.0]
+    clock.now += 1
+    assert cache.get(A) is None
+    assert len(cache) == 0
+
+
+def test_size_zero_disables_the_cache():
+    cache = PredictionCache(max_entries=0)
+    cache.put(A, [1.0])
+    assert cache.get(A) is None
+    assert cache.stats()['misses'] == 0
+
+
+def test_a_new_model_version_invalidates_memory_and_drops_late_results(tmp_path):
+    cache = PredictionCache(disk_dir=str(tmp_path), model_version='1')
+    cache.put(A, [1.0])
+
+    cache.set_model_version('2')
+    assert cache.get(A) is None
+    # Computed by version 1 while the swap happened
+    cache.put(B, [1.0], version='1')
+    assert cache.get(B) is None
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_the_disk_tier_is_shared_between_processes(tmp_path):
+    writer = PredictionCache(disk_dir=str(tmp_path), model_version='v1/final')
+    reader = PredictionCache(disk_dir=str(tmp_path), model_version='v1/final')
+    writer.put(A, [0.25, 0.75])
+
+    assert reader.get(A) == [0.25, 0.75]
+    assert reader.stats()['disk_hits'] == 1
+    assert reader.get(A) == [0.25, 0.75]
+    assert reader.stats()['memory_hits'] == 1
+    # Other versions have their own directory
+    assert PredictionCache(disk_dir=str(tmp_path), model_version='2').get(A) is None
+
+
+def test_swapping_versions_keeps_disk_entries_other_workers_still_serve(tmp_path):
+    swapped = PredictionCache(disk_dir=str(tmp_path), model_version='1')
+    still_on_1 = PredictionCache(disk_dir=str(tmp_path), model_version='1')
+    swapped.put(A, [1.0])
+
+    swapped.set_model_version('2')
+
+    assert still_on_1.get(A) == [1.0]
+
+
+def test_sweep_deletes_expired_entries_of_every_version(tmp_path, clock):
+    old_version = PredictionCache(disk_dir=str(tmp_path), ttl_seconds=60, model_version='1')
+    old_version.put(A, [1.0])
+    clock.now += 30
+    cache = PredictionCache(disk_dir=str(tmp_path), ttl_seconds=60, model_version='2')
+    cache.put(B, [1.0])
+    os.utime(old_version._disk_path(A, '1'), (clock.now - 30, clock.now - 30))
+
+    assert cache.sweep_disk(now=clock.now + 40) == 1
+
+    assert disk_files(tmp_path) == [f"{B}.json"]
+    # The emptied directory of version 1 is gone too
+    assert os.listdir(tmp_path) == ['2']
+
+
+def test_sweep_keeps_the_newest_entries_up_to_the_limit(tmp_path, clock):
+    cache = PredictionCache(disk_dir=str(tmp_path), disk_max_entries=2, model_version='1')
+    for age, digest in enumerate([A, B, C]):
+        cache.put(digest, [1.0])
+        os.utime(cache._disk_path(digest, '1'), (clock.now - 10 + age, clock.now - 10 + age))
+
+    assert cache.sweep_disk() == 1
+    assert disk_files(tmp_path) == sorted([f"{B}.json", f"{C}.json"])
+    assert cache.stats()['disk_evictions'] == 1
+
+
+def test_put_starts_a_sweep_once_the_interval_elapsed(tmp_path, clock):
+    cache = PredictionCache(disk_dir=str(tmp_path), ttl_seconds=60, sweep_interval_s=100, model_version='1')
+    cache.put(A, [1.0])
+    os.utime(cache._disk_path(A, '1'), (clock.now - 120, clock.now - 120))
+    clock.now += 100
+
+    cache.put(B, [1.0])
+    for thread in [t for t in prediction_cache.threading.enumerate() if t.name == 'prediction-cache-sweep']:
+        thread.join(timeout=5)
+
+    assert disk_files(tmp_path) == [f"{B}.json"]
+
+
+def test_a_failed_disk_write_leaves_no_temp_file(tmp_path, monkeypatch):
+    def broken_dump(value, f):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(prediction_cache.json, 'dump', broken_dump)
+    cache = PredictionCache(disk_dir=str(tmp_path), model_version='1')
+
+    cache.put(A, [1.0])
+
+    assert cache.get(A) == [1.0]
+    assert disk_files(tmp_path) == []
@@ -0,0 +1,210 @@
+"""Pre-aggregated statistics: increments on write and rebuilds from history."""
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+
+import prediction_stats
+from prediction_stats import aggregate_predictions, month_range, rebuild_stats, summarize
+from storage import MemoryStorage, MongoStorage
+
+
+def record(user_id, month, label='Melanoma', confidence=80.0):
+    return {'user_id': user_id, 'timestamp': datetime(2026, month, 15, tzinfo=timezone.utc),
+            'label': label, 'predicted_class': 4, 'confidence': confidence}
+
+
+def write_history(storage, records):
+    # What backend/model_api.py does for each write-behind batch
+    storage.insert_predictions(records)
+    storage.increment_stats(aggregate_predictions(records))
+
+
+def stats_of(storage, *user_ids):
+    return {user_id: summarize(storage.stats_months(user_id)) for user_id in user_ids}
+
+
+@pytest.fixture(autouse=True)
+def settle(monkeypatch):
+    """Runs the callables appended to it instead of sleeping before replacing"""
+    hooks = []
+
+    def sleep(seconds):
+        if hooks:
+            hooks.pop(0)()
+
+    monkeypatch.setattr(prediction_stats, 'time', SimpleNamespace(sleep=sleep))
+    return hooks
+
+
+def test_increments_match_a_rebuild():
+    storage = MemoryStorage()
+    alice, bob = ObjectId(), ObjectId()
+    write_history(storage, [record(alice, 1), record(alice, 1, 'Melanocytic Nevi', 60.0), record(bob, 2)])
+    write_history(storage, [record(alice, 3, confidence=90.0), record(bob, 2, 'Dermatofibroma')])
+    incremented = stats_of(storage, alice, bob)
+
+    assert rebuild_stats(storage) == (5, 3)
+    assert stats_of(storage, alice, bob) == incremented
+    assert incremented[alice]['total_predictions'] == 3
+    assert incremented[alice]['average_confidence'] == round((80 + 60 + 90) / 3, 2)
+    assert incremented[bob]['by_class'] == {'Melanoma': 1, 'Dermatofibroma': 1}
+
+
+def test_a_retried_batch_is_counted_once():
+    storage = MemoryStorage()
+    alice = ObjectId()
+    batch = [record(alice, 1), record(alice, 1), record(alice, 2)]
+    # An attempt that wrote part of the batch before failing
+    storage.insert_predictions(batch[:2])
+
+    write_history(storage, batch)
+
+    assert storage.insert_predictions(batch) == 0
+    assert stats_of(storage, alice)[alice]['total_predictions'] == 3
+    assert rebuild_stats(storage) == (3, 2)
+    assert stats_of(storage, alice)[alice]['total_predictions'] == 3
+
+
+def test_rebuild_fixes_drift_and_drops_months_without_history():
+    storage = MemoryStorage()
+    alice = ObjectId()
+    write_history(storage, [record(alice, 1)])
+    storage.increment_stats(aggregate_predictions([record(alice, 1), record(alice, 5)]))
+
+    rebuild_stats(storage, user_id=alice)
+
+    months = storage.stats_months(alice)
+    assert [(doc['month'], doc['count']) for doc in months] == [('2026-01', 1)]
+
+
+class LiveWrites:
+    """Storage whose history stream runs a write after its first record"""
+
+    def __init__(self, storage, write):
+        self.storage = storage
+        self.write = write
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def iter_predictions(self, **kwargs):
+        write, self.write = self.write, None
+        for row in self.storage.iter_predictions(**kwargs):
+            yield row
+            if write is not None:
+                write()
+                write = None
+
+
+def test_rebuild_keeps_summaries_created_while_it_runs():
+    storage = MemoryStorage()
+    alice, bob = ObjectId(), ObjectId()
+    write_history(storage, [record(alice, 1)])
+    storage.increment_stats(aggregate_predictions([record(alice, 4)]))
+
+    rebuild_stats(LiveWrites(storage, lambda: write_history(storage, [record(bob, 6)])))
+
+    assert [doc['month'] for doc in storage.stats_months(alice)] == ['2026-01']
+    assert [(doc['month'], doc['count']) for doc in storage.stats_months(bob)] == [('2026-06', 1)]
+
+
+def test_a_prediction_written_behind_the_cursor_is_not_lost():
+    storage = MemoryStorage()
+    alice = ObjectId()
+    write_history(storage, [record(alice, 1), record(alice, 2), record(alice, 3)])
+    storage.increment_stats(aggregate_predictions([record(alice, 2)]))
+    # Lands in January after the pass has already read January
+    late = dict(record(alice, 1), timestamp=datetime(2026, 1, 1, tzinfo=timezone.utc))
+
+    assert rebuild_stats(LiveWrites(storage, lambda: write_history(storage, [late]))) == (5, 3)
+
+    assert [(doc['month'], doc['count']) for doc in storage.stats_months(alice)] == \
+        [('2026-01', 2), ('2026-02', 1), ('2026-03', 1)]
+
+
+def test_an_increment_landing_after_the_pass_is_not_counted_twice(settle):
+    storage = MemoryStorage()
+    alice = ObjectId()
+    write_history(storage, [record(alice, 1)])
+    # Stored and read by the pass, but its increment is still on the way
+    in_flight = [record(alice, 1, confidence=40.0)]
+    storage.insert_predictions(in_flight)
+    settle.append(lambda: storage.increment_stats(aggregate_predictions(in_flight)))
+
+    rebuild_stats(storage, user_id=alice)
+
+    assert stats_of(storage, alice)[alice]['total_predictions'] == 2
+    assert stats_of(storage, alice)[alice]['average_confidence'] == 60.0
+
+
+def test_predictions_made_after_the_pass_started_are_counted_once():
+    storage = MemoryStorage()
+    alice = ObjectId()
+    write_history(storage, [record(alice, 1)])
+    now = {'user_id': alice, 'timestamp': datetime.now(timezone.utc), 'label': 'Melanoma', 'confidence': 50.0}
+
+    rebuild_stats(LiveWrites(storage, lambda: write_history(storage, [now])))
+
+    assert stats_of(storage, alice)[alice]['total_predictions'] == 2
+
+
+def test_months_that_keep_changing_keep_their_live_counts(settle, caplog):
+    storage = MemoryStorage()
+    alice = ObjectId()
+    write_history(storage, [record(alice, 1), record(alice, 2)])
+    storage.increment_stats(aggregate_predictions([record(alice, 2)]))
+    settle.extend(lambda: write_history(storage, [record(alice, 1)]) for _ in range(3))
+
+    # Both months, then January with one and with two more predictions
+    assert rebuild_stats(storage, max_rounds=3) == (2 + 2 + 3, 1)
+
+    assert [(doc['month'], doc['count']) for doc in storage.stats_months(alice)] == [('2026-01', 4), ('2026-02', 1)]
+    assert 'kept changing' in caplog.text
+
+
+def test_month_range_covers_the_calendar_month():
+    assert month_range('2026-12') == (datetime(2026, 12, 1, tzinfo=timezone.utc),
+                                      datetime(2027, 1, 1, tzinfo=timezone.utc))
+
+
+def test_rebuild_of_one_user_leaves_the_others_alone():
+    storage = MemoryStorage()
+    alice, bob = ObjectId(), ObjectId()
+    write_history(storage, [record(alice, 1), record(bob, 1)])
+    storage.increment_stats(aggregate_predictions([record(bob, 9)]))
+
+    rebuild_stats(storage, user_id=alice)
+
+    assert [doc['month'] for doc in storage.stats_months(bob)] == ['2026-01', '2026-09']
+
+
+class BulkInsertFails:
+    def __init__(self, details):
+        self.details = details
+
+    def insert_many(self, records, ordered=True):
+        raise BulkWriteError(self.details)
+
+
+def mongo_storage(predictions):
+    storage = MongoStorage.__new__(MongoStorage)
+    storage.predictions = predictions
+    return storage
+
+
+def test_mongo_insert_skips_duplicates_of_an_earlier_attempt():
+    details = {'nInserted': 1, 'writeErrors': [{'index': 0, 'code': 11000}], 'writeConcernErrors': []}
+    assert mongo_storage(BulkInsertFails(details)).insert_predictions([{}, {}]) == 1
+
+
+@pytest.mark.parametrize('details', [
+    {'nInserted': 0, 'writeErrors': [{'index': 0, 'code': 11000}, {'index': 1, 'code': 121}],
+     'writeConcernErrors': []},
+    {'nInserted': 2, 'writeErrors': [], 'writeConcernErrors': [{'code': 64}]},
+])
+def test_mongo_insert_raises_other_write_errors(details):
+    with pytest.raises(BulkWriteError):
+        mongo_storage(BulkInsertFails(details)).insert_predictions([{}, {}])
@@ -0,0 +1,50 @@
+"""The process pool returns what in-thread preprocessing returns, and gives up after its timeout."""
+import io
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from preprocess_pool import PreprocessBusy, PreprocessPool
+from preprocessing import preprocess_image
+
+
+def png_bytes(width=300, height=200):
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([x % 256, y % 256, (x + y) % 256], axis=-1).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, 'RGB').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def pool():
+    pool = PreprocessPool(1, slots=1, normalization='unit')
+    yield pool
+    pool.close()
+
+
+def test_worker_result_matches_in_thread_preprocessing(pool):
+    data = png_bytes()
+
+    result = pool.preprocess(data, timeout=30)
+
+    np.testing.assert_array_equal(result, preprocess_image(io.BytesIO(data), normalization='unit'))
+    # The slot went back to the pool
+    assert pool._free_slots.qsize() == 1
+
+
+def test_no_free_slot_within_the_timeout_raises_busy(pool):
+    slot = pool._free_slots.get()
+
+    with pytest.raises(PreprocessBusy):
+        pool.preprocess(png_bytes(), timeout=0.05)
+    pool._free_slots.put(slot)
+
+
+def test_a_slow_worker_times_out_and_its_slot_comes_back_when_done(pool):
+    with pytest.raises(FutureTimeoutError):
+        pool.preprocess(png_bytes(), timeout=0)
+
+    assert pool._free_slots.get(timeout=30) == 0
@@ -0,0 +1,58 @@
+"""
+The draft-mode decode path against the original full decode.
+
+Both paths use the same resize filter; the only difference allowed is the
+reduced DCT scale libjpeg decodes at, which must stay within a grey level or
+so on average and a few levels on any pixel.
+"""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from preprocessing import RESAMPLING, preprocess_image, preprocess_image_reference
+
+# In 0-255 grey levels
+MEAN_TOLERANCE = 1.5
+MAX_TOLERANCE = 8.0
+
+
+def synthetic_photo(width, height, fmt='JPEG', seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    r = 128 + 100 * np.sin(x / width * 6.0)
+    g = 128 + 100 * np.cos(y / height * 4.0)
+    b = 128 + 60 * np.sin((x + y) / (width + height) * 10.0)
+    pixels = np.stack([r, g, b], axis=-1) + rng.normal(0, 8, (height, width, 3))
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB').save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('resample', sorted(RESAMPLING))
+@pytest.mark.parametrize('size', [(640, 480), (1000, 750), (3024, 2268)])
+def test_draft_decode_matches_full_decode(size, resample):
+    data = synthetic_photo(*size)
+    fast = preprocess_image(io.BytesIO(data), normalization='unit', resample=resample)
+    reference = preprocess_image_reference(io.BytesIO(data), normalization='unit', resample=resample)
+
+    assert fast.shape == reference.shape == (224, 224, 3)
+    assert fast.dtype == np.float32
+    difference = np.abs(fast - reference) * 255.0
+    assert difference.mean() <= MEAN_TOLERANCE
+    assert difference.max() <= MAX_TOLERANCE
+
+
+def test_non_jpeg_is_decoded_in_full():
+    data = synthetic_photo(640, 480, fmt='PNG')
+    fast = preprocess_image(io.BytesIO(data), resample='lanczos')
+    reference = preprocess_image_reference(io.BytesIO(data), resample='lanczos')
+    np.testing.assert_allclose(fast, reference, atol=1e-6)
+
+
+def test_defaults_to_bicubic():
+    data = synthetic_photo(400, 300, fmt='PNG')
+    expected = np.asarray(Image.open(io.BytesIO(data)).convert('RGB').resize((224, 224), Image.BICUBIC))
+    result = preprocess_image(io.BytesIO(data), normalization='unit')
+    np.testing.assert_allclose(result * 255.0, expected, atol=1e-3)
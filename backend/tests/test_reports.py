@@ -0,0 +1,67 @@
+"""Disease reports: the read-only catalog, batch rendering and conditional responses."""
+import pytest
+from flask import Flask, request
+
+from reports import (REPORT_CATALOG, UNKNOWN_REPORT, InvalidReportRequest, generate_disease_report,
+                     generate_disease_reports, report_response)
+
+
+def test_reports_are_copies_with_the_confidence_added():
+    report = generate_disease_report('  Melanoma ', 0.875)
+
+    assert report['diagnosis'] == 'Melanoma' and report['confidence'] == '87.50%'
+    report['recommendations'] = []
+    assert 'confidence' not in REPORT_CATALOG['melanoma']
+    assert len(generate_disease_report('melanoma', 0.5)['recommendations']) == 4
+
+
+def test_the_catalog_cannot_be_modified():
+    with pytest.raises(TypeError):
+        REPORT_CATALOG['melanoma']['description'] = 'changed'
+    with pytest.raises(TypeError):
+        REPORT_CATALOG['new'] = UNKNOWN_REPORT
+    assert isinstance(REPORT_CATALOG['melanoma']['recommendations'], tuple)
+
+
+def test_unknown_diseases_get_the_unknown_report():
+    assert generate_disease_report('psoriasis', 0.2)['diagnosis'] == 'Unknown Condition'
+
+
+def test_batch_reports_keep_the_order_of_the_items():
+    reports = generate_disease_reports([{'disease': 'dermatofibroma', 'confidence': 0.4},
+                                        {'disease': 'Melanoma', 'confidence': '0.9'},
+                                        {'disease': 'psoriasis'}], max_items=3)
+
+    assert [(r['diagnosis'], r['confidence']) for r in reports] == [
+        ('Dermatofibroma', '40.00%'), ('Melanoma', '90.00%'), ('Unknown Condition', '0.00%')
+    ]
+
+
+@pytest.mark.parametrize('items, message', [
+    (None, 'non-empty list'),
+    ([], 'non-empty list'),
+    ([{'disease': 'melanoma'}] * 3, 'Too many items: 3 sent, at most 2'),
+    ([{'disease': 'melanoma'}, {'confidence': 0.5}], 'item 1'),
+    ([{'disease': 'melanoma', 'confidence': 'high'}], 'Invalid confidence for item 0'),
+])
+def test_bad_batches_are_refused_whole(items, message):
+    with pytest.raises(InvalidReportRequest, match=message):
+        generate_disease_reports(items, max_items=2)
+
+
+def test_a_matching_etag_gets_an_empty_304():
+    app = Flask(__name__)
+
+    @app.route('/report')
+    def report():
+        return report_response(generate_disease_report(request.args['disease'], 0.5), max_age_s=60)
+
+    client = app.test_client()
+    first = client.get('/report?disease=melanoma')
+    assert first.status_code == 200
+    assert first.headers['Cache-Control'] in ('private, max-age=60', 'max-age=60, private')
+
+    again = client.get('/report?disease=melanoma', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304 and again.data == b''
+    other = client.get('/report?disease=acne', headers={'If-None-Match': first.headers['ETag']})
+    assert other.status_code == 200
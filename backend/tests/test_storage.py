@@ -0,0 +1,196 @@
+"""Both storage backends behave the same; MongoStorage runs on the fake_mongo collections."""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson.objectid import ObjectId
+
+from fake_mongo import FakeCollection
+from prediction_stats import aggregate_predictions
+from storage import MemoryStorage, MongoStorage, Storage, UpdateOutcome
+
+START = datetime(2026, 3, 1, tzinfo=timezone.utc)
+
+
+def fake_mongo_storage():
+    storage = MongoStorage.__new__(MongoStorage)
+    for name in ('users', 'predictions', 'buckets', 'stats', 'blobs'):
+        setattr(storage, name, FakeCollection())
+    storage.ensure_indexes()
+    return storage
+
+
+@pytest.fixture(params=['memory', 'mongo'])
+def storage(request):
+    return MemoryStorage() if request.param == 'memory' else fake_mongo_storage()
+
+
+def prediction(user_id, minutes, label='Melanoma', confidence=80.0):
+    return {'user_id': user_id, 'timestamp': START + timedelta(minutes=minutes),
+            'label': label, 'predicted_class': 4, 'confidence': confidence}
+
+
+def test_a_backend_missing_a_method_cannot_be_created():
+    class Incomplete(Storage):
+        name = 'incomplete'
+
+        def find_user(self, include_password=False, **by):
+            return None
+
+    with pytest.raises(TypeError, match='abstract'):
+        Incomplete()
+
+
+# ------------------------------------------------------------
+# Users
+# ------------------------------------------------------------
+
+def test_users_are_found_by_one_key_without_password_or_history(storage):
+    user_id = storage.insert_user({'username': 'ada', 'email': 'ada@example.com', 'password': 'hash',
+                                   'predictions': [prediction(None, 0)]})
+
+    for by in ({'_id': user_id}, {'username': 'ada'}, {'email': 'ada@example.com'}):
+        user = storage.find_user(**by)
+        assert (user['_id'], user['username']) == (user_id, 'ada')
+        assert 'password' not in user and 'predictions' not in user
+    assert storage.find_user(include_password=True, username='ada')['password'] == 'hash'
+    assert storage.find_user(username='nobody') is None
+    assert storage.user_exists(email='ada@example.com') and not storage.user_exists(email='x@example.com')
+    with pytest.raises(ValueError):
+        storage.find_user(username='ada', email='ada@example.com')
+
+
+def test_update_user_reports_matched_and_modified(storage):
+    user_id = storage.insert_user({'username': 'ada', 'password': 'old'})
+
+    assert storage.update_user({'password': 'new'}, _id=user_id) == UpdateOutcome(1, 1)
+    assert storage.update_user({'password': 'new'}, _id=user_id) == UpdateOutcome(1, 0)
+    assert storage.update_user({'password': 'new'}, username='nobody') == UpdateOutcome(0, 0)
+    assert storage.find_user(include_password=True, _id=user_id)['password'] == 'new'
+
+
+# ------------------------------------------------------------
+# Flat history
+# ------------------------------------------------------------
+
+def test_inserting_a_retried_batch_skips_what_was_stored(storage):
+    user_id = ObjectId()
+    batch = [prediction(user_id, i) for i in range(3)]
+
+    assert storage.insert_predictions(batch[:2]) == 2
+    assert storage.insert_predictions(batch) == 1
+    assert all('_id' in record for record in batch)
+    assert storage.stored_prediction_ids([batch[0]['_id'], ObjectId()]) == {batch[0]['_id']}
+
+
+def test_pages_are_newest_first_and_continue_after_a_key(storage):
+    user_id = ObjectId()
+    # Two predictions share a timestamp; _id breaks the tie
+    records = [prediction(user_id, i) for i in (0, 1, 1, 2, 3)] + [prediction(ObjectId(), 5)]
+    storage.insert_predictions(records)
+    expected = sorted(records[:5], key=lambda r: (r['timestamp'], r['_id']), reverse=True)
+
+    first = storage.prediction_page(user_id, 2)
+    rest = storage.prediction_page(user_id, 10, after=(first[-1]['timestamp'], first[-1]['_id']))
+
+    assert [r['_id'] for r in first + rest] == [r['_id'] for r in expected]
+    assert set(storage.prediction_page(user_id, 1, fields=('confidence',))[0]) == {'_id', 'confidence'}
+
+
+def test_iter_predictions_limits_users_fields_and_time(storage):
+    alice, bob = ObjectId(), ObjectId()
+    storage.insert_predictions([prediction(alice, i) for i in range(5)] + [prediction(bob, 2)])
+
+    rows = list(storage.iter_predictions(user_id=alice, fields=('timestamp',), batch_size=2,
+                                         since=START + timedelta(minutes=1), until=START + timedelta(minutes=4)))
+
+    assert [r['timestamp'] for r in rows] == [START + timedelta(minutes=i) for i in (1, 2, 3)]
+    assert all(set(r) == {'_id', 'timestamp'} for r in rows)
+    assert len(list(storage.iter_predictions())) == 6
+
+
+# ------------------------------------------------------------
+# Statistics
+# ------------------------------------------------------------
+
+def stats(storage, user_id):
+    return [(doc['month'], doc['count'], doc['classes']) for doc in storage.stats_months(user_id)]
+
+
+def test_increments_add_up_and_bump_versions(storage):
+    user_id = ObjectId()
+    storage.increment_stats(aggregate_predictions([prediction(user_id, 0), prediction(user_id, 1, 'Nevi.x')]))
+    storage.increment_stats(aggregate_predictions([prediction(user_id, 2)]))
+
+    assert stats(storage, user_id) == [('2026-03', 3, {'Melanoma': 2, 'Nevi_x': 1})]
+    assert 'version' not in storage.stats_months(user_id)[0]
+    assert storage.stats_versions(user_id) == {(user_id, '2026-03'): 2}
+    assert storage.stats_versions(keys=[(user_id, '2026-03'), (user_id, '2026-04')]) == {(user_id, '2026-03'): 2}
+
+
+def test_replace_stats_only_writes_unchanged_summaries(storage):
+    alice, bob = ObjectId(), ObjectId()
+    storage.increment_stats(aggregate_predictions([prediction(alice, 0), prediction(bob, 0)]))
+    storage.increment_stats(aggregate_predictions([dict(prediction(alice, 0), timestamp=START.replace(month=1))]))
+    versions = storage.stats_versions()
+    # bob's summary changes after the versions were read
+    storage.increment_stats(aggregate_predictions([prediction(bob, 1)]))
+    rebuilt = aggregate_predictions([prediction(alice, 0, confidence=10.0), prediction(alice, 1, confidence=20.0),
+                                     prediction(bob, 0), dict(prediction(bob, 0), timestamp=START.replace(month=5))])
+
+    changed = storage.replace_stats(rebuilt, versions)
+
+    assert changed == {(bob, '2026-03')}
+    # alice: March rewritten, January (no history left) deleted
+    assert stats(storage, alice) == [('2026-03', 2, {'Melanoma': 2})]
+    assert storage.stats_months(alice)[0]['confidence_sum'] == 30.0
+    # bob: March keeps its live count, May is new and written
+    assert stats(storage, bob) == [('2026-03', 2, {'Melanoma': 2}), ('2026-05', 1, {'Melanoma': 1})]
+    assert storage.replace_stats(rebuilt, versions) >= {(alice, '2026-03'), (bob, '2026-05')}
+
+
+def test_replace_stats_reports_a_summary_created_meanwhile(storage):
+    user_id = ObjectId()
+    rebuilt = aggregate_predictions([prediction(user_id, 0)])
+    storage.increment_stats(aggregate_predictions([prediction(user_id, 0)]))
+
+    assert storage.replace_stats(rebuilt, {}) == {(user_id, '2026-03')}
+
+
+# ------------------------------------------------------------
+# Bucketed history and blobs
+# ------------------------------------------------------------
+
+def test_bucketed_history_reads_newest_first(storage):
+    user_id = ObjectId()
+    storage.append_history(user_id, [{'timestamp': START, 'n': 0}, {'timestamp': START, 'n': 1}])
+    storage.append_history(user_id, [{'timestamp': START, 'n': 2}])
+
+    assert [p['n'] for p in storage.recent_history(user_id)] == [2, 1, 0]
+    assert [p['n'] for p in storage.recent_history(user_id, limit=2)] == [2, 1]
+    assert storage.count_history(user_id) == 3
+    assert storage.count_history(ObjectId()) == 0
+
+
+def test_legacy_history_is_the_embedded_array(storage):
+    user_id = storage.insert_user({'username': 'ada', 'predictions': [{'n': 0}]})
+    other = storage.insert_user({'username': 'bob'})
+
+    assert storage.legacy_history(user_id) == [{'n': 0}]
+    assert storage.legacy_history(other) == []
+
+
+def test_blob_references_are_counted_and_forgotten_once_released(storage):
+    digest = 'ab' * 32
+    assert storage.acquire_blob(digest, size=10, content_type='image/png') == 1
+    assert storage.acquire_blob(digest) == 2
+    assert storage.release_blob(digest) == 1
+    later = datetime.now(timezone.utc) + timedelta(hours=1)
+    assert storage.unreferenced_blobs(released_before=later) == []
+
+    assert storage.release_blob(digest) == 0
+    assert storage.release_blob(digest) is None
+    assert storage.release_blob('cd' * 32) is None
+    assert storage.unreferenced_blobs(released_before=later) == [digest]
+    assert storage.forget_blob(digest, released_before=datetime.now(timezone.utc) - timedelta(hours=1)) is False
+    assert storage.forget_blob(digest, released_before=later) is True
+    assert storage.unreferenced_blobs(released_before=later) == []
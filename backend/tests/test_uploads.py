@@ -0,0 +1,66 @@
+"""Upload validation: format sniffing and header checks before any pixel is decoded."""
+import io
+
+import pytest
+from PIL import Image
+
+from uploads import UploadRejected, open_upload, sniff_format
+
+
+def encoded(fmt, size=(40, 30)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 100, 50)).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('fmt', ['JPEG', 'PNG'])
+def test_jpeg_and_png_are_opened_lazily_at_their_header_size(fmt):
+    stream = io.BytesIO(encoded(fmt))
+
+    img = open_upload(stream)
+
+    assert (img.format, img.size) == (fmt, (40, 30))
+    assert sniff_format(io.BytesIO(encoded(fmt))) == fmt
+
+
+def test_sniffing_leaves_the_stream_where_it_was():
+    stream = io.BytesIO(b'xx' + encoded('PNG'))
+    stream.seek(2)
+
+    assert sniff_format(stream) == 'PNG'
+    assert stream.tell() == 2
+
+
+@pytest.mark.parametrize('data', [encoded('GIF'), encoded('BMP'), b'', b'%PDF-1.7 not an image'])
+def test_other_formats_are_unsupported_media(data):
+    with pytest.raises(UploadRejected) as rejected:
+        open_upload(io.BytesIO(data))
+    assert rejected.value.status == 415
+
+
+def test_images_over_the_pixel_limit_are_too_large():
+    with pytest.raises(UploadRejected) as rejected:
+        open_upload(io.BytesIO(encoded('PNG', (100, 100))), max_pixels=100 * 99)
+    assert rejected.value.status == 413
+    assert '100x100' in str(rejected.value)
+
+    assert open_upload(io.BytesIO(encoded('PNG', (100, 100))), max_pixels=100 * 100).size == (100, 100)
+
+
+@pytest.mark.parametrize('fmt', ['JPEG', 'PNG'])
+def test_a_corrupt_header_is_a_bad_request(fmt):
+    data = encoded(fmt)
+    # Keep the magic bytes, mangle the rest of the header
+    corrupt = data[:8] + b'\x00' * 24 if fmt == 'PNG' else data[:3] + b'\x00' * 24
+
+    with pytest.raises(UploadRejected) as rejected:
+        open_upload(io.BytesIO(corrupt))
+    assert rejected.value.status == 400
+
+
+def test_a_decompression_bomb_refused_by_pil_is_too_large(monkeypatch):
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000)
+
+    with pytest.raises(UploadRejected) as rejected:
+        open_upload(io.BytesIO(encoded('PNG', (100, 100))), max_pixels=1000)
+    assert rejected.value.status == 413
@@ -0,0 +1,147 @@
+"""WriteBehindQueue: batching, retries and giving up."""
+import threading
+
+import pytest
+
+from write_behind import WriteBehindQueue
+
+
+class FlakyWriter:
+    """Fails the first `failures` calls, then stores what it is given"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = []
+        self.written = []
+
+    def __call__(self, batch):
+        self.calls.append(list(batch))
+        if len(self.calls) <= self.failures:
+            raise ConnectionError('database unreachable')
+        self.written.extend(batch)
+
+
+def make_queue(write_fn, **kwargs):
+    options = dict(name='test', max_batch_size=10, flush_interval_ms=10, max_retries=2,
+                   retry_backoff_s=0.001, max_backoff_s=0.002)
+    options.update(kwargs)
+    return WriteBehindQueue(write_fn, **options)
+
+
+@pytest.fixture
+def queues():
+    made = []
+    yield lambda write_fn, **kwargs: made.append(make_queue(write_fn, **kwargs)) or made[-1]
+    for queue in made:
+        queue.close()
+
+
+def test_records_are_written_in_batches(queues):
+    writer = FlakyWriter()
+    queue = queues(writer, max_batch_size=4, flush_interval_ms=200)
+
+    assert queue.put_many(range(10)) == 10
+    assert queue.flush(timeout=5)
+
+    assert writer.written == list(range(10))
+    assert all(len(batch) <= 4 for batch in writer.calls)
+    stats = queue.stats()
+    assert (stats['written'], stats['failed'], stats['retries'], stats['queue_depth']) == (10, 0, 0, 0)
+
+
+def test_a_failed_batch_is_retried_with_the_same_records(queues):
+    writer = FlakyWriter(failures=2)
+    queue = queues(writer, max_retries=2)
+
+    queue.put_many(['a', 'b', 'c'])
+    assert queue.flush(timeout=5)
+
+    assert writer.calls == [['a', 'b', 'c']] * 3
+    assert writer.written == ['a', 'b', 'c']
+    stats = queue.stats()
+    assert (stats['written'], stats['failed'], stats['retries']) == (3, 0, 2)
+
+
+def test_a_batch_is_given_up_after_max_retries(queues):
+    writer = FlakyWriter(failures=100)
+    queue = queues(writer, max_retries=2)
+
+    queue.put_many(['a', 'b'])
+    assert queue.flush(timeout=5)
+
+    assert len(writer.calls) == 3
+    stats = queue.stats()
+    assert (stats['written'], stats['failed'], stats['retries'], stats['queue_depth']) == (0, 2, 2, 0)
+
+    # The worker carries on with later batches
+    writer.failures = 0
+    queue.put('c')
+    assert queue.flush(timeout=5)
+    assert writer.written == ['c']
+
+
+def test_errors_are_never_treated_as_success(queues):
+    class DuplicateKeyError(Exception):
+        details = {'writeErrors': [{'code': 11000}]}
+
+    calls = []
+
+    def write(batch):
+        calls.append(batch)
+        raise DuplicateKeyError()
+
+    queue = queues(write, max_retries=1)
+    queue.put('a')
+    assert queue.flush(timeout=5)
+    assert len(calls) == 2
+    assert queue.stats()['failed'] == 1
+
+
+def test_records_over_the_buffer_limit_are_dropped(queues):
+    release = threading.Event()
+    queue = queues(lambda batch: release.wait(5), max_queue_size=3, max_batch_size=1)
+
+    accepted = queue.put_many(range(5))
+    release.set()
+    assert queue.flush(timeout=5)
+
+    assert accepted == 3
+    assert queue.stats()['dropped'] == 2
+
+
+def test_close_writes_what_is_buffered():
+    writer = FlakyWriter()
+    queue = make_queue(writer, flush_interval_ms=10000)
+    queue.put_many(range(3))
+    queue.close()
+
+    assert writer.written == [0, 1, 2]
+    assert not queue.put('late')
+
+
+def test_batches_given_up_on_are_passed_to_on_failure(queues):
+    failed = []
+    writer = FlakyWriter(failures=100)
+    queue = queues(writer, max_retries=1, on_failure=lambda records, error: failed.append((records, error)))
+
+    queue.put_many(['a', 'b'])
+    assert queue.flush(timeout=5)
+
+    assert [records for records, _ in failed] == [['a', 'b']]
+    assert isinstance(failed[0][1], ConnectionError)
+
+
+def test_a_raising_failure_handler_does_not_stop_the_worker(queues):
+    writer = FlakyWriter(failures=2)
+
+    def on_failure(records, error):
+        raise RuntimeError('handler bug')
+
+    queue = queues(writer, max_retries=1, on_failure=on_failure)
+    queue.put('a')
+    assert queue.flush(timeout=5)
+    queue.put('b')
+    assert queue.flush(timeout=5)
+
+    assert writer.written == ['b']
+    assert queue.stats()['failed'] == 1
@@ -0,0 +1,73 @@
+"""
+Early validation of image uploads.
+
+Everything here works on the upload stream as Werkzeug hands it over and
+runs before any pixel data is decoded: the format is sniffed from the first
+bytes, and the dimensions from the image header are checked against a
+decompression-bomb limit. Oversized request bodies never get this far - they
+are refused by Flask's MAX_CONTENT_LENGTH while the body is being read.
+"""
+import os
+
+from PIL import Image
+
+# Largest accepted request body and decoded image size
+MAX_UPLOAD_BYTES = int(float(os.environ.get('MAX_UPLOAD_MB', 20)) * 1024 * 1024)
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 50_000_000))
+
+# Make PIL itself refuse anything past the limit as a second line of defence
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Leading bytes of the formats the model accepts
+MAGIC_NUMBERS = [
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+]
+_SNIFF_LENGTH = max(len(magic) for magic, _ in MAGIC_NUMBERS)
+
+
+class UploadRejected(Exception):
+    """An upload that must be refused before decoding; carries the HTTP status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def sniff_format(stream):
+    """Return 'JPEG' or 'PNG' from the first bytes of a seekable stream, else None"""
+    position = stream.tell()
+    head = stream.read(_SNIFF_LENGTH)
+    stream.seek(position)
+    for magic, image_format in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return image_format
+    return None
+
+
+def open_upload(stream, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Validate an upload stream and open it lazily with PIL
+
+    Only the header is parsed; pixels are decoded later, straight from the
+    stream. Raises UploadRejected for unsupported formats (415), corrupt
+    headers (400) and images whose header dimensions exceed max_pixels (413).
+    """
+    image_format = sniff_format(stream)
+    if image_format is None:
+        raise UploadRejected('Unsupported file format, only JPEG and PNG images are accepted', 415)
+
+    try:
+        img = Image.open(stream, formats=[image_format])
+    except Image.DecompressionBombError:
+        raise UploadRejected(f'Image is too large, the limit is {max_pixels} pixels', 413)
+    except Exception as e:
+        raise UploadRejected(f'Invalid {image_format} image: {e}', 400)
+
+    width, height = img.size
+    if width * height > max_pixels:
+        img.close()
+        raise UploadRejected(
+            f'Image is too large ({width}x{height}), the limit is {max_pixels} pixels', 413
+        )
+    return img
@@ -0,0 +1,216 @@
+"""
+Write-behind buffer for prediction history.
+
+Request threads hand records to a WriteBehindQueue and return straight away.
+A single worker thread collects them and writes them with one bulk insert
+when max_batch_size records are waiting or flush_interval_ms after the first
+one arrived, whichever comes first. Failed writes are retried with
+exponential backoff; records that cannot be buffered or written are counted
+and dropped instead of slowing the API down.
+"""
+import logging
+import queue
+import threading
+import time
+import weakref
+
+from metrics import REGISTRY, Counter, Gauge, observe_stage
+
+logger = logging.getLogger(__name__)
+
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+def _queue_metrics(name, registry):
+    """
+    Metrics shared by every queue with this name, registered once per registry
+
+    Returns (queues, records_total, retries_total); the depth gauge sums the
+    pending records of the live queues in the weak set.
+    """
+    with _metrics_lock:
+        metrics = _metrics.get((registry, name))
+        if metrics is None:
+            queues = weakref.WeakSet()
+            Gauge(
+                f'abdos_{name}_write_queue_depth', f'{name} records waiting to be written', registry=registry
+            ).set_function(lambda: sum(q._pending for q in list(queues)))
+            records_total = Counter(
+                f'abdos_{name}_write_records_total',
+                f'{name} records by outcome: written, dropped (queue full) or failed (retries exhausted)',
+                ['result'],
+                registry=registry
+            )
+            retries_total = Counter(
+                f'abdos_{name}_write_retries_total', f'Retried {name} bulk writes', registry=registry
+            )
+            metrics = _metrics[(registry, name)] = (queues, records_total, retries_total)
+        return metrics
+
+class WriteBehindQueue:
+    """
+    Buffer records in memory and write them in bulk from a background thread
+
+    A failed batch is retried by calling write_fn again with the same list,
+    so write_fn has to cope with records an earlier attempt already wrote
+    (Storage.insert_predictions skips duplicate ids, for example).
+
+    Args:
+    - write_fn: callable taking a list of records, e.g. Storage.insert_predictions
+    - on_failure: optional callable(records, error) run for every batch given
+      up on after max_retries, e.g. to release resources the records hold
+    - name: label for logs and metrics
+    - max_batch_size: records per bulk write
+    - flush_interval_ms: longest a record waits for others before it is written
+    - max_queue_size: records buffered before new ones are dropped
+    - max_retries: retries per batch before it is dropped
+    - retry_backoff_s: first retry delay, doubled per attempt up to max_backoff_s
+    - registry: metrics registry; queues sharing a name share their metrics
+    """
+
+    def __init__(self, write_fn, name='history', max_batch_size=100, flush_interval_ms=500,
+                 max_queue_size=10000, max_retries=5, retry_backoff_s=0.5, max_backoff_s=30.0,
+                 on_failure=None, registry=REGISTRY):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        self.write_fn = write_fn
+        self.on_failure = on_failure
+        self.name = name
+        self.max_batch_size = int(max_batch_size)
+        self.flush_interval = max(float(flush_interval_ms), 0.0) / 1000.0
+        self.max_queue_size = int(max_queue_size)
+        self.max_retries = int(max_retries)
+        self.retry_backoff = float(retry_backoff_s)
+        self.max_backoff = float(max_backoff_s)
+
+        self._queue = queue.Queue()
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._closed = False
+        self._counts = {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'retries': 0, 'batches': 0}
+
+        queues, self._records_total, self._retries_total = _queue_metrics(name, registry)
+        queues.add(self)
+
+        self._worker = threading.Thread(target=self._run, name=f'{name}-write-behind', daemon=True)
+        self._worker.start()
+
+    # ------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------
+
+    def put(self, record):
+        """Buffer one record; returns False if it was dropped because the buffer is full"""
+        return self.put_many([record]) == 1
+
+    def put_many(self, records):
+        """Buffer several records; returns how many were accepted"""
+        records = list(records)
+        with self._idle:
+            if self._closed:
+                accepted = 0
+            else:
+                accepted = max(0, min(len(records), self.max_queue_size - self._pending))
+            self._pending += accepted
+            self._counts['queued'] += accepted
+            self._counts['dropped'] += len(records) - accepted
+
+        for record in records[:accepted]:
+            self._queue.put(record)
+        if accepted < len(records):
+            self._records_total.labels(result='dropped').inc(len(records) - accepted)
+            logger.warning(f"{self.name} write buffer full, dropped {len(records) - accepted} records")
+        return accepted
+
+    def flush(self, timeout=None):
+        """Wait until everything buffered so far has been written or given up on"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    def close(self, timeout=10.0):
+        """Stop accepting records, write what is buffered and stop the worker"""
+        with self._idle:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._worker.join(timeout=timeout)
+        if self._worker.is_alive():
+            logger.warning(f"{self.name} write buffer not drained on shutdown ({self._pending} records left)")
+
+    def stats(self):
+        with self._idle:
+            counts = dict(self._counts)
+            depth = self._pending
+        return dict(
+            counts,
+            queue_depth=depth,
+            max_queue_size=self.max_queue_size,
+            max_batch_size=self.max_batch_size,
+            flush_interval_ms=self.flush_interval * 1000.0,
+        )
+
+    # ------------------------------------------------------------
+    # Worker
+    # ------------------------------------------------------------
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                record = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if record is None:
+                return batch, True
+            batch.append(record)
+        return batch, False
+
+    def _write(self, batch):
+        """None once the batch is written, or the last error if it was given up on"""
+        delay = self.retry_backoff
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                self.write_fn(batch)
+                observe_stage('db_write', time.perf_counter() - started)
+                return None
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Giving up on {len(batch)} {self.name} records after {attempt + 1} attempts: {str(e)}")
+                    return e
+                logger.warning(f"{self.name} bulk write failed ({str(e)}), retrying in {delay:.1f}s")
+                with self._idle:
+                    self._counts['retries'] += 1
+                self._retries_total.inc()
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def _run(self):
+        while True:
+            batch, stop = self._collect()
+            if batch:
+                error = self._write(batch)
+                if error is not None and self.on_failure is not None:
+                    try:
+                        self.on_failure(batch, error)
+                    except Exception as e:
+                        logger.error(f"{self.name} failure handler raised: {str(e)}")
+                result = 'written' if error is None else 'failed'
+                self._records_total.labels(result=result).inc(len(batch))
+                with self._idle:
+                    self._counts[result] += len(batch)
+                    self._counts['batches'] += 1
+                    self._pending -= len(batch)
+                    self._idle.notify_all()
+            if stop:
+                break
@@ -0,0 +1,50 @@
+"""
+Move prediction history embedded in users.predictions into bucket documents.
+
+Runs online: users are migrated batch by batch while model_api.py keeps
+serving, history reads merge any not-yet-migrated array with the buckets,
+and an interrupted run can simply be started again.
+
+Usage:
+    python migrate_history.py --dry-run
+    python migrate_history.py --batch-size 100 --pause-ms 200
+"""
+import argparse
+import logging
+import os
+import sys
+
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+from history_buckets import BUCKET_SIZE, migrate_embedded_history  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uri', default=os.environ.get('MONGO_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--db', default=os.environ.get('MONGO_DB', 'abdos_db'))
+    parser.add_argument('--batch-size', type=int, default=100, help='users per batch')
+    parser.add_argument('--pause-ms', type=float, default=0, help='pause between batches to limit load')
+    parser.add_argument('--bucket-size', type=int, default=BUCKET_SIZE, help='predictions per bucket')
+    parser.add_argument('--limit', type=int, default=None, help='stop after this many users')
+    parser.add_argument('--dry-run', action='store_true', help='only count what would be moved')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    db = MongoClient(args.uri)[args.db]
+    users, predictions = migrate_embedded_history(
+        db.users, db.prediction_buckets,
+        batch_size=args.batch_size,
+        pause_s=args.pause_ms / 1000.0,
+        bucket_size=args.bucket_size,
+        limit=args.limit,
+        dry_run=args.dry_run
+    )
+    verb = 'Would move' if args.dry_run else 'Moved'
+    print(f"{verb} {predictions} predictions of {users} users into prediction_buckets")
+
+
+if __name__ == '__main__':
+    main()
@@ -10,21 +10,35 @@
 
 # Import necessary libraries
 from flask import Flask, request, jsonify
-from tensorflow.keras.models import load_model
 import numpy as np
-from PIL import Image
 from flask_cors import CORS
 import os
 import logging
 import time
-from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
+import atexit
+from flask_jwt_extended import (JWTManager, jwt_required, create_access_token, get_jwt_identity,
+                                verify_jwt_in_request)
 from bson.objectid import ObjectId
-from datetime import datetime
-from pymongo import MongoClient
+from datetime import datetime, timezone
 import sys
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from waitress import serve
 
+# Serving helpers (inference engines etc.) are shared with the backend server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+from inference import load_engine, start_warm_up
+from model_registry import ModelRegistry, keras_loader
+from prediction_cache import PredictionCache, digest_stream, register_cache_metrics
+from preprocessing import preprocess_image
+from preprocess_pool import PreprocessBusy, PreprocessPool
+from uploads import MAX_UPLOAD_BYTES, UploadRejected, open_upload
+from metrics import instrument_app, stage
+from identity_cache import IdentityCache, register_identity_cache_metrics
+from storage import storage_from_env
+from passwords import HasherBusy, PasswordHasher
+from write_behind import WriteBehindQueue
+from reports import InvalidReportRequest, generate_disease_report, generate_disease_reports, report_response
+
 # Set up logging to track server activity and debug issues
 logging.basicConfig(
     level=logging.INFO,
@@ -32,54 +46,225 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Connect to MongoDB database for storing user data and prediction history
+# Storage for user data and prediction history: MongoDB with a configured
+# connection pool, or STORAGE_BACKEND=memory to run without a database
+# (MONGO_URI, MONGO_MAX_POOL_SIZE, timeouts and write concern: backend/storage.py)
 try:
-    client = MongoClient('mongodb://localhost:27017/')
-    db = client['abdos_db']
-    mongo = db
-    logger.info("Successfully connected to MongoDB")
+    storage = storage_from_env()
+    logger.info(f"Storage backend: {storage.name}")
 except Exception as e:
-    logger.error(f"Failed to connect to MongoDB: {str(e)}")
+    logger.error(f"Failed to set up storage: {str(e)}")
     raise
 
+# Prediction history lives in fixed-size bucket documents per user, not in
+# the user document (see backend/history_buckets.py and migrate_history.py)
+try:
+    storage.ensure_indexes()
+except Exception as e:
+    logger.error(f"Could not create prediction history indexes: {str(e)}")
+
+# Predictions of signed-in callers are appended to their history buckets
+# behind the response: a background thread writes every HISTORY_BATCH_SIZE
+# predictions or HISTORY_FLUSH_MS, retrying failed writes with backoff
+def write_history(records):
+    # A retried batch is the same list of records, so users whose predictions
+    # an earlier attempt already appended are skipped rather than pushed twice
+    by_user = {}
+    for record in records:
+        if not record.get('appended'):
+            by_user.setdefault(record['user_id'], []).append(record)
+    for user_id, user_records in by_user.items():
+        storage.append_history(user_id, [record['prediction'] for record in user_records])
+        for record in user_records:
+            record['appended'] = True
+
+history_writer = WriteBehindQueue(
+    write_history,
+    name='history',
+    max_batch_size=int(os.environ.get('HISTORY_BATCH_SIZE', 100)),
+    flush_interval_ms=float(os.environ.get('HISTORY_FLUSH_MS', 500)),
+    max_queue_size=int(os.environ.get('HISTORY_QUEUE_SIZE', 10000)),
+    max_retries=int(os.environ.get('HISTORY_MAX_RETRIES', 5)),
+    retry_backoff_s=float(os.environ.get('HISTORY_RETRY_BACKOFF_S', 0.5))
+)
+atexit.register(history_writer.close)
+
+# Password hashing on a small dedicated pool so logins cannot starve
+# predictions; PASSWORD_HASH_METHOD sets the method and cost (default:
+# werkzeug's own), and stored hashes made with the same method at a lower
+# cost are upgraded on the next successful login
+password_hasher = PasswordHasher(
+    method=os.environ.get('PASSWORD_HASH_METHOD') or None,
+    max_workers=int(os.environ.get('AUTH_HASH_WORKERS', 2)),
+    max_pending=int(os.environ.get('AUTH_HASH_QUEUE_SIZE', 64)),
+    timeout=float(os.environ.get('AUTH_HASH_TIMEOUT_S', 10))
+)
+atexit.register(password_hasher.close)
+
+# Largest history page returned by /api/history
+HISTORY_MAX_LIMIT = 1000
+
+def load_profile(user_id):
+    """User document as returned by /api/auth/profile (no password or history)"""
+    user = storage.find_user(_id=ObjectId(user_id))
+    if user:
+        user['_id'] = str(user['_id'])
+    return user
+
+# JWT identity (user id) -> profile, so authenticated routes skip the user
+# lookup; entries expire after IDENTITY_CACHE_TTL_S (IDENTITY_CACHE_SIZE=0 disables)
+identity_cache = IdentityCache(
+    load_profile,
+    max_entries=int(os.environ.get('IDENTITY_CACHE_SIZE', 4096)),
+    ttl_seconds=float(os.environ.get('IDENTITY_CACHE_TTL_S', 60))
+)
+register_identity_cache_metrics(identity_cache)
+
 # ============================================================
 # Model Loading
 # ============================================================
-# Only load the user's downloaded model
+# Versions of the model declared in backend/models/model_config.config are
+# loaded from <base_path>/<version>/saved_model (MODEL_VERSION pins one, else
+# the newest is served and new versions are hot-swapped in). Without the
+# config, or with MODEL_BACKEND=tflite, the user's downloaded model is used.
 MODEL_PATH = r"C:\Users\User\Downloads\skin_cancer_model.h5"
-model = None
-try:
-    logger.info(f"Loading model from: {MODEL_PATH}")
-    model = load_model(MODEL_PATH, compile=False)
-    logger.info("Model loaded successfully!")
-except Exception as e:
-    logger.error(f"Error loading model: {str(e)}")
-    model = None
+MODEL_CONFIG_PATH = os.environ.get(
+    'MODEL_CONFIG_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'models', 'model_config.config')
+)
+registry = None
+if os.environ.get('MODEL_BACKEND', 'keras').lower() == 'keras' and os.path.exists(MODEL_CONFIG_PATH):
+    try:
+        registry = ModelRegistry.from_config(
+            MODEL_CONFIG_PATH, os.environ.get('MODEL_NAME') or None,
+            loader=keras_loader(compile=False),
+            pinned_version=os.environ.get('MODEL_VERSION') or None,
+            poll_interval_s=float(os.environ.get('MODEL_POLL_INTERVAL_S', 30))
+        )
+        registry.load_initial()
+    except Exception as e:
+        logger.error(f"Error loading a versioned model from {MODEL_CONFIG_PATH}: {str(e)}")
+        registry = None
+
+if registry is None:
+    try:
+        logger.info(f"Loading model from: {MODEL_PATH}")
+        registry = ModelRegistry.single(load_engine(MODEL_PATH, compile=False))
+    except Exception as e:
+        logger.error(f"Error loading model: {str(e)}")
+
+if registry is not None:
+    logger.info(f"Model loaded successfully! ({registry.current.name} backend: {registry.current.source}, "
+                f"version {registry.current.version})")
+    # Trace the serving function and run warm-up passes in the background;
+    # /health reports ready once this has finished
+    start_warm_up(registry.current)
+    registry.start_polling()
+
+# Cache of model outputs keyed by image content + model version
+# (PREDICTION_CACHE_SIZE=0 disables, PREDICTION_CACHE_DIR shares hits across workers)
+prediction_cache = PredictionCache(
+    max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', 1024)),
+    ttl_seconds=float(os.environ.get('PREDICTION_CACHE_TTL_S', 3600)),
+    disk_dir=os.environ.get('PREDICTION_CACHE_DIR') or None,
+    model_version=registry.current.version if registry is not None else None,
+    disk_max_entries=int(os.environ.get('PREDICTION_CACHE_DISK_MAX_ENTRIES', 100000)),
+    sweep_interval_s=float(os.environ.get('PREDICTION_CACHE_SWEEP_S', 300))
+)
+
+# Outputs of a replaced model version must not be served again
+if registry is not None:
+    registry.add_listener(lambda engine: prediction_cache.set_model_version(engine.version))
+
+# Optional process pool for decode/resize/normalize so image work does not
+# hold the GIL in waitress request threads (PREPROCESS_PROCESSES=0 disables)
+PREPROCESS_PROCESSES = int(os.environ.get('PREPROCESS_PROCESSES', 0))
+# Longest a request waits for a free pool slot and its worker together
+PREPROCESS_TIMEOUT_S = float(os.environ.get('PREPROCESS_TIMEOUT_S', 30))
+preprocess_pool = None
+if PREPROCESS_PROCESSES > 0:
+    preprocess_pool = PreprocessPool(PREPROCESS_PROCESSES, normalization='unit', resample='lanczos')
+    logger.info(f"Preprocessing in {PREPROCESS_PROCESSES} worker processes")
 
 # ============================================================
 # API Endpoints
 # ============================================================
 
+# Prometheus text metrics at /metrics (per-stage histograms, request counts
+# by status, in-flight gauges); METRICS_ENABLED=0 makes the timers no-ops
+instrument_app(app)
+register_cache_metrics(prediction_cache)
+
+# Request bodies over MAX_UPLOAD_MB are refused while they are being read
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+@app.errorhandler(413)
+def request_too_large(e):
+    """Return upload size errors as JSON like the other endpoints"""
+    return jsonify({
+        'error': 'Upload too large',
+        'details': f'The limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB'
+    }), 413
+
 @app.route('/', methods=['GET'])
 def index():
     """Serve the API documentation page"""
-    return render_template('index.html', model_loaded=model is not None)
+    return render_template('index.html', model_loaded=registry is not None)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Check if the API and model are working properly"""
+    model = registry.current if registry is not None else None
     status = {
         'status': 'healthy',
-        'model_loaded': model is not None
+        'model_loaded': model is not None,
+        'model_backend': model.name if model is not None else None,
+        'model_version': model.version if model is not None else None
     }
+    if model is not None:
+        # Not ready until the serving function is traced and warmed up
+        if not model.ready:
+            status['status'] = 'warming_up'
+            return jsonify(status), 503
+        status['status'] = 'ready'
+        status['warmup'] = model.warmup_stats
     return jsonify(status)
 
+@app.route('/models/stats', methods=['GET'])
+def model_stats():
+    """Served and available model versions, and versions still draining"""
+    if registry is None:
+        return jsonify({'error': 'Model not loaded'}), 503
+    return jsonify(registry.stats())
+
+@app.route('/identity-cache/stats', methods=['GET'])
+def identity_cache_stats():
+    """Hit/miss counts and size of the identity cache"""
+    return jsonify(identity_cache.stats())
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counts and size of the prediction cache"""
+    return jsonify(prediction_cache.stats())
+
+def history_user():
+    """ObjectId of the signed-in user sending this request, or None"""
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+        if identity and identity_cache.get(identity):
+            return ObjectId(identity)
+    except Exception as e:
+        logger.warning(f"Prediction not saved to history: {str(e)}")
+    return None
+
 @app.route('/predict', methods=['POST'])
 def predict():
     """
     Process an uploaded skin lesion image and return predictions
     
-    Expects a multipart/form-data request with an 'image' file
+    Expects a multipart/form-data request with an 'image' file; with a valid
+    JWT in the Authorization header the prediction is saved to the user's history
     Returns prediction results including:
     - predicted_class: The numeric class ID (0-6)
     - confidence: Confidence score (0-1)
@@ -89,7 +274,7 @@ def predict():
     logger.info("--- PREDICT ENDPOINT ENTERED (Expecting Multipart) ---")
     sys.stdout.flush()
 
-    if model is None:
+    if registry is None:
         logger.error("Prediction attempted but model is not loaded")
         sys.stdout.flush()
         return jsonify({
@@ -97,73 +282,117 @@ def predict():
             'details': 'The model failed to load or the model file was not found'
         }), 503
 
-    if 'image' not in request.files:
+    # Accessing request.files parses the multipart body
+    with stage('parse'):
+        files = request.files
+
+    if 'image' not in files:
         logger.error("No 'image' key found in request.files")
         sys.stdout.flush()
         return jsonify({'error': "No 'image' key found in request.files"}), 400
         
     try:
-        file = request.files['image']
+        file = files['image']
         logger.info(f"Processing image: {file.filename}, Content type: {file.content_type}, Size: {file.content_length} bytes")
         sys.stdout.flush()
 
-        if not file.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            logger.error(f"Unsupported file format: {file.filename}")
+        # Check the magic bytes and the header dimensions straight from the
+        # upload stream; nothing is decoded until these checks pass
+        try:
+            with stage('validate'):
+                img = open_upload(file.stream)
+        except UploadRejected as rejected:
+            logger.error(f"Upload rejected: {file.filename}: {str(rejected)}")
             sys.stdout.flush()
             return jsonify({
-                'error': 'Unsupported file format',
-                'details': 'Only JPG, JPEG, and PNG images are supported'
-            }), 400
+                'error': 'Unsupported file format' if rejected.status == 415 else 'Invalid image',
+                'details': str(rejected)
+            }), rejected.status
 
-        try:
-            img = Image.open(file.stream)
-            logger.info(f"Image opened successfully from stream. Size: {img.size}, Mode: {img.mode}")
+        # Re-uploads of the same image are answered from the cache
+        with stage('hash'):
+            digest = digest_stream(file.stream)
+        cached = prediction_cache.get(digest)
+        if cached is not None:
+            predictions = np.asarray([cached], dtype=np.float32)
+            prediction_time = 0.0
+            logger.info(f"Prediction cache hit for {file.filename}")
             sys.stdout.flush()
-
-            if img.mode != 'RGB':
-                logger.info(f"Converting image from {img.mode} to RGB")
+        else:
+            try:
+                logger.info(f"Image opened successfully from stream. Size: {img.size}, Mode: {img.mode}")
                 sys.stdout.flush()
-                img = img.convert('RGB')
 
-            img = img.resize((224, 224), Image.LANCZOS)
-            logger.info(f"Image resized to: {img.size}")
-            sys.stdout.flush()
-
-            img_array = np.array(img, dtype=np.float32) / 255.0
-            logger.info(f"Image converted to array. Shape: {img_array.shape}, Range: [{img_array.min()}, {img_array.max()}]")
-            sys.stdout.flush()
+                if preprocess_pool is not None:
+                    # Decode in a worker process; the array comes back via shared memory
+                    file.stream.seek(0)
+                    with stage('preprocess_pool'):
+                        img_array = preprocess_pool.preprocess(file.stream.read(), timeout=PREPROCESS_TIMEOUT_S)
+                    logger.info("Image preprocessed in worker process")
+                    sys.stdout.flush()
+                else:
+                    # JPEGs are decoded at the nearest DCT scale >= 224 before the
+                    # final LANCZOS resize, then scaled to [0, 1] straight into float32
+                    img_array = preprocess_image(img, normalization='unit', resample='lanczos')
+                logger.info(f"Image converted to array. Shape: {img_array.shape}, Range: [{img_array.min()}, {img_array.max()}]")
+                sys.stdout.flush()
 
-            img_array = np.expand_dims(img_array, axis=0)
-            logger.info(f"Final array shape: {img_array.shape}")
-            sys.stdout.flush()
+                img_array = np.expand_dims(img_array, axis=0)
+                logger.info(f"Final array shape: {img_array.shape}")
+                sys.stdout.flush()
 
-        except Exception as img_error:
-            logger.error(f"Error preprocessing image from stream: {str(img_error)}")
-            sys.stdout.flush()
-            return jsonify({'error': 'Image preprocessing failed', 'details': str(img_error)}), 400
+            except (PreprocessBusy, FutureTimeoutError):
+                logger.warning(f"Preprocessing pool busy, rejected {file.filename}")
+                sys.stdout.flush()
+                return jsonify({'error': 'Server busy, try again shortly'}), 503
+            except Exception as img_error:
+                logger.error(f"Error preprocessing image from stream: {str(img_error)}")
+                sys.stdout.flush()
+                return jsonify({'error': 'Image preprocessing failed', 'details': str(img_error)}), 400
         
-        try:
-            start_time = time.time()
-            predictions = model.predict(img_array)
-            prediction_time = time.time() - start_time
-            logger.info(f"Prediction completed in {prediction_time:.2f} seconds")
-            sys.stdout.flush()
-        except Exception as pred_error:
-            logger.error(f"Error during model prediction: {str(pred_error)}")
-            sys.stdout.flush()
-            return jsonify({'error': 'Model prediction failed', 'details': str(pred_error)}), 500
+            try:
+                # The lease keeps this request on its model version if a new
+                # one is swapped in meanwhile
+                with registry.lease() as model:
+                    version = model.version
+                    start_time = time.time()
+                    with stage('inference'):
+                        predictions = model.predict(img_array)
+                prediction_time = time.time() - start_time
+                prediction_cache.put(digest, predictions[0], version=version)
+                logger.info(f"Prediction completed in {prediction_time:.2f} seconds")
+                sys.stdout.flush()
+            except Exception as pred_error:
+                logger.error(f"Error during model prediction: {str(pred_error)}")
+                sys.stdout.flush()
+                return jsonify({'error': 'Model prediction failed', 'details': str(pred_error)}), 500
         
         predicted_class = np.argmax(predictions)
         confidence = float(np.max(predictions))
         logger.info(f"Predicted class: {predicted_class} ({CLASS_LABELS.get(predicted_class, 'Unknown')}) with confidence: {confidence:.4f}")
         sys.stdout.flush()
         
-        return jsonify({
-            'predicted_class': int(predicted_class),
-            'confidence': confidence,
-            'class_name': CLASS_LABELS.get(int(predicted_class), 'Unknown'),
-            'prediction_time': prediction_time
-        })
+        # Signed-in callers (optional Authorization header) get the prediction
+        # added to their history; saving never fails the prediction itself
+        user_id = history_user()
+        if user_id is not None:
+            prediction = {
+                'timestamp': datetime.now(timezone.utc),
+                'predicted_class': int(predicted_class),
+                'class_name': CLASS_LABELS.get(int(predicted_class), 'Unknown'),
+                'confidence': confidence,
+                'image_name': file.filename
+            }
+            if not history_writer.put({'user_id': user_id, 'prediction': prediction}):
+                logger.warning(f"History buffer full, prediction for {user_id} not saved")
+        
+        with stage('serialize'):
+            return jsonify({
+                'predicted_class': int(predicted_class),
+                'confidence': confidence,
+                'class_name': CLASS_LABELS.get(int(predicted_class), 'Unknown'),
+                'prediction_time': prediction_time
+            })
     except Exception as e:
         import traceback
         logger.error(f"Error during prediction: {str(e)}")
@@ -200,33 +429,34 @@ def register():
             return jsonify({'error': 'Missing required fields'}), 400
         
         # Check if username already exists
-        if mongo.users.find_one({'username': data['username']}):
+        if storage.user_exists(username=data['username']):
             return jsonify({'error': 'Username already exists'}), 400
         
         # Check if email already exists
-        if mongo.users.find_one({'email': data['email']}):
+        if storage.user_exists(email=data['email']):
             return jsonify({'error': 'Email already exists'}), 400
         
         # Create new user document
         user = {
             'username': data['username'],
             'email': data['email'],
-            'password': generate_password_hash(data['password']),  # Hash the password
-            'created_at': datetime.utcnow(),
-            'predictions': []  # List to store prediction history
+            'password': password_hasher.hash(data['password']),  # Hash the password
+            'created_at': datetime.utcnow()
         }
         
         # Insert the new user into the database
-        result = mongo.users.insert_one(user)
+        user_id = storage.insert_user(user)
         
         # Generate access token
-        access_token = create_access_token(identity=str(result.inserted_id))
+        access_token = create_access_token(identity=str(user_id))
         
         return jsonify({
             'message': 'User registered successfully',
             'access_token': access_token
         }), 201
         
+    except (HasherBusy, FutureTimeoutError):
+        return jsonify({'error': 'Too many authentication requests, try again shortly'}), 503
     except Exception as e:
         logger.error(f"Registration error: {str(e)}")
         return jsonify({'error': 'Registration failed', 'details': str(e)}), 500
@@ -252,14 +482,20 @@ def login():
             return jsonify({'error': 'Missing username or password'}), 400
         
         # Find the user in the database
-        user = mongo.users.find_one({'username': data['username']})
+        user = storage.find_user(include_password=True, username=data['username'])
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
         # Check if password is correct
-        if not check_password_hash(user['password'], data['password']):
+        if not password_hasher.verify(user['password'], data['password']):
             return jsonify({'error': 'Invalid password'}), 401
         
+        # Upgrade hashes made with an older method or cost, without delaying the response
+        if password_hasher.needs_rehash(user['password']):
+            password_hasher.upgrade(
+                data['password'], lambda new_hash: storage.update_user({'password': new_hash}, _id=user['_id'])
+            )
+        
         # Generate access token
         access_token = create_access_token(identity=str(user['_id']))
         
@@ -268,6 +504,8 @@ def login():
             'access_token': access_token
         }), 200
         
+    except (HasherBusy, FutureTimeoutError):
+        return jsonify({'error': 'Too many authentication requests, try again shortly'}), 503
     except Exception as e:
         logger.error(f"Login error: {str(e)}")
         return jsonify({'error': 'Login failed', 'details': str(e)}), 500
@@ -288,15 +526,11 @@ def profile():
         # Get user ID from JWT token
         current_user_id = get_jwt_identity()
         
-        # Find user in database
-        user = mongo.users.find_one({'_id': ObjectId(current_user_id)})
+        # Find user (without password) through the identity cache
+        user = identity_cache.get(current_user_id)
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        # Remove sensitive information
-        user.pop('password', None)
-        user['_id'] = str(user['_id'])
-        
         return jsonify(user), 200
         
     except Exception as e:
@@ -326,8 +560,11 @@ def get_history(user_id):
     - Valid JWT token in Authorization header
     - user_id: ID of the user whose history to retrieve
     
+    Optional query parameters:
+    - limit: number of most recent predictions to return (default 100)
+    
     Returns:
-    - list of previous predictions
+    - list of previous predictions, newest first, and the total count
     - error message if history cannot be retrieved
     """
     try:
@@ -336,114 +573,45 @@ def get_history(user_id):
         if current_user_id != user_id:
             return jsonify({'error': 'Unauthorized to view this history'}), 403
         
+        try:
+            limit = min(max(int(request.args.get('limit', 100)), 1), HISTORY_MAX_LIMIT)
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        
         # Find user in database
-        user = mongo.users.find_one({'_id': ObjectId(user_id)})
-        if not user:
+        user_object_id = ObjectId(user_id)
+        if not identity_cache.get(user_id):
             return jsonify({'error': 'User not found'}), 404
         
-        # Return prediction history
-        predictions = user.get('predictions', [])
+        # Read only the newest buckets needed for this page
+        predictions = storage.recent_history(user_object_id, limit)
+        total = storage.count_history(user_object_id)
+        
+        # Users not migrated yet still have (older) history in their document
+        legacy = storage.legacy_history(user_object_id)
+        if legacy:
+            predictions = (predictions + legacy[::-1])[:limit]
+            total += len(legacy)
+        
         return jsonify({
             'predictions': predictions,
-            'total_predictions': len(predictions)
+            'total_predictions': total
         }), 200
         
     except Exception as e:
         logger.error(f"History retrieval error: {str(e)}")
         return jsonify({'error': 'Could not retrieve history', 'details': str(e)}), 500
 
-def generate_disease_report(disease, confidence):
-    reports = {
-        'actinic keratoses': {
-            'diagnosis': 'Actinic Keratoses',
-            'description': 'Precancerous skin lesions caused by sun damage detected.',
-            'recommendations': [
-                'Consult with a dermatologist',
-                'Consider cryotherapy or topical treatments',
-                'Regular skin monitoring required',
-                'Sun protection measures essential'
-            ]
-        },
-        'basal cell carcinoma': {
-            'diagnosis': 'Basal Cell Carcinoma',
-            'description': 'Most common type of skin cancer detected.',
-            'recommendations': [
-                'Immediate dermatologist consultation required',
-                'Biopsy confirmation needed',
-                'Surgical removal likely necessary',
-                'Regular follow-up appointments essential'
-            ]
-        },
-        'benign keratosis': {
-            'diagnosis': 'Benign Keratosis',
-            'description': 'Non-cancerous skin growth detected.',
-            'recommendations': [
-                'Regular monitoring recommended',
-                'Consider removal if causing discomfort',
-                'No immediate treatment required',
-                'Maintain regular skin checks'
-            ]
-        },
-        'dermatofibroma': {
-            'diagnosis': 'Dermatofibroma',
-            'description': 'Common benign skin growth detected.',
-            'recommendations': [
-                'No treatment necessary unless symptomatic',
-                'Monitor for any changes',
-                'Consider removal if causing discomfort',
-                'Regular skin checks recommended'
-            ]
-        },
-        'melanoma': {
-            'diagnosis': 'Melanoma',
-            'description': 'Serious type of skin cancer detected.',
-            'recommendations': [
-                'Urgent dermatologist consultation required',
-                'Immediate biopsy confirmation needed',
-                'Surgical intervention likely necessary',
-                'Regular monitoring and follow-up essential'
-            ]
-        },
-        'melanocytic nevi': {
-            'diagnosis': 'Melanocytic Nevi',
-            'description': 'Common mole detected.',
-            'recommendations': [
-                'Regular monitoring recommended',
-                'Consider removal if changing in appearance',
-                'No immediate treatment required',
-                'Maintain regular skin checks'
-            ]
-        },
-        'vascular lesions': {
-            'diagnosis': 'Vascular Lesions',
-            'description': 'Blood vessel-related skin marks detected.',
-            'recommendations': [
-                'Consult with dermatologist',
-                'Consider laser treatment if desired',
-                'Monitor for any changes',
-                'No immediate treatment required'
-            ]
-        }
-    }
-    
-    # Convert disease name to lowercase and remove any extra spaces
-    disease_key = disease.lower().strip()
-    
-    # Get the report for the detected disease, default to normal if not found
-    report = reports.get(disease_key, {
-        'diagnosis': 'Unknown Condition',
-        'description': 'The detected condition requires further evaluation.',
-        'recommendations': [
-            'Consult with a dermatologist',
-            'Further diagnostic tests may be needed',
-            'Regular monitoring recommended'
-        ]
-    })
-    
-    # Add confidence score to the report
-    report['confidence'] = f"{confidence:.2%}"
-    
-    return report
+# ============================================================
+# Disease Reports
+# ============================================================
+# The read-only report catalog and its rendering live in backend/reports.py
+
+# Reports are deterministic for their input, so clients may keep them for
+# REPORT_MAX_AGE_S and revalidate with If-None-Match afterwards
+REPORT_MAX_AGE_S = int(os.environ.get('REPORT_MAX_AGE_S', 86400))
+# Largest list accepted by /api/generate-reports
+REPORT_BATCH_MAX = int(os.environ.get('REPORT_BATCH_MAX', 100))
 
 @app.route('/api/generate-report', methods=['POST'])
 @jwt_required()  # Add authentication requirement
@@ -457,12 +625,33 @@ def generate_report():
             return jsonify({'error': 'Disease not specified'}), 400
             
         report = generate_disease_report(disease, confidence)
-        return jsonify(report)
+        return report_response(report, REPORT_MAX_AGE_S)
         
     except Exception as e:
         logger.error(f"Report generation error: {str(e)}")
         return jsonify({'error': 'Failed to generate report', 'details': str(e)}), 500
 
+@app.route('/api/generate-reports', methods=['POST'])
+@jwt_required()
+def generate_reports():
+    """
+    Reports for several diagnoses in one call, e.g. every image of a visit
+
+    Expects {"items": [{"disease": ..., "confidence": ...}, ...]} and returns
+    {"reports": [...]} in the same order.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            reports = generate_disease_reports(data.get('items'), REPORT_BATCH_MAX)
+        except InvalidReportRequest as e:
+            return jsonify({'error': str(e)}), 400
+        return report_response({'reports': reports}, REPORT_MAX_AGE_S)
+
+    except Exception as e:
+        logger.error(f"Batch report generation error: {str(e)}")
+        return jsonify({'error': 'Failed to generate reports', 'details': str(e)}), 500
+
 # ============================================================
 # Server Startup
 # ============================================================
@@ -20,12 +20,16 @@ drive.mount('/content/drive', force_remount=True)
 import os
 import time
 import datetime
+import json
+import hashlib
+import zlib
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import gc  # For garbage collection
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow as tf
 from tensorflow.keras.applications import MobileNetV2
 from tensorflow.keras.layers import Dense, Dropout, GlobalAveragePooling2D, Input, BatchNormalization
@@ -71,6 +75,28 @@ METRICS_DIR = os.path.join(MODEL_DIR, "metrics")
 os.makedirs(METRICS_DIR, exist_ok=True)
 PLOTS_DIR = os.path.join(MODEL_DIR, "plots")
 os.makedirs(PLOTS_DIR, exist_ok=True)
+# Dataset manifest and other artifacts reused across runs
+CACHE_DIR = os.path.join(MODEL_DIR, "cache")
+os.makedirs(CACHE_DIR, exist_ok=True)
+MANIFEST_PATH = os.path.join(CACHE_DIR, "manifest.csv")
+# Rescan the image directories instead of reusing the saved manifest; only
+# new or changed files (by size and mtime) are read and hashed again
+REFRESH_MANIFEST = False
+# Train/val/test assignment per lesion, computed once and reused (CELL 6a)
+SPLIT_PATH = os.path.join(CACHE_DIR, "splits.json")
+SPLIT_FRACTIONS = {'train': 0.6, 'val': 0.2, 'test': 0.2}
+# Decoded training images held for shuffling (~150 KB each as uint8)
+SHUFFLE_BUFFER_SIZE = 512
+# Decoded, resized uint8 images in TFRecord shards (CELL 6b). On Drive the
+# cache survives sessions; a directory under /content reads faster.
+USE_IMAGE_CACHE = True
+IMAGE_CACHE_DIR = os.path.join(CACHE_DIR, f"images_{IMG_SIZE[0]}x{IMG_SIZE[1]}")
+IMAGE_CACHE_SHARDS = 16
+# Phase 1 trains the head on pooled backbone features computed once per
+# (image, augmentation seed) and memory-mapped from disk (CELL 10b)
+USE_FEATURE_CACHE = True
+FEATURE_CACHE_DIR = os.path.join(CACHE_DIR, "features")
+FEATURE_CACHE_AUGMENTATIONS = 4
 
 AUTOTUNE = tf.data.AUTOTUNE
 
@@ -140,8 +166,315 @@ if 'metadata_df' in locals():
     # Create metadata dictionary for quick lookup
     metadata_dict = metadata_df.set_index('image_id').to_dict(orient='index')
 
+# CELL 6a: Dataset Manifest
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif'}
+MANIFEST_COLUMNS = ['path', 'image_id', 'lesion_id', 'label', 'size', 'mtime', 'sha256']
+
+def scan_image_dir(root):
+    """Every image file under root as (path, size, mtime), in a single os.scandir walk"""
+    found = []
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                        stat = entry.stat()
+                        found.append((entry.path, stat.st_size, stat.st_mtime))
+        except OSError as e:
+            print(f"Could not scan {current}: {e}")
+    return found
+
+def hash_file(path, chunk_size=1 << 20):
+    """sha256 of a file's contents, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def build_manifest(metadata_df, image_dirs, manifest_path=MANIFEST_PATH, refresh=False, max_workers=8):
+    """
+    Table of every image that has metadata: path, image_id, lesion_id, label (dx), size, mtime, sha256
+
+    Each directory is walked once, all directories in parallel, and files are
+    joined to the metadata through a dict keyed by image_id (one lookup per
+    file instead of a DataFrame filter). The result is saved to manifest_path.
+    A saved manifest is returned as-is without touching the image directories
+    unless refresh=True. A refresh rescans the directories but keeps the
+    content hash of every file whose (path, size, mtime) is unchanged; only
+    new or changed files are read and hashed. The changes against the saved
+    manifest (added, removed, modified files) are reported, so caches keyed
+    on it know what to rebuild.
+    """
+    previous = None
+    if os.path.exists(manifest_path):
+        # round_trip: mtimes must compare equal to the values that were saved
+        previous = pd.read_csv(manifest_path, float_precision='round_trip')
+        if not refresh and 'sha256' in previous.columns:
+            print(f"Using cached manifest with {len(previous)} images: {manifest_path}")
+            return previous
+
+    start = time.time()
+    existing_dirs = [d for d in image_dirs if os.path.exists(d)]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(existing_dirs)))) as executor:
+        scanned = [f for files in executor.map(scan_image_dir, existing_dirs) for f in files]
+    print(f"Found {len(scanned)} image files in {time.time() - start:.1f}s")
+
+    # Hash join on image_id; the first metadata row wins, as before
+    metadata_df = metadata_df.drop_duplicates('image_id')
+    labels = dict(zip(metadata_df['image_id'], metadata_df['dx']))
+    lesions = (dict(zip(metadata_df['image_id'], metadata_df['lesion_id']))
+               if 'lesion_id' in metadata_df.columns else {})
+
+    matched = {}
+    for path, size, mtime in sorted(scanned):
+        image_id = os.path.splitext(os.path.basename(path))[0]
+        if image_id in labels and path not in matched:
+            matched[path] = (image_id, size, mtime)
+
+    # Unchanged files keep the hash of the saved row; labels are joined again
+    # since the metadata may have changed
+    known = {}
+    if previous is not None and 'sha256' in previous.columns:
+        known = {(path, size, mtime): sha for path, size, mtime, sha
+                 in zip(previous['path'], previous['size'], previous['mtime'], previous['sha256'])}
+    hashes = {path: known[(path, size, mtime)] for path, (_, size, mtime) in matched.items()
+              if (path, size, mtime) in known}
+    changed = [path for path in matched if path not in hashes]
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        hashes.update(zip(changed, executor.map(hash_file, changed)))
+    print(f"Hashed {len(changed)} new or changed files in {time.time() - start:.1f}s, "
+          f"reused {len(matched) - len(changed)} hashes")
+
+    # Images without a lesion_id are their own group
+    rows = [(path, image_id, lesions.get(image_id, image_id), labels[image_id], size, mtime, hashes[path])
+            for path, (image_id, size, mtime) in matched.items()]
+    manifest = pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+    print(f"Matched {len(manifest)} images with metadata")
+
+    if previous is not None:
+        before = dict(zip(previous['path'], zip(previous['size'], previous['mtime'])))
+        after = dict(zip(manifest['path'], zip(manifest['size'], manifest['mtime'])))
+        added = len(after.keys() - before.keys())
+        removed = len(before.keys() - after.keys())
+        modified = sum(1 for path in after.keys() & before.keys() if after[path] != before[path])
+        print(f"Manifest changes: {added} added, {removed} removed, {modified} modified")
+
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    manifest.to_csv(manifest_path, index=False)
+    print(f"Manifest saved to: {manifest_path}")
+    return manifest
+
+def split_manifest(manifest, fractions=SPLIT_FRACTIONS, seed=SEED, split_path=SPLIT_PATH):
+    """
+    Add a 'split' column: train/val/test, stratified by label and grouped by lesion_id
+
+    All images of a lesion go to the same split, so no lesion is seen in
+    training and again in evaluation. Lesions of each label are visited in a
+    seeded random order and each goes to the split furthest below its target
+    share of that label. Assignments are saved to split_path and reused:
+    known lesions keep their split, and only lesions new to the manifest are
+    placed (against the counts of the existing ones). A different seed or
+    fractions starts over.
+    """
+    assignments = {}
+    if os.path.exists(split_path):
+        with open(split_path) as f:
+            saved = json.load(f)
+        if saved.get('seed') == seed and saved.get('fractions') == fractions:
+            assignments = saved['lesions']
+
+    # A lesion's label is the most common label among its images
+    lesion_ids = manifest['lesion_id'].astype(str)
+    lesion_images = manifest.groupby(lesion_ids).size()
+    lesion_labels = manifest.groupby(lesion_ids)['label'].agg(lambda labels: labels.mode().iloc[0])
+
+    rng = np.random.default_rng(seed)
+    new_lesions = 0
+    for label in sorted(lesion_labels.unique()):
+        lesions = sorted(lesion_labels.index[lesion_labels == label])
+        total = sum(int(lesion_images[lesion]) for lesion in lesions)
+        counts = dict.fromkeys(fractions, 0)
+        for lesion in lesions:
+            if lesion in assignments:
+                counts[assignments[lesion]] += int(lesion_images[lesion])
+        for lesion in rng.permutation(lesions):
+            if lesion in assignments:
+                continue
+            split = max(fractions, key=lambda name: fractions[name] * total - counts[name])
+            assignments[str(lesion)] = split
+            counts[split] += int(lesion_images[lesion])
+            new_lesions += 1
+
+    with open(split_path + ".tmp", "w") as f:
+        json.dump({'seed': seed, 'fractions': fractions, 'lesions': assignments}, f)
+    os.replace(split_path + ".tmp", split_path)
+    print(f"Split manifest: {new_lesions} new lesions assigned, saved to {split_path}")
+
+    return manifest.assign(split=[assignments[lesion] for lesion in lesion_ids])
+
+# CELL 6b: Preprocessed Image Cache
+def load_and_resize_image(img_path, img_size=IMG_SIZE):
+    """Decode an image file and resize it to img_size (float32, 0-255)"""
+    img = tf.io.read_file(img_path)
+    img = tf.image.decode_jpeg(img, channels=3)
+    return tf.image.resize(img, img_size)
+
+def make_raw_dataset(paths, labels, img_size=IMG_SIZE):
+    """(image, label) pairs decoded from the image files on every pass"""
+    dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+    return dataset.map(lambda path, label: (load_and_resize_image(path, img_size), label),
+                       num_parallel_calls=AUTOTUNE)
+
+def _shard_names(manifest, num_shards):
+    # Stable across runs: an image stays in its shard as others come and go.
+    # A 'split' column, when present, keeps each split in shards of its own.
+    groups = manifest['split'] if 'split' in manifest.columns else ['all'] * len(manifest)
+    return [f"{group}-{zlib.crc32(str(image_id).encode()) % num_shards:03d}"
+            for group, image_id in zip(groups, manifest['image_id'])]
+
+def _shard_fingerprint(rows):
+    # Content hashes, not mtimes: a file touched without changing keeps its shard
+    digest = hashlib.sha1()
+    for path, sha256, label in sorted(zip(rows['path'], rows['sha256'], rows['label_idx'])):
+        digest.update(f"{path}|{sha256}|{label}\n".encode())
+    return digest.hexdigest()
+
+def write_image_shard(shard_path, paths, labels, img_size=IMG_SIZE):
+    """Decode, resize and write images as uint8 tf.train.Examples (image, label, path)"""
+    decoded = make_raw_dataset(paths, labels, img_size).map(
+        lambda image, label: (tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8), label),
+        num_parallel_calls=AUTOTUNE
+    )
+    temporary_path = shard_path + ".tmp"
+    with tf.io.TFRecordWriter(temporary_path) as writer:
+        # map() keeps the input order, so records line up with paths
+        for (image, label), path in zip(decoded, paths):
+            example = tf.train.Example(features=tf.train.Features(feature={
+                'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.numpy().tobytes()])),
+                'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+                'path': tf.train.Feature(bytes_list=tf.train.BytesList(value=[path.encode()])),
+            }))
+            writer.write(example.SerializeToString())
+    os.replace(temporary_path, shard_path)
+
+def build_image_cache(manifest, class_indices, cache_dir=IMAGE_CACHE_DIR, num_shards=IMAGE_CACHE_SHARDS,
+                      img_size=IMG_SIZE):
+    """
+    Decode every manifest image once into sharded TFRecords of uint8 img_size images
+
+    Rebuilds are incremental: each shard is fingerprinted from its manifest
+    rows (path, sha256, label) and only shards whose fingerprint changed
+    are rewritten; shards no longer in the manifest are deleted. The index is
+    saved after every shard, so an interrupted build resumes where it stopped.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, "index.json")
+    index = {'img_size': list(img_size), 'num_shards': num_shards, 'shards': {}}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            saved = json.load(f)
+        if saved.get('img_size') == list(img_size) and saved.get('num_shards') == num_shards:
+            index = saved
+
+    def save_index():
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(index_path + ".tmp", index_path)
+
+    manifest = manifest.assign(
+        shard=_shard_names(manifest, num_shards),
+        label_idx=[class_indices[dx] for dx in manifest['label']]
+    )
+    start = time.time()
+    rebuilt = 0
+    shards = dict(tuple(manifest.groupby('shard')))
+    for shard, rows in sorted(shards.items()):
+        fingerprint = _shard_fingerprint(rows)
+        shard_file = f"{shard}.tfrecord"
+        known = index['shards'].get(shard, {})
+        if known.get('fingerprint') == fingerprint and os.path.exists(os.path.join(cache_dir, shard_file)):
+            continue
+        write_image_shard(os.path.join(cache_dir, shard_file), rows['path'].tolist(),
+                          rows['label_idx'].tolist(), img_size)
+        index['shards'][shard] = {'file': shard_file, 'fingerprint': fingerprint, 'count': len(rows)}
+        save_index()
+        rebuilt += 1
+
+    for shard in set(index['shards']) - set(shards):
+        stale_path = os.path.join(cache_dir, index['shards'].pop(shard)['file'])
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+    save_index()
+
+    print(f"Image cache: rebuilt {rebuilt} of {len(shards)} shards in {time.time() - start:.1f}s ({cache_dir})")
+    return index
+
+def load_image_cache(cache_dir=IMAGE_CACHE_DIR, groups=None, img_size=IMG_SIZE, cycle_length=8,
+                     shuffle_shards=False, seed=SEED, deterministic=False):
+    """
+    (uint8 image, label) pairs streamed from the cache shards
+
+    Shards are read in parallel with interleave; groups (e.g. ['train'])
+    limits the result to those shard groups. shuffle_shards reorders the
+    shard files on every pass. By default records come in whichever order
+    the parallel reads finish; deterministic=True (without shuffle_shards)
+    yields the same order on every pass.
+    """
+    with open(os.path.join(cache_dir, "index.json")) as f:
+        index = json.load(f)
+    files = sorted(
+        os.path.join(cache_dir, info['file']) for shard, info in index['shards'].items()
+        if groups is None or shard.rsplit('-', 1)[0] in groups
+    )
+    if not files:
+        raise ValueError(f"No cached shards for {groups or 'any group'} in {cache_dir}")
+
+    feature_spec = {
+        'image': tf.io.FixedLenFeature([], tf.string),
+        'label': tf.io.FixedLenFeature([], tf.int64),
+    }
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, feature_spec)
+        image = tf.reshape(tf.io.decode_raw(example['image'], tf.uint8), img_size + (3,))
+        return image, tf.cast(example['label'], tf.int32)
+
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    if shuffle_shards:
+        dataset = dataset.shuffle(len(files), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.interleave(
+        lambda path: tf.data.TFRecordDataset(path, buffer_size=8 * 1024 * 1024),
+        cycle_length=min(cycle_length, len(files)),
+        num_parallel_calls=AUTOTUNE,
+        deterministic=deterministic
+    )
+    return dataset.map(parse, num_parallel_calls=AUTOTUNE)
+
+def benchmark_input_pipeline(dataset, num_batches=50, batch_size=BATCH_SIZE):
+    """Images per second delivered by an unbatched (image, label) dataset, after one warm-up batch"""
+    iterator = iter(dataset.batch(batch_size).prefetch(AUTOTUNE))
+    next(iterator)
+    images = 0
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        try:
+            batch_images, _ = next(iterator)
+        except StopIteration:
+            break
+        images += int(batch_images.shape[0])
+    return images / (time.perf_counter() - start)
+
 # CELL 6: Dataset Creation with Metadata
-def create_dataset_from_metadata(metadata_path, image_dirs, img_size=IMG_SIZE, batch_size=BATCH_SIZE, seed=SEED):
+def create_dataset_from_metadata(metadata_path, image_dirs, img_size=IMG_SIZE, batch_size=BATCH_SIZE, seed=SEED,
+                                 manifest_path=MANIFEST_PATH, refresh_manifest=REFRESH_MANIFEST,
+                                 use_cache=USE_IMAGE_CACHE, cache_dir=IMAGE_CACHE_DIR,
+                                 shuffle_buffer_size=SHUFFLE_BUFFER_SIZE):
     """Create a TensorFlow dataset using the HAM10000 metadata file to assign labels"""
     print(f"Loading metadata from: {metadata_path}")
 
@@ -163,66 +496,41 @@ def create_dataset_from_metadata(metadata_path, image_dirs, img_size=IMG_SIZE, b
     class_indices = {name: i for i, name in enumerate(class_names)}
     print(f"Found {len(class_names)} classes: {class_names}")
 
-    # Find all image files in the directories
-    all_image_paths = []
-    for img_dir in image_dirs:
-        if os.path.exists(img_dir):
-            for ext in ['.jpg', '.jpeg', '.png', '.bmp', '.gif']:
-                all_image_paths.extend(glob(os.path.join(img_dir, f"**/*{ext}"), recursive=True))
-                all_image_paths.extend(glob(os.path.join(img_dir, f"**/*{ext.upper()}"), recursive=True))
-
-    print(f"Found {len(all_image_paths)} image files")
-
-    # Match images to metadata
-    valid_paths = []
-    valid_labels = []
-
-    for img_path in all_image_paths:
-        # Extract image_id from filename
-        filename = os.path.basename(img_path)
-        image_id = os.path.splitext(filename)[0]
-
-        # Find in metadata
-        matching_rows = metadata_df[metadata_df['image_id'] == image_id]
-        if not matching_rows.empty:
-            dx = matching_rows.iloc[0]['dx']
-            label_idx = class_indices[dx]
-
-            valid_paths.append(img_path)
-            valid_labels.append(label_idx)
-
-    print(f"Matched {len(valid_paths)} images with metadata")
-
-    if not valid_paths:
+    # Find all image files and match them to metadata, then assign the
+    # fixed train/val/test split (see CELL 6a)
+    manifest = build_manifest(metadata_df, image_dirs, manifest_path=manifest_path, refresh=refresh_manifest)
+    if manifest.empty:
         raise ValueError("No images could be matched with metadata")
-
-    # Function to load and preprocess an image
-    def load_and_preprocess_image(img_path, label):
-        img = tf.io.read_file(img_path)
-        img = tf.image.decode_jpeg(img, channels=3)
-        img = tf.image.resize(img, img_size)
-        return img, label
-
-    # Create TensorFlow datasets
-    path_ds = tf.data.Dataset.from_tensor_slices(valid_paths)
-    label_ds = tf.data.Dataset.from_tensor_slices(valid_labels)
-    dataset = tf.data.Dataset.zip((path_ds, label_ds))
-
-    # Apply preprocessing
-    dataset = dataset.map(load_and_preprocess_image, num_parallel_calls=AUTOTUNE)
-
-    # Shuffle the dataset
-    dataset = dataset.shuffle(buffer_size=len(valid_paths), seed=seed)
-
-    # Split into train/val/test
-    total_size = len(valid_paths)
-    train_size = int(0.6 * total_size)
-    val_size = int(0.2 * total_size)
-
-    train_ds = dataset.take(train_size)
-    temp_ds = dataset.skip(train_size)
-    val_ds = temp_ds.take(val_size)
-    test_ds = temp_ds.skip(val_size)
+    manifest = split_manifest(manifest, seed=seed)
+    valid_labels = [class_indices[dx] for dx in manifest['label']]
+
+    def to_float(image, label):
+        return tf.cast(image, tf.float32), label
+
+    if use_cache:
+        # Decode once into the shard cache (CELL 6b), one set of shards per
+        # split. Training reads its shards in a new order every epoch and
+        # shuffles within a bounded buffer of uint8 images. Training images
+        # stay uint8 until augment_dataset (CELL 7) has augmented them.
+        build_image_cache(manifest, class_indices, cache_dir=cache_dir, img_size=img_size)
+        train_ds = (load_image_cache(cache_dir, groups=['train'], img_size=img_size, shuffle_shards=True, seed=seed)
+                    .shuffle(shuffle_buffer_size, seed=seed))
+        val_ds = load_image_cache(cache_dir, groups=['val'], img_size=img_size).map(to_float, num_parallel_calls=AUTOTUNE)
+        test_ds = load_image_cache(cache_dir, groups=['test'], img_size=img_size).map(to_float, num_parallel_calls=AUTOTUNE)
+    else:
+        # Shuffle file paths (a few bytes each) before decoding, so no
+        # decoded image waits in a shuffle buffer
+        splits = {}
+        for split in SPLIT_FRACTIONS:
+            rows = manifest[manifest['split'] == split]
+            splits[split] = (rows['path'].tolist(), [class_indices[dx] for dx in rows['label']])
+        train_paths, train_labels = splits['train']
+        train_ds = (tf.data.Dataset.from_tensor_slices((train_paths, train_labels))
+                    .shuffle(len(train_paths), seed=seed, reshuffle_each_iteration=True)
+                    .map(lambda path, label: (load_and_resize_image(path, img_size), label),
+                         num_parallel_calls=AUTOTUNE))
+        val_ds = make_raw_dataset(*splits['val'], img_size)
+        test_ds = make_raw_dataset(*splits['test'], img_size)
 
     # Batch and prepare for training
     train_ds = train_ds.batch(batch_size).prefetch(AUTOTUNE)
@@ -239,6 +547,9 @@ def create_dataset_from_metadata(metadata_path, image_dirs, img_size=IMG_SIZE, b
         class_name = class_names[label_idx]
         print(f"  {class_name}: {count} images ({count/len(valid_labels)*100:.1f}%)")
 
+    print("\nImages per split and class:")
+    print(pd.crosstab(manifest['label'], manifest['split'], margins=True).to_string())
+
     return train_ds, val_ds, test_ds, class_names
 
 # Create datasets using the metadata
@@ -250,18 +561,62 @@ print("\nClass names (diagnosis codes):")
 for i, class_name in enumerate(class_names):
     print(f"   {i}: {class_name}")
 
+# CELL 6c: Input Pipeline Benchmark
+# Images/sec of decoding JPEGs on every pass against streaming the shard cache.
+# Reads the whole training set twice; enable to regenerate input_pipeline_benchmark.csv
+RUN_INPUT_PIPELINE_BENCHMARK = False
+if RUN_INPUT_PIPELINE_BENCHMARK and USE_IMAGE_CACHE:
+    benchmark_manifest = pd.read_csv(MANIFEST_PATH)
+    benchmark_indices = {name: i for i, name in enumerate(class_names)}
+    raw_rate = benchmark_input_pipeline(make_raw_dataset(
+        benchmark_manifest['path'].tolist(), [benchmark_indices[dx] for dx in benchmark_manifest['label']]
+    ))
+    cached_rate = benchmark_input_pipeline(load_image_cache(IMAGE_CACHE_DIR))
+    benchmark_df = pd.DataFrame([
+        {'pipeline': 'raw (read + decode + resize)', 'images_per_sec': raw_rate},
+        {'pipeline': 'cached uint8 shards', 'images_per_sec': cached_rate},
+    ])
+    print(benchmark_df.to_string(index=False))
+    print(f"Speed-up: {cached_rate / raw_rate:.1f}x")
+    benchmark_df.to_csv(os.path.join(METRICS_DIR, "input_pipeline_benchmark.csv"), index=False)
+
 # CELL 7: Data Augmentation
 # Define enhanced data augmentation
-data_augmentation = Sequential([
-    tf.keras.layers.RandomFlip("horizontal_and_vertical"),
-    tf.keras.layers.RandomRotation(0.2),
-    tf.keras.layers.RandomZoom(0.2),
-    tf.keras.layers.RandomContrast(0.2),
-    tf.keras.layers.RandomBrightness(0.2),
-], name="data_augmentation")
+def make_augmentation(seed=None):
+    """The augmentation block; with a seed it draws the same transformations on every run"""
+    return Sequential([
+        tf.keras.layers.RandomFlip("horizontal_and_vertical", seed=seed),
+        tf.keras.layers.RandomRotation(0.2, seed=seed),
+        tf.keras.layers.RandomZoom(0.2, seed=seed),
+        tf.keras.layers.RandomContrast(0.2, seed=seed),
+        tf.keras.layers.RandomBrightness(0.2, seed=seed),
+    ], name="data_augmentation")
+
+data_augmentation = make_augmentation()
 
 print("\nData augmentation pipeline created with enhanced transformations")
 
+def augment_dataset(dataset, augmentation=data_augmentation):
+    """
+    Randomly augment batched training images in parallel tf.data workers
+
+    Augmentation used to be the first block of the model, where it ran
+    serially inside each training step and stayed in the exported graph.
+    In the input pipeline it overlaps with training, and the model the
+    servers load contains no augmentation ops. Batches from the image cache
+    arrive as uint8 and are only cast to float32 after augmenting.
+    """
+    dataset = dataset.map(
+        lambda images, labels: (tf.cast(augmentation(images, training=True), tf.float32), labels),
+        num_parallel_calls=AUTOTUNE
+    )
+    return dataset.prefetch(AUTOTUNE)
+
+# Kept for the visualization below, the augmentation benchmark and int8
+# calibration, which all want the original images
+train_dataset_unaugmented = train_dataset
+train_dataset = augment_dataset(train_dataset)
+
 # CELL 8: Visualize Augmented Images
 def visualize_augmentations(dataset, augmentation_model, num_examples=5):
     """Show examples of augmented images"""
@@ -269,7 +624,7 @@ def visualize_augmentations(dataset, augmentation_model, num_examples=5):
 
     for images, labels in dataset.take(1):
         images = images[:num_examples]
-        augmented_images = augmentation_model(images)
+        augmented_images = augmentation_model(images, training=True)
 
         for i in range(num_examples):
             # Original image
@@ -289,11 +644,18 @@ def visualize_augmentations(dataset, augmentation_model, num_examples=5):
     plt.show()
 
 # Show some augmented examples
-visualize_augmentations(train_dataset, data_augmentation)
+visualize_augmentations(train_dataset_unaugmented, data_augmentation)
 
 # CELL 9: MobileNetV2 Model Building
-def build_mobilenet_model(optimizer_name="Adam"):
-    """Build MobileNetV2 model for skin lesion classification"""
+def build_mobilenet_model(optimizer_name="Adam", in_graph_augmentation=False):
+    """
+    Build MobileNetV2 model for skin lesion classification
+
+    Training data is augmented in the input pipeline (augment_dataset), so
+    the model itself has no augmentation layers. in_graph_augmentation=True
+    rebuilds the old layout with data_augmentation as the first block, for
+    the comparison in CELL 9b only.
+    """
     input_shape = IMG_SIZE + (3,)  # Add channels dimension
 
     # Create unique layer names
@@ -302,8 +664,7 @@ def build_mobilenet_model(optimizer_name="Adam"):
     # Define model inputs
     inputs = Input(shape=input_shape, name=f"{model_prefix}input")
 
-    # Apply data augmentation (only during training)
-    x = data_augmentation(inputs)
+    x = data_augmentation(inputs) if in_graph_augmentation else inputs
 
     # Load MobileNetV2 base model
     base_model = MobileNetV2(include_top=False, weights='imagenet', input_shape=input_shape)
@@ -362,6 +723,66 @@ def build_mobilenet_model(optimizer_name="Adam"):
 
     return model, base_model, fine_tune_at, optimizer_name
 
+# CELL 9b: Augmentation Placement Benchmark
+class StepTimeCallback(tf.keras.callbacks.Callback):
+    """Wall time of every training step, in seconds"""
+
+    def on_train_begin(self, logs=None):
+        self.step_times = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step_times.append(time.perf_counter() - self._step_start)
+
+    def mean_step_ms(self, skip=1):
+        # The first steps include tracing and pipeline warm-up
+        times = self.step_times[skip:] or self.step_times
+        return float(np.mean(times)) * 1000 if times else float('nan')
+
+def measure_serving_latency(model, batch_size=1, runs=30):
+    """Median milliseconds of one inference call, as the servers run it"""
+    images = tf.random.uniform((batch_size,) + IMG_SIZE + (3,), maxval=255)
+    serve = tf.function(lambda x: model(x, training=False))
+    serve(images)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        serve(images).numpy()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000
+
+def benchmark_augmentation_placement(steps=30):
+    """Step time and serving latency with augmentation in the model graph vs in tf.data"""
+    rows = []
+    for placement, in_graph, dataset in [
+        ('in model graph (before)', True, train_dataset_unaugmented),
+        ('tf.data map (after)', False, train_dataset),
+    ]:
+        model, _, _, _ = build_mobilenet_model("Adam", in_graph_augmentation=in_graph)
+        step_timer = StepTimeCallback()
+        model.fit(dataset.take(steps), epochs=1, callbacks=[step_timer], verbose=0)
+        rows.append({
+            'augmentation': placement,
+            'train_step_ms': step_timer.mean_step_ms(),
+            'serving_ms_batch_1': measure_serving_latency(model, 1),
+            'serving_ms_batch_32': measure_serving_latency(model, 32),
+        })
+        del model
+        tf.keras.backend.clear_session()
+        gc.collect()
+
+    report_df = pd.DataFrame(rows)
+    print(report_df.to_string(index=False))
+    report_df.to_csv(os.path.join(METRICS_DIR, "augmentation_benchmark.csv"), index=False)
+    return report_df
+
+# Builds and briefly trains two extra models; enable to regenerate augmentation_benchmark.csv
+RUN_AUGMENTATION_BENCHMARK = False
+if RUN_AUGMENTATION_BENCHMARK:
+    benchmark_augmentation_placement()
+
 # CELL 10: Setup Callbacks
 def setup_callbacks(optimizer_name):
     """Create callbacks for training"""
@@ -413,6 +834,142 @@ def setup_callbacks(optimizer_name):
 
     return callbacks, model_path, timestamp
 
+# CELL 10b: Phase 1 Feature Cache
+# In Phase 1 the backbone is frozen, so its output for a given input never
+# changes. Pooled features (GAP output) are computed once per training image
+# and augmentation seed, plus once for validation, and stored as float16
+# memory-mapped files. The head then trains on them without running the
+# backbone at all. Every training view is written from the same fixed order
+# of the train split, so row i is the same image in each of them.
+HEAD_LAYERS = ['bn1', 'dropout1', 'dense1', 'bn2', 'dropout2', 'dense2', 'bn3', 'dropout3', 'output']
+
+def feature_cache_key(seeds, img_size=IMG_SIZE):
+    """Changes whenever the images, the split, the input size or the seeds change"""
+    digest = hashlib.sha1()
+    for path in (MANIFEST_PATH, SPLIT_PATH):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    digest.update(json.dumps({'img_size': list(img_size), 'seeds': list(seeds), 'uint8_cache': USE_IMAGE_CACHE,
+                              'backbone': 'MobileNetV2/imagenet', 'tf': tf.__version__,
+                              'train_order': 'fixed'}).encode())
+    return digest.hexdigest()[:16]
+
+def ordered_train_dataset(batch_size=BATCH_SIZE):
+    """
+    Batches of the train split in one fixed order, never shuffled
+
+    The same images come in the same order on every pass and every run for
+    an unchanged manifest and split: cached shards are read in file order
+    with a deterministic interleave, raw files in path order.
+    """
+    if USE_IMAGE_CACHE:
+        dataset = load_image_cache(IMAGE_CACHE_DIR, groups=['train'], deterministic=True)
+    else:
+        manifest = split_manifest(pd.read_csv(MANIFEST_PATH, float_precision='round_trip'))
+        rows = manifest[manifest['split'] == 'train'].sort_values('path')
+        class_indices = {name: i for i, name in enumerate(class_names)}
+        dataset = make_raw_dataset(rows['path'].tolist(), [class_indices[dx] for dx in rows['label']])
+    return dataset.batch(batch_size)
+
+def _write_features(extractor, dataset, features_path, augmentation=None):
+    labels = []
+    with open(features_path + ".tmp", 'wb') as f:
+        for images, batch_labels in dataset:
+            if augmentation is not None:
+                images = augmentation(images, training=True)
+            images = tf.cast(images, tf.float32)
+            extractor(images, training=False).numpy().astype(np.float16).tofile(f)
+            labels.append(batch_labels.numpy().astype(np.int32))
+    np.save(features_path + ".labels.npy", np.concatenate(labels))
+    os.replace(features_path + ".tmp", features_path)
+
+def _open_features(features_path, dim):
+    labels = np.load(features_path + ".labels.npy", mmap_mode='r')
+    features = np.memmap(features_path, dtype=np.float16, mode='r', shape=(len(labels), dim))
+    return features, labels
+
+def build_feature_cache(model, optimizer_name, num_augmentations=FEATURE_CACHE_AUGMENTATIONS,
+                        cache_dir=FEATURE_CACHE_DIR, seed=SEED):
+    """
+    Memory-mapped pooled features: {'train': [(features, labels) per seed], 'val': (features, labels)}
+
+    Each train view is one seeded augmentation of ordered_train_dataset(),
+    so the views line up row for row and shuffling is left to
+    feature_dataset. Reuses whatever an earlier run (or an interrupted one)
+    already wrote for the same images, split and seeds.
+    """
+    prefix = f"MobileNetV2_{optimizer_name}_"
+    gap = model.get_layer(f"{prefix}gap")
+    extractor = Model(model.inputs, gap.output, name=f"{prefix}feature_extractor")
+    dim = int(gap.output.shape[-1])
+
+    seeds = [seed + i for i in range(num_augmentations)]
+    key_dir = os.path.join(cache_dir, feature_cache_key(seeds))
+    os.makedirs(key_dir, exist_ok=True)
+
+    start = time.time()
+    train_ordered = ordered_train_dataset()
+    jobs = [(f"train_seed{s}.f16", train_ordered, s) for s in seeds]
+    jobs.append(("val.f16", val_dataset, None))
+    for name, dataset, augmentation_seed in jobs:
+        features_path = os.path.join(key_dir, name)
+        if os.path.exists(features_path):
+            continue
+        print(f"Computing backbone features: {name}")
+        augmentation = make_augmentation(augmentation_seed) if augmentation_seed is not None else None
+        _write_features(extractor, dataset, features_path, augmentation)
+    print(f"Feature cache ready in {time.time() - start:.1f}s: {key_dir}")
+
+    return {
+        'train': [_open_features(os.path.join(key_dir, f"train_seed{s}.f16"), dim) for s in seeds],
+        'val': _open_features(os.path.join(key_dir, "val.f16"), dim),
+        'dim': dim,
+    }
+
+def feature_dataset(views, dim, batch_size=BATCH_SIZE, shuffle=False, seed=SEED):
+    """
+    Batches of (features, label) read from memory-mapped views
+
+    With several views (augmentation seeds) each example is drawn from a
+    randomly chosen view on every pass, standing in for fresh augmentation.
+    The views must hold the same images in the same rows (build_feature_cache
+    writes them that way); shuffle=True is the only shuffling they get.
+    """
+    count = min(len(labels) for _, labels in views)
+
+    def fetch(view_ids, indices):
+        features = np.empty((len(indices), dim), dtype=np.float32)
+        labels = np.empty(len(indices), dtype=np.int32)
+        for view in np.unique(view_ids):
+            rows = np.nonzero(view_ids == view)[0]
+            view_features, view_labels = views[view]
+            features[rows] = view_features[indices[rows]]
+            labels[rows] = view_labels[indices[rows]]
+        return features, labels
+
+    def load(view_ids, indices):
+        features, labels = tf.numpy_function(fetch, [view_ids, indices], [tf.float32, tf.int32])
+        features.set_shape([None, dim])
+        labels.set_shape([None])
+        return features, labels
+
+    dataset = tf.data.Dataset.range(count)
+    if shuffle:
+        dataset = dataset.shuffle(count, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.map(
+        lambda index: (tf.random.uniform([], 0, len(views), dtype=tf.int64, seed=seed), index)
+    )
+    return dataset.batch(batch_size).map(load, num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
+
+def build_head_model(model, optimizer_name, dim):
+    """The classification head of model on feature inputs; it shares (and so trains) the model's layers"""
+    prefix = f"MobileNetV2_{optimizer_name}_"
+    features = Input(shape=(dim,), name=f"{prefix}features")
+    x = features
+    for name in HEAD_LAYERS:
+        x = model.get_layer(f"{prefix}{name}")(x)
+    return Model(features, x, name=f"{prefix}head")
+
 # CELL 11: Training Function
 def train_mobilenet_model(optimizer_name="Adam"):
     """Train MobileNetV2 model on skin lesion dataset"""
@@ -424,22 +981,47 @@ def train_mobilenet_model(optimizer_name="Adam"):
 
     # Set up callbacks
     callbacks, model_path, timestamp = setup_callbacks(optimizer_name)
+    step_timer = StepTimeCallback()
 
     # Record start time
     start_time = time.time()
 
     # Phase 1: Train with frozen base model
     print(f"\nPhase 1: Training with frozen base model for {INITIAL_EPOCHS} epochs")
-    history = model.fit(
-        train_dataset,
-        epochs=INITIAL_EPOCHS,
-        validation_data=val_dataset,
-        callbacks=callbacks
-    )
+    if USE_FEATURE_CACHE:
+        # Train only the head, on cached backbone features (CELL 10b). Its
+        # layers are the model's own, so the full model is trained with it.
+        feature_cache = build_feature_cache(model, optimizer_name)
+        head = build_head_model(model, optimizer_name, feature_cache['dim'])
+        head.compile(
+            optimizer=model.optimizer.__class__.from_config(model.optimizer.get_config()),
+            loss='sparse_categorical_crossentropy',
+            metrics=[
+                'accuracy',
+                tf.keras.metrics.SparseTopKCategoricalAccuracy(k=3, name='top3_accuracy'),
+                tf.keras.metrics.SparseCategoricalAccuracy(name='categorical_accuracy')
+            ]
+        )
+        # The checkpoint callback is left out: head weights do not fit the
+        # full model that Phase 2 checkpoints to the same file
+        history = head.fit(
+            feature_dataset(feature_cache['train'], feature_cache['dim'], shuffle=True),
+            epochs=INITIAL_EPOCHS,
+            validation_data=feature_dataset([feature_cache['val']], feature_cache['dim']),
+            callbacks=[cb for cb in callbacks if not isinstance(cb, ModelCheckpoint)] + [step_timer]
+        )
+    else:
+        history = model.fit(
+            train_dataset,
+            epochs=INITIAL_EPOCHS,
+            validation_data=val_dataset,
+            callbacks=callbacks + [step_timer]
+        )
 
     # Record time after initial training
     phase1_time = time.time() - start_time
-    print(f"Phase 1 training completed in {phase1_time:.2f} seconds")
+    phase1_step_ms = step_timer.mean_step_ms()
+    print(f"Phase 1 training completed in {phase1_time:.2f} seconds ({phase1_step_ms:.1f} ms/step)")
 
     # Phase 2: Fine-tuning
     print(f"\nPhase 2: Fine-tuning from layer {fine_tune_at} for {FINE_TUNE_EPOCHS} epochs")
@@ -474,13 +1056,16 @@ def train_mobilenet_model(optimizer_name="Adam"):
         epochs=INITIAL_EPOCHS + FINE_TUNE_EPOCHS,
         initial_epoch=history.epoch[-1] + 1,
         validation_data=val_dataset,
-        callbacks=callbacks
+        callbacks=callbacks + [step_timer]
     )
 
     # Record time after fine-tuning
     total_time = time.time() - start_time
     phase2_time = total_time - phase1_time
-    print(f"Phase 2 fine-tuning completed in {phase2_time:.2f} seconds")
+    phase2_step_ms = step_timer.mean_step_ms()
+    serving_ms = measure_serving_latency(model, 1)
+    print(f"Phase 2 fine-tuning completed in {phase2_time:.2f} seconds ({phase2_step_ms:.1f} ms/step)")
+    print(f"Serving latency (batch of 1): {serving_ms:.1f} ms")
     print(f"Total training time: {total_time:.2f} seconds")
 
     # Evaluate the model on the test set
@@ -518,7 +1103,10 @@ def train_mobilenet_model(optimizer_name="Adam"):
         'test_categorical_accuracy': test_cat_acc,
         'training_time_phase1': phase1_time,
         'training_time_phase2': phase2_time,
-        'training_time_total': total_time
+        'training_time_total': total_time,
+        'step_time_ms_phase1': phase1_step_ms,
+        'step_time_ms_phase2': phase2_step_ms,
+        'serving_latency_ms': serving_ms
     }
 
     return model, history_data, metrics
@@ -995,6 +1583,112 @@ if __name__ == "__main__":
 # This cell can be run independently after the main training is complete
 # No need to modify existing code
 
+# Number of training images used to calibrate the int8 quantization ranges
+TFLITE_CALIBRATION_SAMPLES = 200
+
+def tflite_representative_dataset(dataset=None, num_samples=TFLITE_CALIBRATION_SAMPLES):
+    """Yield single training images from create_dataset_from_metadata for int8 calibration"""
+    dataset = dataset if dataset is not None else train_dataset_unaugmented
+
+    def generator():
+        for image, _ in dataset.unbatch().take(num_samples):
+            yield [tf.expand_dims(tf.cast(image, tf.float32), 0)]
+
+    return generator
+
+def evaluate_tflite_model(tflite_path, dataset, num_threads=None):
+    """Top-1 accuracy of a TFLite model on a batched (images, labels) dataset"""
+    interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=num_threads)
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    input_dtype = input_details['dtype']
+    output_dtype = output_details['dtype']
+
+    interpreter.resize_tensor_input(input_details['index'], [1] + list(input_details['shape'][1:]))
+    interpreter.allocate_tensors()
+
+    correct = 0
+    total = 0
+    for images, labels in dataset.unbatch():
+        image = tf.expand_dims(tf.cast(images, tf.float32), 0).numpy()
+        if input_dtype != np.float32:
+            scale, zero_point = input_details['quantization']
+            info = np.iinfo(input_dtype)
+            image = np.clip(np.round(image / scale + zero_point), info.min, info.max).astype(input_dtype)
+        interpreter.set_tensor(input_details['index'], image)
+        interpreter.invoke()
+        output = interpreter.get_tensor(output_details['index'])[0]
+        if output_dtype != np.float32:
+            scale, zero_point = output_details['quantization']
+            output = (output.astype(np.float32) - zero_point) * scale
+        correct += int(np.argmax(output) == int(labels.numpy()))
+        total += 1
+
+    return correct / total if total else 0.0
+
+def export_tflite_models(model, model_path, timestamp, calibration_ds=None, eval_ds=None):
+    """
+    Export fp16 and full-int8 TFLite variants of a trained model
+
+    The int8 model is calibrated on training images from create_dataset_from_metadata
+    and uses int8 inputs/outputs, so it runs integer-only on CPU. Each variant is
+    evaluated on the test split and the accuracy delta against the Keras model is
+    saved to tflite_report_<timestamp>.csv so a serving variant can be picked knowingly.
+    """
+    calibration_ds = calibration_ds if calibration_ds is not None else train_dataset_unaugmented
+    eval_ds = eval_ds if eval_ds is not None else test_dataset
+
+    exported = {}
+
+    # fp16: weights stored as float16, compute stays float32 on CPU
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+    exported['fp16'] = converter.convert()
+
+    # Full integer quantization calibrated on real training images
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = tflite_representative_dataset(calibration_ds)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    exported['int8'] = converter.convert()
+
+    print("\nEvaluating Keras model on test split for the TFLite comparison...")
+    keras_results = model.evaluate(eval_ds, verbose=0, return_dict=True)
+    keras_accuracy = keras_results['accuracy']
+
+    keras_size_mb = model.count_params() * 4 / (1024 * 1024)
+    rows = [{'variant': 'keras', 'path': '', 'size_mb': keras_size_mb,
+             'accuracy': keras_accuracy, 'accuracy_delta': 0.0}]
+
+    for variant, tflite_bytes in exported.items():
+        tflite_path = os.path.join(model_path, f"model_{timestamp}_{variant}.tflite")
+        with open(tflite_path, "wb") as f:
+            f.write(tflite_bytes)
+
+        accuracy = evaluate_tflite_model(tflite_path, eval_ds)
+        rows.append({
+            'variant': variant,
+            'path': tflite_path,
+            'size_mb': len(tflite_bytes) / (1024 * 1024),
+            'accuracy': accuracy,
+            'accuracy_delta': accuracy - keras_accuracy
+        })
+        print(f"✓ {variant} TFLite model saved to: {tflite_path}")
+
+    report_df = pd.DataFrame(rows)
+    report_path = os.path.join(model_path, f"tflite_report_{timestamp}.csv")
+    report_df.to_csv(report_path, index=False)
+
+    print("\nTFLite export summary (test split):")
+    print(report_df[['variant', 'size_mb', 'accuracy', 'accuracy_delta']].to_string(index=False))
+    print(f"✓ TFLite report saved to: {report_path}")
+    print("Serve a variant with MODEL_BACKEND=tflite TFLITE_MODEL_PATH=<path> [TFLITE_NUM_THREADS=<n>]")
+
+    return report_df
+
 def save_complete_model_standalone():
     """Save the most recently trained model completely (architecture + weights + optimizer state)"""
     # Try to get the model from the global scope
@@ -1045,6 +1739,12 @@ def save_complete_model_standalone():
         model.save(h5_path, save_format='h5')
         print(f"✓ H5 model saved to: {h5_path}")
 
+        # Export quantized TFLite variants for CPU serving
+        try:
+            export_tflite_models(model, model_path, timestamp)
+        except Exception as e:
+            print(f"⚠️ Error exporting TFLite models: {e}")
+
         # Create example code for loading the model
         loading_code = f"""
 # Example code to load the saved model:
@@ -1079,6 +1779,7 @@ File Formats:
   - TensorFlow SavedModel: {complete_model_path}
   - SavedModel Format: {savedmodel_path}
   - H5 Format: {h5_path}
+  - TFLite fp16 / int8: {os.path.join(model_path, f"model_{timestamp}_<variant>.tflite")}
 
 Model Summary:
 """